@@ -0,0 +1,47 @@
+'''Rows/sec of the old per-row timestamp parsing versus parse_datetime_column
+
+Run from the repository root:
+    python benchmarks/bench_datetime_parsing.py
+'''
+import os
+import sys
+import time
+
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src', 'main', 'python'))
+
+from clean_utils import (AIR_EGG_TIME_FORMAT, PURPLE_AIR_TIME_FORMAT,
+                         parse_datetime_column, parse_time_string)
+
+FILES = [
+    ('Purple_air.csv', 'created_at', PURPLE_AIR_TIME_FORMAT),
+    ('air_egg.csv', 'Timestamp', AIR_EGG_TIME_FORMAT),
+]
+
+def per_row(col):
+    #the parsing stage Data_File.clean used before vectorization
+    col = col.apply(parse_time_string)
+    col = col.apply(pd.to_datetime)
+    return col.apply(lambda x: x.replace(tzinfo=None))
+
+def rows_per_second(func, col, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(col)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(col) / best
+
+if __name__ == '__main__':
+    for fn, column, time_format in FILES:
+        col = pd.read_csv(os.path.join(ROOT, 'data', fn), usecols=[column])[column]
+        before = rows_per_second(per_row, col)
+        after = rows_per_second(lambda c: parse_datetime_column(c, time_format), col)
+        fallback = rows_per_second(parse_datetime_column, col)
+        print('{}: {} rows'.format(fn, len(col)))
+        print('  per-row dateutil:   {:>12,.0f} rows/sec'.format(before))
+        print('  vectorized format:  {:>12,.0f} rows/sec ({:.0f}x)'.format(after, after / before))
+        print('  vectorized inferred:{:>12,.0f} rows/sec ({:.0f}x)'.format(fallback, fallback / before))
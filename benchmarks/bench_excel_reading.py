@@ -0,0 +1,70 @@
+'''Wall time and peak memory of reading a PurpleAir .xlsx export with pandas.read_excel versus
+excel_utils.read_sheet, whole and in chunks
+
+Run from the repository root (the workbooks are written to a temporary folder first):
+    python benchmarks/bench_excel_reading.py 10000 100000
+'''
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src', 'main', 'python'))
+
+from excel_utils import read_sheet
+from sensors import NA_VALUES, PurpleAirFormat
+
+CHUNKSIZE = 10000
+
+def write_workbook(path, rows):
+    #same layout as data/Purple_air.csv, two decimal readings every 80 seconds
+    rng = np.random.RandomState(0)
+    raw = pd.read_csv(os.path.join(ROOT, 'data', 'Purple_air.csv'), nrows=1)
+    pm25 = np.round(rng.gamma(2.0, 8.0, rows), 2)
+    times = pd.date_range('2018-08-09 00:00:17', periods=rows, freq='80S')
+    df = pd.DataFrame(dict((col, pm25) for col in raw.columns), columns=raw.columns)
+    df[raw.columns[0]] = times.strftime('%Y-%m-%d %H:%M:%S UTC')
+    df.to_excel(path, index=False)
+
+def measure(func, repeat=2):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak / (1024 * 1024)
+
+if __name__ == '__main__':
+    sensor_format = PurpleAirFormat()
+    usecols = sensor_format.used_columns()
+    dtypes = dict((col, dtype) for col, dtype in sensor_format.dtypes.items() if col in usecols)
+    readers = [
+        ('pandas.read_excel', lambda path: pd.read_excel(path, header=0, names=sensor_format.columns, usecols=usecols,
+                                                         dtype=dtypes, na_values=NA_VALUES)),
+        ('read_sheet', lambda path: read_sheet(path, None, sensor_format.columns, usecols, dtypes, NA_VALUES)),
+        ('read_sheet chunks', lambda path: sum(len(chunk.index) for chunk in read_sheet(
+            path, None, sensor_format.columns, usecols, dtypes, NA_VALUES, CHUNKSIZE))),
+    ]
+    folder = tempfile.mkdtemp()
+    try:
+        for rows in [int(arg) for arg in sys.argv[1:]] or [10000, 100000]:
+            path = os.path.join(folder, 'purple_air_{}.xlsx'.format(rows))
+            write_workbook(path, rows)
+            pd.testing.assert_frame_equal(readers[0][1](path), readers[1][1](path))
+            print('{:,} rows'.format(rows))
+            for name, reader in readers:
+                seconds, peak = measure(lambda: reader(path))
+                print('  {:<18} {:>7.2f} s {:>8.1f} MB peak'.format(name, seconds, peak))
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import shutil
+from collections import namedtuple
+
+from cache_utils import touch
+
+#folder of the store under cache_utils.user_cache_dir()
+ARTIFACT_FOLDER = 'artifacts'
+#bump whenever an artifact comes out differently for the same inputs, so stored ones are rebuilt
+ARTIFACT_VERSION = 3
+
+#name: used to request the artifact and as its file_dict key
+#filename: file it is written to in the output folder (internal artifacts only live in the store)
+#inputs: artifacts it is made from, or the sources 'data' (the cleaned, filtered and resampled data of the run)
+#    and 'header' (the PDF header image)
+#internal: only kept in the store, never written to the output folder
+#stored: kept in the store, the pdf is not because it carries the time it was generated
+Artifact = namedtuple('Artifact', ['name', 'filename', 'inputs', 'internal', 'stored'])
+
+SOURCES = ['data', 'header']
+#every output of a report, each listed after its inputs
+ARTIFACTS = [
+    Artifact('cleaned_data', 'cleaned_data.csv', ['data'], False, True),
+    Artifact('summary_stats', 'summary_stats.pkl', ['data'], True, True),
+    Artifact('basic_stats', 'general_statistics.csv', ['summary_stats'], False, True),
+    Artifact('threshold_stats', 'threshold_stats.csv', ['data'], False, True),
+    Artifact('sampling_profile', 'sampling_profile.json', ['data'], True, True),
+    Artifact('boxplot', 'boxplot.png', ['data'], False, True),
+    Artifact('humidity_graph', 'humidity_graph.png', ['data'], False, True),
+    Artifact('PM25_thresh', 'pm25_graph.png', ['data'], False, True),
+    Artifact('PM10_thresh', 'pm10_graph.png', ['data'], False, True),
+    Artifact('pdf', 'summary.pdf', ['basic_stats', 'threshold_stats', 'sampling_profile', 'boxplot',
+                                    'humidity_graph', 'PM25_thresh', 'PM10_thresh', 'header'], False, False),
+]
+ARTIFACT_NAMES = [artifact.name for artifact in ARTIFACTS]
+#what a report is made of when the caller does not ask for a subset
+REPORT_ARTIFACTS = [artifact.name for artifact in ARTIFACTS if not artifact.internal]
+
+def get_artifact(name):
+    for artifact in ARTIFACTS:
+        if artifact.name == name:
+            return artifact
+    raise ValueError('Unknown artifact {}, expected one of {}'.format(name, ', '.join(ARTIFACT_NAMES)))
+
+def digest(values):
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+def artifact_keys(source_keys):
+    '''Hashes every artifact from the hashes of its inputs, so a change to any source changes the key of
+    every artifact made from it
+
+    @param source_keys: dict of source name ('data', 'header') to its hash
+    @result dict of artifact name to key
+    '''
+    keys = dict(source_keys)
+    for artifact in ARTIFACTS:
+        keys[artifact.name] = digest([artifact.name, ARTIFACT_VERSION, [keys[name] for name in artifact.inputs]])
+    return keys
+
+def plan_artifacts(requested, is_stored):
+    '''Works out which of the requested artifacts, and of the inputs they need, must be built
+
+    An artifact that is stored is reused as it is, so its own inputs are not needed for it.
+
+    @param requested: artifact names
+    @param is_stored: function of an artifact name, True if the store holds it for the current inputs
+    @result tuple of (set of names to reuse, list of names to build in dependency order, set of sources needed)
+    '''
+    reuse = set()
+    build = set()
+    sources = set()
+    pending = [get_artifact(name).name for name in requested]
+    while pending:
+        name = pending.pop()
+        if name in SOURCES:
+            sources.add(name)
+        elif name not in reuse and name not in build:
+            if is_stored(name):
+                reuse.add(name)
+            else:
+                build.add(name)
+                pending.extend(get_artifact(name).inputs)
+    return reuse, [name for name in ARTIFACT_NAMES if name in build], sources
+
+
+class ArtifactStore():
+    '''Artifact Store Class - keeps a copy of every artifact built, by the key of its inputs
+    Files are copied in and out rather than linked, so editing an output file never changes the store.
+    Reading an artifact touches it, so cache_utils.prune_cache drops the least recently used ones first.
+    @param store_dir: folder of the store, created on first save
+    @function contains: whether an artifact is stored
+    @function fetch: copies a stored artifact into an output folder
+    @function save: stores an artifact file
+    '''
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def path(self, key, filename):
+        return os.path.join(self.store_dir, key[:2], '{}_{}'.format(key, filename))
+
+    def contains(self, key, filename):
+        return os.path.exists(self.path(key, filename))
+
+    def fetch(self, key, filename, output_folder):
+        outpath = os.path.join(output_folder, filename)
+        shutil.copyfile(self.path(key, filename), outpath)
+        touch(self.path(key, filename))
+        return outpath
+
+    def save(self, key, filename, src_path):
+        path = self.path(key, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        #copy to a temporary name first so a crash never leaves a truncated artifact behind
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+    def load_bytes(self, key, filename):
+        #internal artifacts are read straight from the store
+        with open(self.path(key, filename), 'rb') as f:
+            data = f.read()
+        touch(self.path(key, filename))
+        return data
+
+    def save_bytes(self, key, filename, data):
+        path = self.path(key, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return path
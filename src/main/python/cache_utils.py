@@ -0,0 +1,182 @@
+import glob
+import hashlib
+import json
+import os
+import sys
+
+#pyarrow is optional, without it every run re-parses the raw file
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+#the caches live in a per-user folder rather than next to the reports, and are pruned to a size limit
+CACHE_DIR_ENV = 'AQA_DISK_CACHE_DIR'
+CACHE_LIMIT_ENV = 'AQA_DISK_CACHE_MB'
+DEFAULT_CACHE_LIMIT_MB = 2048
+CACHE_FOLDER = 'clean'
+
+def cache_available():
+    return feather is not None
+
+def user_cache_dir():
+    '''Folder of the on-disk caches of the current user, AQA_DISK_CACHE_DIR overrides it
+
+    @result %LOCALAPPDATA%\\AirQualityAnalysis\\Cache on Windows, ~/Library/Caches/AirQualityAnalysis on macOS
+        and $XDG_CACHE_HOME/air-quality-analysis (~/.cache by default) elsewhere
+    '''
+    if os.environ.get(CACHE_DIR_ENV):
+        return os.environ[CACHE_DIR_ENV]
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+        return os.path.join(base, 'AirQualityAnalysis', 'Cache')
+    if sys.platform == 'darwin':
+        return os.path.expanduser(os.path.join('~', 'Library', 'Caches', 'AirQualityAnalysis'))
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache'))
+    return os.path.join(base, 'air-quality-analysis')
+
+def cache_limit_bytes():
+    return int(float(os.environ.get(CACHE_LIMIT_ENV, DEFAULT_CACHE_LIMIT_MB)) * (1 << 20))
+
+def touch(path):
+    #marks a cache entry as used, the modification time orders entries for prune_cache
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+def prune_cache(cache_dir, limit_bytes):
+    '''Deletes the least recently used files under a cache folder until it fits a size limit
+
+    Entries are touched whenever they are read, so their modification time is their last use.
+    A file deleted while another process reads it is a cache miss there, never an error.
+
+    @param cache_dir: folder to prune, every file below it counts towards the limit
+    @param limit_bytes: size the folder is pruned to
+    @result number of files deleted
+    '''
+    entries = []
+    total = 0
+    for folder, _, filenames in os.walk(cache_dir):
+        for fn in filenames:
+            path = os.path.join(folder, fn)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, path, st.st_size))
+            total += st.st_size
+    removed = 0
+    for _, path, size in sorted(entries):
+        if total <= limit_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+def file_hash(filepath, block_size=1 << 20):
+    #sha256 of the file contents, read in blocks so large exports are not loaded at once
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cache_filename(digest, sensor_name, clean_version):
+    return '{}_{}_v{}.feather'.format(digest, sensor_name, clean_version)
+
+def load_clean_cache(cache_dir, digest, clean_version):
+    '''Looks up a cleaned data frame stored by store_clean_cache
+
+    @param cache_dir: folder holding the cached files
+    @param digest: file_hash of the raw input file
+    @param clean_version: version of the cleaning code that produced the cached frame
+    @result tuple of (sensor name, data frame), or (None, None) on a cache miss
+    '''
+    if not cache_available():
+        return None, None
+    pattern = os.path.join(cache_dir, cache_filename(digest, '*', clean_version))
+    for path in glob.glob(pattern):
+        sensor_name = os.path.basename(path)[len(digest) + 1:-len('_v{}.feather'.format(clean_version))]
+        try:
+            table = feather.read_table(path)
+        except (IOError, pa.ArrowInvalid):
+            #partially written, corrupt or just pruned cache entry, treat as a miss
+            continue
+        touch(path)
+        return sensor_name, table.to_pandas()
+    return None, None
+
+def store_clean_cache(cache_dir, digest, sensor_name, clean_version, df):
+    '''Writes a cleaned data frame to the cache in the Feather (Arrow IPC) format
+
+    @param df: cleaned data frame, its index is not stored
+    @result path of the cache file, or None if pyarrow is not installed
+    '''
+    if not cache_available():
+        return None
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, cache_filename(digest, sensor_name, clean_version))
+    #write to a temporary name first so a crash never leaves a truncated entry behind
+    #the pid keeps batch workers cleaning the same file from sharing a temporary file
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    feather.write_feather(df.reset_index(drop=True), tmp_path, compression='uncompressed')
+    os.replace(tmp_path, path)
+    return path
+
+def pyramid_filename(digest, sensor_name, clean_version, level):
+    return '{}_{}_v{}_{}.feather'.format(digest, sensor_name, clean_version, level)
+
+def metadata_filename(digest, sensor_name, clean_version):
+    return '{}_{}_v{}_pyramid.json'.format(digest, sensor_name, clean_version)
+
+def load_pyramid(cache_dir, digest, sensor_name, clean_version, levels):
+    '''Looks up the pre-aggregated tables stored by store_pyramid
+
+    @param levels: names of the levels to load
+    @result tuple of (dict of level name to DataFrame indexed by bucket start, metadata dict), or (None, None) on a miss
+    '''
+    if not cache_available():
+        return None, None
+    metadata_path = os.path.join(cache_dir, metadata_filename(digest, sensor_name, clean_version))
+    try:
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        pyramid = {}
+        for level in levels:
+            path = os.path.join(cache_dir, pyramid_filename(digest, sensor_name, clean_version, level))
+            pyramid[level] = feather.read_table(path).to_pandas().set_index('Datetime')
+            touch(path)
+    except (IOError, ValueError, pa.ArrowInvalid):
+        return None, None
+    touch(metadata_path)
+    return pyramid, metadata
+
+def store_pyramid(cache_dir, digest, sensor_name, clean_version, pyramid, metadata):
+    '''Writes the levels of a pre-aggregation pyramid, and metadata about the data they summarize
+
+    The metadata is written last, so load_pyramid only finds complete pyramids.
+
+    @param pyramid: dict of level name to DataFrame indexed by bucket start
+    @param metadata: JSON serializable dict
+    @result path of the metadata file, or None if pyarrow is not installed
+    '''
+    if not cache_available():
+        return None
+    os.makedirs(cache_dir, exist_ok=True)
+    for level, df in pyramid.items():
+        path = os.path.join(cache_dir, pyramid_filename(digest, sensor_name, clean_version, level))
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        feather.write_feather(df.rename_axis('Datetime').reset_index(), tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path)
+    path = os.path.join(cache_dir, metadata_filename(digest, sensor_name, clean_version))
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(metadata, f)
+    os.replace(tmp_path, path)
+    return path
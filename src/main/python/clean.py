@@ -1,7 +1,25 @@
 import os
+import json
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from artifact_utils import ARTIFACT_FOLDER, REPORT_ARTIFACTS
+from cache_utils import CACHE_FOLDER, cache_limit_bytes, prune_cache, user_cache_dir
+from clean_utils import create_output_folder
+from colocation_utils import colocate
 from data_file import Data_File
+from incremental_utils import STATE_FOLDER
+from profile_utils import Instrumentation
+from progress_utils import ProgressReporter
+from stat_utils import SummaryStats, write_summary
+
+VALID_EXTENSIONS = ['.csv', '.xlsx', '.xls']
+MANIFEST_NAME = 'manifest.json'
+BATCH_STATISTICS_NAME = 'batch_statistics.csv'
+COLOCATION_PREFIX = 'Colocation'
 
-def process_file(filepath, output_path, averaging_range, header, start_time=None, stop_time=None):
+def process_file(filepath, output_path, averaging_range, header, start_time=None, stop_time=None, chunksize=None, use_cache=True, stage_times=None, trace_memory=False, profile=False, render_workers=1, all_columns=False, incremental=False, summary=None, progress=None, cancel_token=None, frame_cache=None, artifacts=None, reuse_artifacts=False):
     '''Interface to Front End
 
     @param filepath: string path to file input
@@ -9,23 +27,153 @@ def process_file(filepath, output_path, averaging_range, header, start_time=None
     @param start_time: string or python time object for start of range to filter data
     @param stop_time: string or python time object for stop of range to filter data
     @param averaging_range: string or python time object for averaging range
+    @param chunksize: optional number of rows to stream at a time for large csv files
+    @param use_cache: reuse cleaned data from earlier runs on the same file, kept in the per-user cache folder
+        (cache_utils.user_cache_dir) which is pruned to its size limit after every run
+    @param stage_times: optional dict that is filled with the wall time in seconds of each processing stage
+    @param trace_memory: record the tracemalloc peak of every stage in timings.json
+    @param profile: also dump a cProfile of the run to profile.prof in the output folder
+    @param render_workers: number of processes rendering charts, 1 (the default) renders in this process and None starts one per chart
+    @param all_columns: also read the columns the report does not use into cleaned_data.csv
+    @param incremental: keep running aggregates of csv files under output_path so re-running a file
+        that was appended to only reads the new rows (the cleaned data cache is not used then)
+    @param summary: optional SummaryStats that the statistics of this file are merged into
+    @param progress: optional callable invoked with a progress_utils.ProgressEvent after every stage
+    @param cancel_token: optional progress_utils.CancelToken, once it is cancelled the run stops at the next
+        stage, chunk, chart or pdf section with progress_utils.Cancelled and its output folder is removed
+        (pass a chunksize so large files are read in chunks rather than in one uninterruptible read)
+    @param frame_cache: optional frame_cache_utils.FrameCache, for long running callers processing the same files repeatedly
+    @param artifacts: optional list of artifact_utils.ARTIFACT_NAMES to produce instead of the full report
+    @param reuse_artifacts: with use_cache, keep every artifact built in the artifact store of the per-user
+        cache folder, and copy requested artifacts whose inputs did not change since an earlier run from there
+        instead of building them (the pdf is always rebuilt)
 
     @result String filepath for resulting PDF file
     '''
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    data_obj = Data_File(filepath, output_path, averaging_range, header, start_time, stop_time)
+    #an appended file gets a new hash every run, so hashing it for the cache would only cost time
+    cache_root = user_cache_dir() if use_cache else None
+    cache_dir = os.path.join(cache_root, CACHE_FOLDER) if use_cache and not incremental else None
+    state_dir = os.path.join(output_path, STATE_FOLDER) if incremental else None
+    artifact_dir = os.path.join(cache_root, ARTIFACT_FOLDER) if use_cache and reuse_artifacts else None
+    if summary is not None:
+        #the statistics to merge have to be loaded even when general_statistics.csv is reused
+        artifacts = list(artifacts if artifacts is not None else REPORT_ARTIFACTS) + ['summary_stats']
+    instrumentation = Instrumentation(trace_memory, profile)
+    if progress is not None or cancel_token is not None:
+        instrumentation.listeners.append(ProgressReporter(progress, cancel_token))
+    try:
+        data_obj = Data_File(filepath, output_path, averaging_range, header, start_time, stop_time, chunksize, cache_dir, instrumentation, render_workers, all_columns, state_dir, frame_cache, artifacts, artifact_dir)
+    finally:
+        #stops profiling and memory tracing if the pipeline failed part way
+        instrumentation.stop()
+        if cache_root is not None:
+            prune_cache(cache_root, cache_limit_bytes())
+    if stage_times is not None:
+        stage_times.update(data_obj.stage_times)
+    if summary is not None and data_obj.summary is not None:
+        summary.merge(data_obj.summary)
 
     return data_obj.get_output_filepath()
 
-#Below is for testing purposes only
+def list_data_files(paths):
+    #expands directories into the data files they contain, files are passed through as given
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for fn in sorted(os.listdir(path)):
+                if os.path.splitext(fn)[1].lower() in VALID_EXTENSIONS:
+                    files.append(os.path.join(path, fn))
+        else:
+            files.append(path)
+    return files
+
+def process_file_entry(filepath, output_path, averaging_range, header, start_time=None, stop_time=None, chunksize=None, use_cache=True, trace_memory=False, profile=False, render_workers=1, all_columns=False, incremental=False, with_summary=False, frame_cache=None, artifacts=None, reuse_artifacts=False):
+    #runs process_file and turns its result or error into a manifest entry
+    #this runs inside a worker process, so matplotlib and FPDF state never cross files
+    #with_summary adds the file's SummaryStats under 'summary', which has to be removed before writing the entry as JSON
+    entry = {'file': filepath, 'output': None, 'error': None, 'stages': {}}
+    summary = SummaryStats() if with_summary else None
+    start = time.time()
+    try:
+        entry['output'] = process_file(filepath, output_path, averaging_range, header, start_time, stop_time,
+                                       chunksize, use_cache, entry['stages'], trace_memory, profile, render_workers,
+                                       all_columns, incremental, summary, frame_cache=frame_cache, artifacts=artifacts,
+                                       reuse_artifacts=reuse_artifacts)
+        if summary is not None:
+            entry['summary'] = summary
+    except Exception as e:
+        entry['error'] = str(e) # same contract as the GUI, the back end describes its errors
+    entry['seconds'] = round(time.time() - start, 3)
+    return entry
+
+def process_files(paths, output_path, averaging_range, header, start_time=None, stop_time=None, chunksize=None, use_cache=True, max_workers=None, trace_memory=False, profile=False, all_columns=False, incremental=False, artifacts=None, reuse_artifacts=False, render_workers=1):
+    '''Batch interface - processes several files in parallel, one Data_File pipeline per worker process
+
+    @param paths: list of file and/or directory paths, directories are searched for csv/xlsx/xls files
+    @param max_workers: number of worker processes, defaults to the number of cores
+        (the files are already spread over the cores, so by default each file renders its charts in its own worker)
+    @param render_workers: number of processes rendering the charts of each file, see process_file
+    Other parameters are passed to process_file for every file.
+
+    The statistics of all processed files are merged (without gathering their rows) into
+    batch_statistics.csv next to the manifest.
+
+    @result String filepath of the manifest listing the output folder or error of every file
+    '''
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    files = list_data_files(paths)
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(process_file_entry, fp, output_path, averaging_range, header,
+                                   start_time, stop_time, chunksize, use_cache, trace_memory, profile, render_workers, all_columns, incremental, True, None, artifacts, reuse_artifacts) for fp in files]
+        entries = [future.result() for future in futures]
+
+    summary = SummaryStats()
+    for entry in entries:
+        if 'summary' in entry:
+            summary.merge(entry.pop('summary'))
+
+    manifest = {
+        'averaging_range': list(averaging_range),
+        'processed': len([e for e in entries if e['error'] is None]),
+        'failed': len([e for e in entries if e['error'] is not None]),
+        'seconds': round(time.time() - start, 3),
+        'statistics': write_summary(summary, os.path.join(output_path, BATCH_STATISTICS_NAME)),
+        'files': entries,
+    }
+    manifest_path = os.path.join(output_path, MANIFEST_NAME)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest_path
+
+def process_colocation(paths, output_path, averaging_range, start_time=None, stop_time=None):
+    '''Co-location interface - compares sensors that ran side by side instead of reporting on each file
+
+    The files are averaged onto a common grid of the averaging range and every pair of sensors is compared
+    (bias, RMSE, correlation and linear fit) on the measurements both report. The results are written to a
+    Colocation folder in output_path, see colocation_utils.colocate.
+
+    @param paths: list of file and/or directory paths, directories are searched for csv/xlsx/xls files
+    @result String filepath of the Colocation output folder
+    '''
+    files = list_data_files(paths)
+    output_folder = create_output_folder(output_path, COLOCATION_PREFIX)
+    try:
+        colocate(files, averaging_range, output_folder, start_time, stop_time)
+    except BaseException:
+        shutil.rmtree(output_folder, ignore_errors=True)
+        raise
+    return output_folder
+
+#Running this module directly is the same as running the headless command line interface in cli.py
 if __name__ == "__main__":
-    python_folder = os.path.dirname(os.path.abspath(__file__))
-    main_folder = os.path.dirname(python_folder)
-    src_folder = os.path.dirname(main_folder)
-    app_folder = os.path.dirname(src_folder)
-
-    for i in ['Air_beam_7_31_8.22', 'air_egg', 'Purple_air']:
-        filename = os.path.join(app_folder, r'data/' + i + '.csv')
-        process_file(filename, (1, 'Hour'), r'C:\Users\Joel\Documents\GT Courses\Junior Design\Air-Quality-Analysis\data\data_out')
+    import sys
+    from cli import main
+    sys.exit(main())
@@ -1,61 +1,194 @@
+import os
+import time
+from collections import namedtuple
+
 import dateutil.parser
+import numpy as np
 import pandas as pd
 
+from pyramid_utils import HOURLY_LEVEL, LEVEL_NAMES, build_levels, level_stat, pyramid_level
+
+#known timestamp formats for each sensor export, used to skip per-row format inference
+PURPLE_AIR_TIME_FORMAT = '%Y-%m-%d %H:%M:%S UTC'
+AIR_EGG_TIME_FORMAT = '%m/%d/%Y %H:%M'
+
+#uniform column names of each sensor export, in the order the export lists them
+PURPLE_AIR_COLUMNS = ['Datetime', 'entry_id', 'PM1.0', 'PM2.5', 'PM10.0', 'UptimeMins', 'RSSI_dbm', 'Temperature', 'Humidity', 'Pm2.5_CF1']
+AIR_EGG_COLUMNS = ['Datetime', 'Temperature', 'Humidity', 'SO2[ppb]', 'SO2[V]', 'PM1.0', 'PM2.5', 'PM10.0', 'Pressure', 'Latitude', 'Longitude', 'Altitude']
+
+#column names given to AirBeam measurements, keyed by the end of the sensor:model name
+AIR_BEAM_VALUE_NAMES = {
+    'F': 'Temperature',
+    'C': 'Temperature_C',
+    'RH': 'Humidity',
+    'PM1': 'PM1.0',
+    'PM2.5': 'PM2.5',
+    'PM10': 'PM10.0',
+}
+#header names each AirBeam measurement block may use for its columns
+AIR_BEAM_BLOCK_COLUMNS = {
+    'Datetime': ['Timestamp'],
+    'Latitude': ['geo:lat', 'Latitude'],
+    'Longitude': ['geo:long', 'Longitude'],
+    'value': ['Value'],
+}
+
 def clean_purple_air(data_frame):
-    data_frame.columns = ['Datetime', 'entry_id', 'PM1.0', 'PM2.5', 'PM10.0', 'UptimeMins', 'RSSI_dbm', 'Temperature', 'Humidity', 'Pm2.5_CF1']
+    data_frame.columns = PURPLE_AIR_COLUMNS
     return data_frame
 
 def clean_air_egg(data_frame):
-    data_frame.columns = ['Datetime', 'Temperature', 'Humidity', 'SO2[ppb]', 'SO2[V]', 'PM1.0', 'PM2.5', 'PM10.0', 'Pressure', 'Latitude', 'Longitude', 'Altitude']
+    data_frame.columns = AIR_EGG_COLUMNS
     return data_frame
 
+def air_beam_value_name(model, capability):
+    #AirBeam models end in the measured quantity, e.g. AirBeam2-PM2.5, which is more specific than the capability
+    suffix = str(model).split('-')[-1]
+    if suffix in AIR_BEAM_VALUE_NAMES:
+        return AIR_BEAM_VALUE_NAMES[suffix]
+    return str(capability)
+
 def clean_air_beam(data_frame):
-    #TODO: if the values can change on different runs of this sensor, this will need to be changed to be more dynamic
-    #That means using the splits, find the Value name, then add the dataframes to a list, then iterate over that list to merge
-    beam = data_frame
-    splits = list(beam[beam['sensor:model'] == 'sensor:model'].index)
-    df1 = beam.iloc[0:splits[0]]
-    df2 = beam.iloc[splits[0]:splits[1]]
-    df3 = beam.iloc[splits[1]:splits[2]]
-    df4 = beam.iloc[splits[2]:splits[3]]
-    df1.columns = ['Datetime', 'Latitude', 'Longitude', 'Temperature']
-    df1 = df1.drop([0,1])
-    df2.columns = ['Datetime', 'Latitude', 'Longitude', 'Humidity']
-    df2 = df2.drop(df2.index[0:3])
-    df3.columns = ['Datetime', 'Latitude', 'Longitude', 'PM2.5']
-    df3 = df3.drop(df3.index[0:3])
-    df4.columns = ['Datetime', 'Latitude', 'Longitude', 'PM10.0']
-    df4 = df4.drop(df4.index[0:3])
-    beam = pd.merge(df1, df2, how='outer', on=['Datetime', 'Latitude', 'Longitude'])
-    beam = pd.merge(beam, df3, how='outer', on=['Datetime', 'Latitude', 'Longitude'])
-    beam = pd.merge(beam, df4, how='outer', on=['Datetime', 'Latitude', 'Longitude'])
-    data_frame = beam
-    return data_frame
+    '''Splits an AirBeam session export into its measurement blocks and aligns them on time
+
+    The export repeats a sensor:model header row before every measurement block. Each block has
+    a sensor description row, a Timestamp/geo:lat/geo:long/Value header row and then its samples.
+    Any number of blocks is supported; their values are stacked into one long frame and pivoted
+    once on the parsed timestamp instead of merged pairwise.
+    '''
+    first_col = data_frame.iloc[:, 0]
+    splits = np.flatnonzero((first_col == 'sensor:model').values)
+    #the first block's sensor:model row is the file header, so its description is row 0
+    info_rows = np.r_[0, splits + 1]
+    ends = np.r_[splits, len(data_frame.index)]
+
+    blocks = []
+    names = []
+    for info, end in zip(info_rows, ends):
+        model = data_frame.iat[info, 0]
+        capability = data_frame.iat[info, 2]
+        name = air_beam_value_name(model, capability)
+        header = [str(h) for h in data_frame.iloc[info + 1]]
+        block = data_frame.iloc[info + 2:end]
+        positions = {}
+        for col, aliases in AIR_BEAM_BLOCK_COLUMNS.items():
+            found = [header.index(a) for a in aliases if a in header]
+            if not found:
+                raise ValueError('AirBeam block for ' + name + ' has no ' + col + ' column')
+            positions[col] = found[0]
+        blocks.append(pd.DataFrame({
+            'Datetime': block.iloc[:, positions['Datetime']].values,
+            'Latitude': block.iloc[:, positions['Latitude']].values,
+            'Longitude': block.iloc[:, positions['Longitude']].values,
+            'variable': name,
+            'value': block.iloc[:, positions['value']].values,
+        }))
+        if name not in names:
+            names.append(name)
+
+    beam = pd.concat(blocks, ignore_index=True)
+    beam = beam[beam['Datetime'].notnull()]
+    beam['Datetime'] = parse_datetime_column(beam['Datetime'])
+    for col in ['Latitude', 'Longitude', 'value']:
+        beam[col] = pd.to_numeric(beam[col], errors='coerce')
+    values = beam.groupby(['Datetime', 'variable'])['value'].mean().unstack()
+    values = values.reindex(columns=names)
+    values.columns.name = None
+    coords = beam.groupby('Datetime')[['Latitude', 'Longitude']].first()
+    return coords.join(values).reset_index()
+
+def create_output_folder(output_path, prefix):
+    '''Creates a new output folder named prefix followed by the current time
+
+    Runs with the same prefix started within the same second (e.g. a batch) get numbered folders.
+
+    @result path of the folder
+    '''
+    folder_name = prefix + time.strftime("%Y%m%d-%H%M%S")
+    output_folder = os.path.join(output_path, folder_name)
+    suffix = 0
+    while True:
+        try:
+            os.makedirs(output_folder)
+            return output_folder
+        except FileExistsError:
+            suffix += 1
+            output_folder = os.path.join(output_path, folder_name + '_' + str(suffix))
 
-def filter_on_time(df, start_time=None, stop_time=None):
-    #currently broken due to timezone naiive and aware datetime objects
+def to_py_datetime(t):
+    #the GUI passes QDateTime objects, headless callers pass datetimes or timestamp strings
+    if hasattr(t, 'toPyDateTime'):
+        return t.toPyDateTime()
+    return pd.Timestamp(t).to_pydatetime()
+
+def time_window(times, start_time, stop_time):
+    '''Binary searches a sorted datetime column for the rows between two times (both inclusive)
+
+    @param times: Series of datetime64 values in ascending order, NaT sorted last
+    @result tuple of (first row position, position after the last row)
+    '''
+    values = times.values
+    first = np.searchsorted(values, pd.Timestamp(to_py_datetime(start_time)).to_datetime64(), side='left')
+    end = np.searchsorted(values, pd.Timestamp(to_py_datetime(stop_time)).to_datetime64(), side='right')
+    return first, max(first, end)
+
+def filter_on_time(df, start_time=None, stop_time=None, allow_empty=False):
+    '''Selects the rows between start_time and stop_time (both inclusive)
+
+    df must be sorted by Datetime, as clean_frame leaves it, so the window is found by binary search
+    and returned as a slice of df instead of a copy of the matching rows.
+    allow_empty is used when filtering one chunk of a larger file.
+    '''
     if start_time is not None and stop_time is not None:
-        #filter on both
-        after_start = df['Datetime'] >= start_time.toPyDateTime()
-        before_end = df['Datetime'] <= stop_time.toPyDateTime()
-        if len(df[after_start & before_end].index) == 0:
+        first, end = time_window(df['Datetime'], start_time, stop_time)
+        if not allow_empty and first == end:
             raise ValueError("Start and Stop Times given are outside range of file.")
-        return df[after_start & before_end].reset_index(drop=True)
+        window = df.iloc[first:end]
+        #number the rows from 0 like a new frame, the values themselves are not copied
+        window.index = pd.RangeIndex(len(window.index))
+        return window
     return df
 
+#utc offset or zone suffix of a timestamp string, e.g. 'z', '+05:30' or ' UTC'
+UTC_OFFSET = r'\s*(?:[zZ]|UTC|GMT|[+-]\d{2}:?\d{2})$'
+
 def parse_time_string(s):
     d = dateutil.parser.parse(s)
     return d
 
-def resample(df, averaging_range):
+def parse_datetime_column(col, time_format=None):
+    '''Vectorized replacement for applying parse_time_string to every row
+
+    @param col: pandas Series of timestamp strings
+    @param time_format: strftime format of the strings, or None to let pandas infer it
+    @result Series of timezone naive datetime64 values (wall time is kept, tzinfo is dropped)
+    '''
+    if time_format is not None:
+        try:
+            return pd.to_datetime(col, format=time_format)
+        except ValueError:
+            #export does not match the expected layout, fall through to inference
+            pass
+    parsed = pd.to_datetime(col)
+    if parsed.dtype == object:
+        #mixed utc offsets, drop them from the strings so every row keeps its own wall time
+        parsed = pd.to_datetime(col.str.replace(UTC_OFFSET, '', regex=True))
+    if getattr(parsed.dt, 'tz', None) is not None:
+        parsed = parsed.dt.tz_localize(None)
+    return parsed
+
+def get_rate(averaging_range):
+    '''Translates an averaging range tuple into a pandas offset alias
+
+    @param averaging_range: tuple containing integer then string indicating time to average values over
+    @result tuple of (offset alias string, approximate length of the range in seconds)
+    '''
     rate_num = averaging_range[0]
     rate_str = averaging_range[1]
 
     if rate_num == 0:
         raise ValueError("Averaging Range cannot be 0!")
 
-    rate_in_seconds = (df['Datetime'][1] - df['Datetime'][0]).total_seconds()
-
     if rate_str == 'Minutes':
         rate_comp = rate_num*60
         rate = str(rate_num) + 'T'
@@ -76,21 +209,239 @@ def resample(df, averaging_range):
         rate = str(rate_num) + 'Y'
     else:
         raise ValueError("Averaging Duration must be measured in Minutes, Hours, Days, Weeks, Months, or Years.")
+    return rate, rate_comp
+
+#an interval this many times the median interval is a gap in the data, not jitter
+GAP_FACTOR = 3
+#what resampling does at the requested averaging range, decided from the sampling profile
+RESAMPLE_NONE = 'none'
+RESAMPLE_DOWN = 'downsample'
+RESAMPLE_UP = 'upsample'
+
+SamplingProfile = namedtuple('SamplingProfile', ['samples', 'start', 'end', 'median_interval', 'mode_interval',
+                                                 'mean_interval', 'jitter', 'min_interval', 'max_interval',
+                                                 'gaps', 'gap_seconds'])
+
+class SamplingProfiler():
+    '''Builds the SamplingProfile of a time series from a histogram of the intervals between samples,
+    chunk by chunk, so streamed and incrementally read files get the same profile as whole frames
+    @attribute samples: number of timestamps added
+    @function add: adds a sorted Series of timestamps that follows the ones added before
+    @function profile: returns the SamplingProfile of everything added, intervals are in seconds
+    '''
+    def __init__(self):
+        self.samples = 0
+        self.start = None
+        self.last = None
+        self.histogram = pd.Series(dtype='int64')
 
-    if rate_in_seconds == rate_comp:
+    def add(self, times):
+        values = times.dropna().values
+        if len(values) == 0:
+            return
+        self.samples += len(values)
+        if self.last is None:
+            self.start = values[0]
+        else:
+            #the interval between the last sample of the previous chunk and the first of this one
+            values = np.r_[self.last, values]
+        self.last = values[-1]
+        intervals = np.diff(values).astype('timedelta64[ms]').astype(np.int64)
+        #chunks of an unsorted file can overlap, intervals going back in time are not sample intervals
+        keys, counts = np.unique(intervals[intervals >= 0], return_counts=True)
+        self.histogram = self.histogram.add(pd.Series(counts, index=keys), fill_value=0)
+
+    def profile(self):
+        histogram = self.histogram[self.histogram > 0].sort_index()
+        start, end = pd.Timestamp(self.start), pd.Timestamp(self.last)
+        if len(histogram) == 0:
+            return SamplingProfile(self.samples, start, end, *([np.nan] * 6 + [0, 0.0]))
+        seconds = histogram.index.values / 1000.0
+        counts = histogram.values.astype(float)
+        cumulative = np.cumsum(counts)
+        total = cumulative[-1]
+        #average of the two middle intervals, like np.median
+        median = (seconds[np.searchsorted(cumulative, (total + 1) // 2)] + seconds[np.searchsorted(cumulative, total // 2 + 1)]) / 2
+        gap = seconds > GAP_FACTOR * median
+        regular = ~gap
+        mean_regular = np.average(seconds[regular], weights=counts[regular])
+        jitter = np.sqrt(np.average((seconds[regular] - mean_regular) ** 2, weights=counts[regular]))
+        return SamplingProfile(self.samples, start, end, median, seconds[np.argmax(counts)],
+                               np.average(seconds, weights=counts), jitter, seconds[0], seconds[-1],
+                               int(counts[gap].sum()), float((seconds[gap] * counts[gap]).sum()))
+
+def profile_to_dict(profile):
+    #JSON serializable form of a SamplingProfile
+    values = profile._asdict()
+    values['start'] = None if pd.isnull(profile.start) else str(profile.start)
+    values['end'] = None if pd.isnull(profile.end) else str(profile.end)
+    return values
+
+def profile_from_dict(values):
+    values = dict(values)
+    values['start'] = pd.Timestamp(values['start'])
+    values['end'] = pd.Timestamp(values['end'])
+    return SamplingProfile(**values)
+
+def sampling_profile(times):
+    '''Profiles the sampling of a sorted datetime column with one vectorized diff
+
+    @param times: Series of datetime64 values in ascending order
+    @result SamplingProfile - sample count, first and last time, median, most common (mode) and mean interval,
+        jitter (std of the intervals that are not gaps), shortest and longest interval, and the number and
+        total length of gaps (intervals over GAP_FACTOR times the median), all in seconds
+    '''
+    profiler = SamplingProfiler()
+    profiler.add(times)
+    return profiler.profile()
+
+def resample_plan(profile, rate_comp):
+    #averaging at the native rate changes nothing, averaging faster than it would invent buckets
+    if profile.samples < 2 or np.isnan(profile.median_interval) or profile.median_interval == rate_comp:
+        return RESAMPLE_NONE
+    if rate_comp < profile.median_interval:
+        return RESAMPLE_UP
+    return RESAMPLE_DOWN
+
+def resample(df, averaging_range, profile=None):
+    '''Averages the cleaned data over the averaging range
+
+    Whether that is a no-op or an upsample is decided from the sampling profile before aggregating,
+    in both cases df is returned unchanged.
+
+    @param profile: SamplingProfile of df['Datetime'], computed if not given
+    '''
+    rate_comp = get_rate(averaging_range)[1]
+    if profile is None:
+        profile = sampling_profile(df['Datetime'])
+    plan = resample_plan(profile, rate_comp)
+
+    if plan == RESAMPLE_NONE:
         print("Cannot resample file at the same rate it is already sampled!!")
         return df
+    if plan == RESAMPLE_UP:
+        print("Averaging duration rate is faster than original sample rate. Data Resampling Ignored.")
+        return df
 
     try:
-        df_resampled = df.resample(rate, on='Datetime').mean().reset_index()
-        df_resampled = df_resampled.dropna(thresh=2).reset_index(drop=True)
-        res = df_resampled
+        #the same sums a streamed run makes, so reading a file whole or in chunks gives the same averages
+        accumulator = ResampleAccumulator(averaging_range)
+        accumulator.add(df)
+        res = accumulator.means()
     except MemoryError:
         print('Memory Error due to high resample rate!! Data Resampling Ignored!')
         res = df
-    except ValueError:
-        print("ValueError at line 82 in clean_utils.py")
-    if len(df_resampled) > len(df):
-        print("Averaging duration rate is faster than original sample rate. Data Resampling Ignored.")
-        res = df
     return res
+
+def rollup(sums, counts, rate, origin=None):
+    '''Averages per bucket sums and counts over a coarser rate, the same as resample(rate).mean() of the rows
+
+    @param sums: DataFrame of value sums indexed by bucket start, no bucket may straddle two buckets of rate
+        (e.g. whole minutes for a rate of 5 minutes, whole days for weeks or months)
+    @param counts: DataFrame of the number of values in each bucket, laid out like sums
+    @param rate: pandas offset alias from get_rate
+    @param origin: Timestamp fixed length buckets are counted from, midnight of the first day if None
+    @result DataFrame with a Datetime column and the mean of every column, empty buckets dropped
+    '''
+    sums = sums.sort_index()
+    counts = counts.sort_index()
+    offset = pd.tseries.frequencies.to_offset(rate)
+    if isinstance(offset, pd.tseries.offsets.Tick):
+        if origin is None:
+            #resample anchors fixed length buckets at midnight of the first day
+            origin = sums.index.min().normalize()
+        step = pd.Timedelta(offset)
+        labels = origin + ((sums.index - origin) // step) * step
+        sums = sums.groupby(labels).sum()
+        counts = counts.groupby(labels).sum()
+    else:
+        sums = sums.resample(rate).sum()
+        counts = counts.resample(rate).sum()
+    means = sums / counts.where(counts > 0)
+    means.index.name = 'Datetime'
+    return means.reset_index().dropna(thresh=2).reset_index(drop=True)
+
+class ResampleAccumulator():
+    '''Streaming counterpart of resample - folds cleaned chunks into running per-bucket sums and counts
+    so memory tracks the number of output buckets instead of the number of input rows
+    Rows are summed per pyramid level (see pyramid_utils.build_levels) and the rows of the last day seen
+    are held back until a later chunk or result(), so every bucket of a file in time order is summed from
+    all of its rows at once - the result has the same bits however the file was chunked.
+    @param averaging_range: tuple containing integer then string indicating time to average values over
+    @attribute n_rows: number of rows added so far
+    @attribute min_time: earliest time added
+    @attribute max_time: latest time added
+    @attribute profiler: SamplingProfiler of the added rows, it decides whether resampling applies
+    @function add: folds one cleaned chunk into the running sums and counts
+    @function totals: returns the hourly (sums, counts) of every row added, like stat_utils.hourly_totals
+    @function result: returns the same frame resample would have returned, or None if resample
+        would have returned the input unchanged (the caller then reports the cleaned rows themselves)
+    '''
+    def __init__(self, averaging_range):
+        self.rate, self.rate_comp = get_rate(averaging_range)
+        #the coarsest level whose buckets fit whole into the averaging buckets, hourly totals are kept as well
+        self.level = pyramid_level(self.rate)
+        self.last_level = max(self.level, HOURLY_LEVEL, key=LEVEL_NAMES.index)
+        self.min_time = None
+        self.max_time = None
+        self.profiler = SamplingProfiler()
+        self.columns = []
+        self.sums = {}
+        self.counts = {}
+        self.pending = None
+        self.n_rows = 0
+
+    def add(self, chunk):
+        if len(chunk.index) == 0:
+            return
+        self.n_rows += len(chunk.index)
+        times = chunk['Datetime']
+        self.profiler.add(times)
+        chunk_min, chunk_max = times.min(), times.max()
+        if self.min_time is None or chunk_min < self.min_time:
+            self.min_time = chunk_min
+        if self.max_time is None or chunk_max > self.max_time:
+            self.max_time = chunk_max
+        for col in chunk.columns:
+            if col != 'Datetime' and col not in self.columns:
+                self.columns.append(col)
+
+        rows = chunk if self.pending is None else pd.concat([self.pending, chunk], ignore_index=True)
+        #a day that is still being read may continue in the next chunk
+        done = rows['Datetime'] < chunk_max.floor('D')
+        self.pending = rows[~done]
+        self.sums, self.counts = self.fold(rows[done])
+
+    def fold(self, rows):
+        #adds the level sums and counts of rows to the running ones, returning new dicts of level name to frame
+        sums, counts = dict(self.sums), dict(self.counts)
+        if len(rows.index) == 0:
+            return sums, counts
+        levels = build_levels(rows, ['sum', 'count'], self.last_level)
+        for name in set([self.level, HOURLY_LEVEL]):
+            level_sums, level_counts = level_stat(levels[name], 'sum'), level_stat(levels[name], 'count')
+            if name in sums:
+                level_sums = sums[name].add(level_sums, fill_value=0)
+                level_counts = counts[name].add(level_counts, fill_value=0)
+            sums[name], counts[name] = level_sums, level_counts
+        return sums, counts
+
+    def totals(self):
+        sums, counts = self.fold(self.pending) if self.pending is not None else (self.sums, self.counts)
+        return sums.get(HOURLY_LEVEL), counts.get(HOURLY_LEVEL)
+
+    def means(self, origin=None):
+        #averages the buckets into the averaging range, whatever the sampling profile says, see rollup for origin
+        sums, counts = self.fold(self.pending) if self.pending is not None else (self.sums, self.counts)
+        means = rollup(sums[self.level], counts[self.level], self.rate, origin)
+        return means[['Datetime'] + [col for col in self.columns if col in means.columns]]
+
+    def result(self):
+        plan = resample_plan(self.profiler.profile(), self.rate_comp)
+        if plan == RESAMPLE_NONE:
+            print("Cannot resample file at the same rate it is already sampled!!")
+            return None
+        if plan == RESAMPLE_UP:
+            print("Averaging duration rate is faster than original sample rate. Data Resampling Ignored.")
+            return None
+        return self.means()
@@ -0,0 +1,138 @@
+'''Headless command line interface to the data processor
+
+Runs process_file without PyQt5 or fbs_runtime so it can be used on servers, e.g.
+
+    python cli.py data/Purple_air.csv -n 1 -u Hours -o data_out --json -
+
+prints a JSON summary with the output folder, error and per-stage wall times of every file.
+'''
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+from artifact_utils import ARTIFACT_NAMES
+from clean import (list_data_files, process_colocation, process_file_entry,
+                   process_files)
+from clean_utils import to_py_datetime
+
+AD_UNITS = ["Minutes", "Hours", "Days", "Weeks", "Months", "Years"]
+DEFAULT_HEADER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'resources', 'base', 'ATSDR-logo.png')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Automated air quality analysis for AirBeam, PurpleAir and AirEgg data files.')
+    parser.add_argument('files', nargs='+', help='data files or directories of data files to process')
+    parser.add_argument('-n', '--number', type=int, required=True, help='averaging duration, as a whole number of units')
+    parser.add_argument('-u', '--unit', choices=AD_UNITS, required=True, help='averaging duration unit')
+    parser.add_argument('-o', '--output', default='data_out', help='output directory (default: ./data_out)')
+    parser.add_argument('--start', help='start of the time range to analyse, e.g. "2018-08-10 00:00"')
+    parser.add_argument('--stop', help='end of the time range to analyse')
+    parser.add_argument('--header', default=DEFAULT_HEADER, help='header image for the PDF report')
+    parser.add_argument('--chunksize', type=int, help='stream csv files in chunks of this many rows')
+    parser.add_argument('--all-columns', action='store_true', help='keep columns the report does not use (e.g. PurpleAir entry_id) in cleaned_data.csv')
+    parser.add_argument('--colocate', action='store_true', help='compare the files as co-located sensors (bias, RMSE, correlation) instead of reporting on each')
+    parser.add_argument('--incremental', action='store_true', help='keep running aggregates of csv files in the output directory and only read rows appended since the last run')
+    parser.add_argument('--artifacts', help='comma separated outputs to produce instead of the full report: ' + ', '.join(ARTIFACT_NAMES))
+    parser.add_argument('--reuse-artifacts', action='store_true', help='copy outputs whose inputs did not change since an earlier run from the disk cache instead of rebuilding them (the PDF is always rebuilt)')
+    parser.add_argument('--no-cache', action='store_true', help='always re-parse input files and rebuild every output, without reading or writing the disk cache')
+    parser.add_argument('--trace-memory', action='store_true', help='record the tracemalloc peak of every stage in timings.json')
+    parser.add_argument('--profile', action='store_true', help='dump a cProfile of each run to profile.prof in its output folder')
+    parser.add_argument('--workers', type=int, default=1, help='number of files to process in parallel')
+    parser.add_argument('--render-workers', type=int, help='number of processes rendering the charts of each file (default: one per chart, or 1 with --workers)')
+    parser.add_argument('--json', metavar='PATH', help='write a JSON summary to PATH ("-" for stdout)')
+    args = parser.parse_args(argv)
+
+    if args.number <= 0:
+        parser.error('averaging duration must be a positive whole number')
+    if (args.start is None) != (args.stop is None):
+        parser.error('--start and --stop must be given together')
+    if args.start is not None:
+        try:
+            args.start = to_py_datetime(args.start)
+            args.stop = to_py_datetime(args.stop)
+        except ValueError as e:
+            parser.error('invalid time range: ' + str(e))
+        if args.start > args.stop:
+            parser.error('--stop cannot be before --start')
+    if args.render_workers is not None and args.render_workers <= 0:
+        parser.error('--render-workers must be a positive whole number')
+    if args.reuse_artifacts and args.no_cache:
+        parser.error('--reuse-artifacts keeps the outputs in the disk cache, it cannot be used with --no-cache')
+    if args.artifacts is not None:
+        args.artifacts = [name.strip() for name in args.artifacts.split(',') if name.strip()]
+        unknown = [name for name in args.artifacts if name not in ARTIFACT_NAMES]
+        if unknown or not args.artifacts:
+            parser.error('--artifacts must be a list of: ' + ', '.join(ARTIFACT_NAMES))
+    return args
+
+def run_files(args, averaging_range, use_cache):
+    #processes every input file and returns their manifest entries
+    if args.workers > 1:
+        manifest_path = process_files(args.files, args.output, averaging_range, args.header, args.start, args.stop,
+                                      args.chunksize, use_cache, args.workers, args.trace_memory, args.profile,
+                                      args.all_columns, args.incremental, args.artifacts, args.reuse_artifacts,
+                                      args.render_workers or 1)
+        with open(manifest_path) as f:
+            entries = json.load(f)['files']
+    else:
+        if not os.path.exists(args.output):
+            os.makedirs(args.output)
+        entries = [process_file_entry(fp, args.output, averaging_range, args.header, args.start, args.stop,
+                                      args.chunksize, use_cache, args.trace_memory, args.profile,
+                                      args.render_workers, args.all_columns, args.incremental, artifacts=args.artifacts,
+                                      reuse_artifacts=args.reuse_artifacts)
+                   for fp in list_data_files(args.files)]
+    return entries
+
+def run_colocation(args, averaging_range):
+    #one entry for the whole comparison, in the same shape as a file entry
+    entry = {'file': ', '.join(args.files), 'output': None, 'error': None}
+    start = time.time()
+    try:
+        entry['output'] = process_colocation(args.files, args.output, averaging_range, args.start, args.stop)
+    except Exception as e:
+        entry['error'] = str(e)
+    entry['seconds'] = round(time.time() - start, 3)
+    return [entry]
+
+def main(argv=None):
+    args = parse_args(argv)
+    averaging_range = (args.number, args.unit)
+    use_cache = not args.no_cache
+
+    start = time.time()
+    #the processing code reports some conditions with print, keep stdout for the JSON summary
+    with contextlib.redirect_stdout(sys.stderr if args.json == '-' else sys.stdout):
+        if args.colocate:
+            entries = run_colocation(args, averaging_range)
+        else:
+            entries = run_files(args, averaging_range, use_cache)
+
+    summary = {
+        'averaging_range': list(averaging_range),
+        'start': None if args.start is None else str(args.start),
+        'stop': None if args.stop is None else str(args.stop),
+        'processed': len([e for e in entries if e['error'] is None]),
+        'failed': len([e for e in entries if e['error'] is not None]),
+        'seconds': round(time.time() - start, 3),
+        'files': entries,
+    }
+    if args.json == '-':
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    elif args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    for entry in entries:
+        if entry['error'] is None:
+            print('{}: {}'.format(entry['file'], entry['output']), file=sys.stderr)
+        else:
+            print('{}: ERROR {}'.format(entry['file'], entry['error']), file=sys.stderr)
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from clean_utils import ResampleAccumulator, filter_on_time, parse_datetime_column, to_py_datetime
+from sensors import detect_sheet
+
+#measurements every sensor reports under the same uniform name, compared between co-located sensors
+COLOCATION_COLUMNS = ['PM1.0', 'PM2.5', 'PM10.0', 'Temperature', 'Humidity']
+COLOCATION_STATS_NAME = 'colocation_stats.csv'
+ALIGNED_DATA_NAME = 'aligned_data.csv'
+STATS_COLUMNS = ['Reference', 'Sensor', 'Measurement', 'Pairs', 'Bias', 'RMSE', 'Correlation', 'Slope', 'Intercept']
+#rows read at a time, so only one chunk of one file and the grids are in memory at once
+GRID_CHUNKSIZE = 100000
+#fixed length buckets of every sensor are counted from here, so their edges match whatever day each file starts on
+GRID_ORIGIN = pd.Timestamp('1970-01-01')
+
+def read_chunks(filepath, start_time=None, stop_time=None, chunksize=GRID_CHUNKSIZE):
+    '''Reads and cleans one sensor file the way Data_File does, a chunk at a time when its format streams
+
+    @param chunksize: rows read at a time from csv files and xlsx sheets, other files are read whole
+    @result iterator of cleaned DataFrames of Datetime and the COLOCATION_COLUMNS the sensor reports, each
+        sorted by Datetime and filtered to the time range
+    '''
+    sensor_format, sheet = detect_sheet(filepath)
+    data_frame = None
+    if start_time is not None and stop_time is not None and sensor_format.can_read_window(filepath):
+        data_frame = sensor_format.read_window(filepath, to_py_datetime(start_time), to_py_datetime(stop_time))
+    if data_frame is not None:
+        chunks = [data_frame]
+    elif sensor_format.can_stream(filepath):
+        chunks = sensor_format.read(filepath, chunksize, sheet=sheet)
+    else:
+        chunks = [sensor_format.read(filepath, sheet=sheet)]
+    for chunk in chunks:
+        chunk = sensor_format.clean(chunk)
+        columns = [col for col in COLOCATION_COLUMNS if col in chunk.columns]
+        chunk = chunk[['Datetime'] + columns].copy()
+        chunk['Datetime'] = parse_datetime_column(chunk['Datetime'], sensor_format.time_format)
+        #numbers stored as text (formats read without a schema) have to be numeric to be averaged
+        object_columns = [col for col in columns if chunk[col].dtype == object]
+        if object_columns:
+            chunk[object_columns] = chunk[object_columns].apply(pd.to_numeric, errors='coerce')
+        chunk = chunk.sort_values(by='Datetime').reset_index(drop=True)
+        yield filter_on_time(chunk, start_time, stop_time, allow_empty=True)
+
+def to_grid(chunks, averaging_range, label):
+    '''Averages the compared measurements of one sensor into buckets of the averaging range
+
+    The chunks are folded into the running bucket sums of a ResampleAccumulator, so the grid is the same
+    as resampling the whole file however it was chunked. Buckets are anchored at GRID_ORIGIN rather than
+    the first day of the file, so the grids of all sensors share their bucket labels.
+
+    @param chunks: iterable of cleaned DataFrames from read_chunks
+    @param averaging_range: tuple containing integer then string, the spacing of the grid
+    @param label: name of the sensor, the columns are returned as 'label:measurement'
+    @result DataFrame with a sorted Datetime column of bucket labels, empty buckets dropped
+    '''
+    accumulator = ResampleAccumulator(averaging_range)
+    for chunk in chunks:
+        accumulator.add(chunk)
+    if accumulator.n_rows == 0:
+        raise ValueError("Start and Stop Times given are outside range of file.")
+    grid = accumulator.means(GRID_ORIGIN)
+    return grid.set_index('Datetime').add_prefix(label + ':').reset_index()
+
+def align(grids):
+    '''Joins the gridded sensors on their bucket times
+
+    The grids share one anchored set of buckets (see to_grid), so buckets are joined exactly and each
+    bucket of a sensor is paired at most once.
+
+    @param grids: list of DataFrames returned by to_grid
+    @result DataFrame of Datetime and every 'label:measurement' column, rows with fewer than two sensors dropped
+    '''
+    aligned = grids[0]
+    for grid in grids[1:]:
+        aligned = aligned.merge(grid, on='Datetime', how='outer', sort=True)
+    present = np.zeros(len(aligned.index), dtype='int64')
+    for grid in grids:
+        present += aligned[grid.columns.drop('Datetime')].notna().any(axis=1).values
+    return aligned[present >= 2].reset_index(drop=True)
+
+def pair_stats(reference, sensor):
+    '''Compares the paired readings of two sensors, the first taken as the reference
+
+    @param reference: Series of the reference sensor's measurement on the aligned grid
+    @param sensor: Series of the other sensor's measurement on the same grid
+    @result dict of Pairs, Bias (mean of sensor - reference), RMSE, Correlation (Pearson), and the
+        Slope and Intercept of the least squares fit sensor = Slope * reference + Intercept
+    '''
+    mask = (reference.notna() & sensor.notna()).values
+    x = reference.values[mask].astype('float64')
+    y = sensor.values[mask].astype('float64')
+    stats = {'Pairs': len(x), 'Bias': np.nan, 'RMSE': np.nan, 'Correlation': np.nan, 'Slope': np.nan, 'Intercept': np.nan}
+    if len(x) == 0:
+        return stats
+    diff = y - x
+    stats['Bias'] = diff.mean()
+    stats['RMSE'] = np.sqrt(np.mean(diff * diff))
+    dx = x - x.mean()
+    dy = y - y.mean()
+    sxx = np.dot(dx, dx)
+    syy = np.dot(dy, dy)
+    if sxx > 0:
+        stats['Slope'] = np.dot(dx, dy) / sxx
+        stats['Intercept'] = y.mean() - stats['Slope'] * x.mean()
+        if syy > 0:
+            stats['Correlation'] = np.dot(dx, dy) / np.sqrt(sxx * syy)
+    return stats
+
+def colocation_stats(aligned, labels):
+    '''Compares every pair of sensors on every measurement both of them report
+
+    @param labels: sensor labels in input order, the earlier sensor of each pair is the reference
+    @result DataFrame with STATS_COLUMNS
+    '''
+    rows = []
+    for i, reference in enumerate(labels):
+        for sensor in labels[i + 1:]:
+            for col in COLOCATION_COLUMNS:
+                ref_col, sensor_col = reference + ':' + col, sensor + ':' + col
+                if ref_col not in aligned.columns or sensor_col not in aligned.columns:
+                    continue
+                row = {'Reference': reference, 'Sensor': sensor, 'Measurement': col}
+                row.update(pair_stats(aligned[ref_col], aligned[sensor_col]))
+                rows.append(row)
+    return pd.DataFrame(rows, columns=STATS_COLUMNS)
+
+def sensor_labels(filepaths):
+    #file names without extension, numbered when two files share a name
+    labels = []
+    for filepath in filepaths:
+        label = os.path.splitext(os.path.basename(filepath))[0]
+        candidate, n = label, 1
+        while candidate in labels:
+            n += 1
+            candidate = '{}_{}'.format(label, n)
+        labels.append(candidate)
+    return labels
+
+def colocate(filepaths, averaging_range, output_folder, start_time=None, stop_time=None, chunksize=GRID_CHUNKSIZE):
+    '''Aligns co-located sensor files onto a common time grid and compares them
+
+    Files are read one at a time, in chunks of chunksize rows when their format streams, and reduced to
+    their grid as they are read, so only one chunk of rows is in memory at once.
+
+    @param filepaths: data files of sensors that ran side by side, the first is the reference of its pairs
+    @param averaging_range: tuple containing integer then string, the spacing of the common grid
+    @param output_folder: folder the aligned data and the statistics are written to
+    @param chunksize: rows read at a time from csv files and xlsx sheets
+    @result dict with the paths of colocation_stats.csv and aligned_data.csv and the sensor label of every file
+    '''
+    if len(filepaths) < 2:
+        raise ValueError("Co-location needs at least two data files.")
+    labels = sensor_labels(filepaths)
+    grids = []
+    for filepath, label in zip(filepaths, labels):
+        grids.append(to_grid(read_chunks(filepath, start_time, stop_time, chunksize), averaging_range, label))
+    aligned = align(grids)
+    if len(aligned.index) == 0:
+        raise ValueError("The data files do not overlap in time.")
+
+    stats_path = os.path.join(output_folder, COLOCATION_STATS_NAME)
+    colocation_stats(aligned, labels).round(4).to_csv(stats_path, index=False)
+    aligned_path = os.path.join(output_folder, ALIGNED_DATA_NAME)
+    aligned.to_csv(aligned_path, index=False)
+    return {'statistics': stats_path, 'aligned_data': aligned_path, 'sensors': dict(zip(filepaths, labels))}
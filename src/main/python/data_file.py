@@ -1,51 +1,250 @@
+import io
 import os
-import time
+import json
+import pickle
+import shutil
 import datetime
-from enum import Enum
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import pandas as pd
 
-from clean_utils import (clean_air_beam, clean_air_egg, clean_purple_air,
-                         filter_on_time, parse_time_string, resample)
-from stat_utils import basic_stats, above_threshold_stats
-from vis_utils import boxplot, humidity_graph, threshold_PM25, threshold_PM10
+from clean_utils import (RESAMPLE_DOWN, ResampleAccumulator, create_output_folder, filter_on_time,
+                         get_rate, parse_datetime_column, profile_from_dict,
+                         profile_to_dict, resample, resample_plan, rollup,
+                         sampling_profile, to_py_datetime)
+from cache_utils import (cache_available, file_hash, load_clean_cache,
+                         load_pyramid, store_clean_cache, store_pyramid)
+from pyramid_utils import HOURLY_LEVEL, build_pyramid, level_stat, pyramid_level
+from incremental_utils import (STATE_VERSION, header_end, load_state,
+                               read_tail, rows_path, store_state)
+from artifact_utils import (REPORT_ARTIFACTS, ArtifactStore, artifact_keys, digest,
+                            get_artifact, plan_artifacts)
+from profile_utils import Instrumentation
+from frame_cache_utils import frame_bytes
+from stat_utils import (BoxStats, SummaryStats, basic_stats, above_threshold_stats, hourly_totals,
+                        read_threshold_table, sample_counts)
+from sensors import detect_sheet, match_header
+from vis_utils import BOXPLOT_COLUMNS, CHARTS, ChartReducer, render_charts
 from generate_pdf import create_pdf
 
+#bump whenever clean_frame changes its output so stale cache entries are ignored
+CLEAN_VERSION = 4
+
+class RowReport():
+    '''Streaming report of the cleaned rows themselves, for files whose resampling is a no-op - the rows are
+    appended to a cleaned_data.csv as they come, and only the statistics, the rows the charts draw and the
+    boxplot tails are kept, so an incremental run can pickle it and carry on with the appended rows
+    @param csv_path: file the rows are appended to, None to not write them
+    @param start: earliest time of the rows, see ChartReducer
+    @param end: latest time of the rows
+    @param summarize: also keep the SummaryStats of the rows
+    @attribute n_rows: rows added so far
+    @attribute counts: stat_utils.sample_counts of the rows added so far
+    @attribute csv_bytes: size of the csv file once the rows added so far were written
+    @function add: adds one cleaned chunk
+    @function resume: gets the csv file back to the rows of a pickled report, False if it lost some
+    '''
+    def __init__(self, csv_path, start, end, summarize=True):
+        self.csv_path = csv_path
+        self.summary = SummaryStats() if summarize else None
+        self.box_stats = dict((col, BoxStats()) for col, _ in BOXPLOT_COLUMNS)
+        self.reducer = ChartReducer(start, end)
+        self.counts = {}
+        self.n_rows = 0
+        self.last_time = None
+        self.csv_bytes = 0
+
+    def resume(self):
+        #rows written by a run that failed before its report was saved are cut off again
+        if not os.path.exists(self.csv_path) or os.path.getsize(self.csv_path) < self.csv_bytes:
+            return False
+        with open(self.csv_path, 'r+b') as f:
+            f.truncate(self.csv_bytes)
+        return True
+
+    def add(self, chunk, stage):
+        #stage is Instrumentation.stage of the run, it is not kept so the report can be pickled
+        if len(chunk.index) == 0:
+            return
+        if self.last_time is not None and chunk['Datetime'].iloc[0] < self.last_time:
+            print("Rows are not in time order, cleaned_data.csv keeps the order of the file.")
+        self.last_time = chunk['Datetime'].iloc[-1]
+        #numbered on from the previous chunk, like the rows of one frame
+        chunk.index = pd.RangeIndex(self.n_rows, self.n_rows + len(chunk.index))
+        if self.csv_path is not None:
+            with stage('store_clean_data'):
+                chunk.to_csv(self.csv_path, mode='w' if self.n_rows == 0 else 'a', header=self.n_rows == 0)
+                self.csv_bytes = os.path.getsize(self.csv_path)
+        with stage('summarize'):
+            self.n_rows += len(chunk.index)
+            if self.summary is not None:
+                self.summary.add(chunk)
+            for standard, count in sample_counts(chunk).items():
+                self.counts[standard] = self.counts.get(standard, 0) + count
+            for col, box in self.box_stats.items():
+                if col in chunk.columns:
+                    box.update(chunk[col].values)
+        with stage('reduce_charts'):
+            self.reducer.add(chunk)
 
-class Sensor(Enum):
-    AIR_BEAM = 1
-    PURPLE_AIR = 2
-    AIR_EGG = 3
-    INVALID = 4
 
 class Data_File():
     '''Data File Class - handles file processing automatically upon creation
     @param filepath: the path to the input file
     @param outupt_path: the folder path for outputting files
-    @attribute sensor_type: Sensor enum value, calculated from identify_file() function
+    @param chunksize: if given, csv files and xlsx sheets are streamed in chunks of this many rows instead of loaded whole
+    @param cache_dir: if given, cleaned data is cached there by file hash and reused on later runs, together with
+        a pyramid of 1 minute, 1 hour and 1 day sums, counts, minimums and maximums that later runs without a
+        time range average from directly
+    @param instrumentation: Instrumentation object recording each stage, written to timings.json in the output folder
+    @param render_workers: number of processes rendering charts, 1 (the default) renders in this process and None starts one per chart
+    @param all_columns: also read the columns the report does not use (e.g. PurpleAir entry_id, UptimeMins, RSSI_dbm)
+    @param state_dir: if given, csv files are processed incrementally - running aggregates are kept there
+        per source file and later runs only read the rows appended since the last run
+    @param frame_cache: optional FrameCache of cleaned frames kept by a long running process (the app, server.py),
+        checked before the file is hashed or read, and given the cleaned frame of every file read whole
+    @param artifacts: names of the artifact_utils.ARTIFACTS to produce, defaults to every file of a full report.
+        Only these and the inputs they need are built
+    @param artifact_dir: if given, every artifact built is kept in an ArtifactStore there by the key of its inputs,
+        and requested artifacts whose inputs are unchanged are copied from it instead of being built again -
+        when all of them are stored the data file is hashed but not parsed. The pdf is always rebuilt
+    @attribute format: registered SensorFormat of the file, detected from its first few KB
+    @attribute sensor_type: Sensor enum value of the format
+    @attribute sheet: sheet of a spreadsheet input holding the data, None for csv files
+    @attribute windowed: only the rows in the time range were read from the file, so they are not cached
     @attribute data_frame: data stored in a pandas DataFrame object
     @attribute output_folder: output folder path
     @attribute output_file_path: full output file path
     @attribute averaging_range: tuple containing integer then string indicating time to average values over
+    @attribute file_digest: content hash of the input file, None when caching is disabled
+    @attribute sampling_profile: SamplingProfile (intervals, jitter, gaps) of the cleaned data in the time range
+    @attribute summary: mergeable SummaryStats of the reported data, written to general_statistics.csv
+    @attribute totals: hourly (sums, counts) of the cleaned data before resampling, for the regulatory averages
+    @attribute samples: (number of rows, stat_utils.sample_counts) of a report made of streamed cleaned rows,
+        whose data_frame only holds the rows the charts draw, None otherwise
+    @attribute box_stats: dict of column to stat_utils.BoxStats of a report made of streamed cleaned rows
+    @attribute stage_times: wall time in seconds of each top level processing stage, in the order they ran
+    @attribute build: names of the artifacts this run builds, in dependency order
+    @attribute sources: sources ('data', 'header') the artifacts built need
+    @function run: runs the pipeline, called on creation. If it raises (including progress_utils.Cancelled
+        from a cancelled run) the output folder is removed again by rollback before the error propagates
     TODO: @function make_pdf:
     '''
-    def __init__(self, filepath, output_path, averaging_range, header, start_time=None, stop_time=None):
+    def __init__(self, filepath, output_path, averaging_range, header, start_time=None, stop_time=None, chunksize=None, cache_dir=None, instrumentation=None, render_workers=1, all_columns=False, state_dir=None, frame_cache=None, artifacts=None, artifact_dir=None):
         self.averaging_range = averaging_range
         self.start_time = start_time
         self.stop_time = stop_time
         self.proc_start_time = datetime.datetime.now()
         self.file_dict = {}
-        self.data_frame = self.read_file(filepath)
-        self.sensor_type = self.identify_file(self.data_frame)
-        self.set_output_folder(output_path)
-        self.clean(start_time, stop_time)
+        self.cache_dir = cache_dir
+        self.render_workers = render_workers
+        self.all_columns = all_columns
+        self.state_dir = state_dir
+        self.frame_cache = frame_cache
+        self.frame_key = None
+        self.artifacts = artifacts if artifacts is not None else REPORT_ARTIFACTS
+        self.artifact_store = ArtifactStore(artifact_dir) if artifact_dir is not None else None
+        self.artifact_keys = None
+        self.build = []
+        self.sources = set()
+        self.data_frame = None
+        self.summary = None
+        self.table = None
+        self.sampling_profile = None
+        self.totals = None
+        self.samples = None
+        self.box_stats = None
+        self.file_digest = None
+        self.sheet = None
+        self.windowed = False
+        self.output_folder = None
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        try:
+            self.run(filepath, output_path, header, chunksize)
+        except BaseException:
+            #failed or cancelled part way, leave no partial output folder behind
+            self.rollback()
+            raise
+
+    def run(self, filepath, output_path, header, chunksize):
+        '''Runs the pipeline stages (see progress_utils.PIPELINE_STAGES) one after the other
+        Every stage reports to the instrumentation listeners when it finishes, which is where progress
+        is reported and a cancelled run is stopped.
+        '''
+        start_time, stop_time, cache_dir, state_dir = self.start_time, self.stop_time, self.cache_dir, self.state_dir
+        stage = self.instrumentation.stage
+        cached = None
+        pyramid = None
+        with stage('read_file') as info:
+            #only the header is read to tell the sensor, which names the output folder and keys the artifacts
+            self.format, self.sheet = detect_sheet(filepath)
+            self.sensor_type = self.format.sensor
+            self.set_output_folder(output_path)
+            self.plan_artifacts(filepath, header)
+            if 'data' in self.sources:
+                if self.frame_cache is not None:
+                    #an unchanged file cleaned earlier in this process, it is not even hashed
+                    self.frame_key = self.frame_cache.key(filepath, self.sensor_type.name, self.cache_version())
+                    cached = self.frame_cache.get(self.frame_key)
+                if cached is None and cache_dir is not None and cache_available():
+                    if self.file_digest is None:
+                        self.file_digest = file_hash(filepath)
+                    if start_time is None or stop_time is None:
+                        pyramid = self.load_pyramid()
+                    if pyramid is None:
+                        #the raw file was already cleaned by an earlier run, skip read_file and clean_frame
+                        cached = load_clean_cache(cache_dir, self.file_digest, self.cache_version())[1]
+                        if cached is not None and self.frame_cache is not None:
+                            self.frame_cache.put(self.frame_key, cached)
+                if cached is not None:
+                    self.data_frame = cached
+                ready = cached is not None or pyramid is not None
+                incremental = not ready and state_dir is not None and self.is_incremental(filepath)
+                #reading only the rows of a time range beats streaming the whole file
+                window = start_time is not None and stop_time is not None and self.format.can_read_window(filepath)
+                streaming = not ready and not incremental and not window and chunksize is not None and self.is_streamable(filepath)
+                if not ready and not streaming and not incremental:
+                    self.data_frame = None
+                    if window:
+                        self.data_frame = self.read_window(filepath, start_time, stop_time)
+                    if self.data_frame is None:
+                        self.data_frame = self.read_file(filepath)
+                if not streaming and not incremental and pyramid is None:
+                    info['rows'] = len(self.data_frame.index)
+
+        with stage('clean') as info:
+            #every requested artifact may already be stored, then the data is not needed at all
+            if 'data' in self.sources:
+                if pyramid is not None:
+                    self.roll_up(*pyramid)
+                elif cached is not None:
+                    self.filter_and_resample(start_time, stop_time)
+                elif incremental:
+                    self.clean_increment(filepath, start_time, stop_time)
+                elif streaming:
+                    self.clean_chunks(filepath, chunksize, start_time, stop_time)
+                else:
+                    self.clean(start_time, stop_time)
+                info['rows'] = len(self.data_frame.index) if self.samples is None else self.samples[0]
+                if 'cleaned_data' in self.build and 'cleaned_data' not in self.file_dict:
+                    with stage('store_clean_data'):
+                        self.file_dict['cleaned_data'] = self.store_clean_data()
+
+        with stage('gen_statistics'):
+            self.gen_statistics()
+        with stage('visualize'):
+            self.visualize()
+        with stage('gen_pdf'):
+            self.gen_pdf(header)
+        if self.artifact_store is not None:
+            with stage('store_artifacts'):
+                self.store_artifacts()
+        self.stage_times = self.instrumentation.stage_times()
+        self.file_dict.update({'timings': self.instrumentation.write(self.output_folder)})
 
-        self.gen_statistics()
-        self.visualize()
-        self.gen_pdf(header)
+    def rollback(self):
+        if self.output_folder is not None and os.path.isdir(self.output_folder):
+            shutil.rmtree(self.output_folder, ignore_errors=True)
+        self.output_folder = None
 
     def get_output_filepath(self):
         if self.output_folder is not None:
@@ -53,101 +252,352 @@ class Data_File():
         else:
             raise ValueError("Output path not created!")
 
-    def read_file(self, filepath):
+    def read_file(self, filepath, chunksize=None):
         #reads file and returns pandas dataframe
+        #with a chunksize, csv files and xlsx sheets are returned as an iterator of dataframes instead
         try:
-            if os.path.splitext(filepath)[1] == '.csv':
-                return pd.read_csv(filepath)
-            return pd.read_excel(filepath)
+            return self.format.read(filepath, chunksize, self.all_columns, self.sheet)
         except FileNotFoundError as fnfe:
             print(fnfe)
         except IOError as ioe:
             print(ioe)
 
+    def cache_version(self):
+        #pruned and full reads of the same file are cached separately
+        if self.all_columns:
+            return '{}-all'.format(CLEAN_VERSION)
+        return CLEAN_VERSION
+
+    def read_window(self, filepath, start_time, stop_time):
+        #reads only the rows in the time range from a chronological csv, None if the whole file has to be read
+        data_frame = self.format.read_window(filepath, to_py_datetime(start_time), to_py_datetime(stop_time), self.all_columns)
+        self.windowed = data_frame is not None
+        return data_frame
+
+    def load_pyramid(self):
+        '''Looks up the pre-aggregated pyramid of the file when it can answer this run - the averaging range
+        is a multiple of one of its levels and is longer than the sampling interval
+        @result tuple of (pyramid dict, level name, dict of column name to the dtype of the cleaned column), or None
+        '''
+        rate, rate_comp = get_rate(self.averaging_range)
+        level = pyramid_level(rate)
+        if level is None:
+            return None
+        pyramid, metadata = load_pyramid(self.cache_dir, self.file_digest, self.format.sensor.name, self.cache_version(),
+                                         [level, HOURLY_LEVEL])
+        if pyramid is None:
+            return None
+        profile = profile_from_dict(metadata['sampling_profile'])
+        if resample_plan(profile, rate_comp) != RESAMPLE_DOWN:
+            #the report is made from the cleaned rows themselves
+            return None
+        self.sampling_profile = profile
+        return pyramid, level, metadata['dtypes']
+
+    def store_pyramid(self, data_frame):
+        #pre-aggregates the full cleaned data so later runs at other averaging ranges skip the raw rows
+        with self.instrumentation.stage('store_pyramid'):
+            metadata = {'sampling_profile': profile_to_dict(sampling_profile(data_frame['Datetime'])),
+                        'dtypes': dict((col, str(dtype)) for col, dtype in data_frame.dtypes.items())}
+            store_pyramid(self.cache_dir, self.file_digest, self.sensor_type.name, self.cache_version(),
+                          build_pyramid(data_frame), metadata)
+
+    def roll_up(self, pyramid, level, dtypes):
+        #averages the pyramid level into the requested averaging range, and takes the hourly totals from it
+        stage = self.instrumentation.stage
+        with stage('rollup') as info:
+            table = pyramid[level]
+            means = rollup(level_stat(table, 'sum'), level_stat(table, 'count'), get_rate(self.averaging_range)[0])
+            #back to the dtypes of the cleaned columns, so the report matches a run that resamples the rows
+            self.data_frame = means.astype(dict((col, dtypes[col]) for col in means.columns if col in dtypes))
+            info['rows'] = len(self.data_frame.index)
+        hourly = pyramid[HOURLY_LEVEL]
+        self.totals = (level_stat(hourly, 'sum'), level_stat(hourly, 'count'))
+
+    def plan_artifacts(self, filepath, header):
+        '''Works out which requested artifacts are built and which are reused from the artifact store
+        The file is keyed by its content hash together with the settings of the run, so a file rewritten with
+        the same size and modification time is still told apart. Hashing reads the file but does not parse it,
+        and the hash is kept as file_digest for the cleaned data cache.
+        '''
+        is_stored = lambda name: False
+        if self.artifact_store is not None:
+            content_digest = file_hash(filepath)
+            if self.cache_dir is not None:
+                self.file_digest = content_digest
+            data_key = digest([content_digest, os.path.splitext(filepath)[1].lower(), self.sheet, self.incremental_settings()])
+            header_key = file_hash(header) if os.path.exists(header) else digest([header])
+            self.artifact_keys = artifact_keys({'data': data_key, 'header': header_key})
+            is_stored = lambda name: (get_artifact(name).stored and
+                                      self.artifact_store.contains(self.artifact_keys[name], get_artifact(name).filename))
+        reuse, self.build, self.sources = plan_artifacts(self.artifacts, is_stored)
+        for name in sorted(reuse):
+            self.reuse_artifact(name)
+
+    def reuse_artifact(self, name):
+        #internal artifacts are loaded into the attributes that would have been built, the rest copied to the output folder
+        artifact = get_artifact(name)
+        key = self.artifact_keys[name]
+        if name == 'summary_stats':
+            self.summary = pickle.loads(self.artifact_store.load_bytes(key, artifact.filename))
+        elif name == 'sampling_profile':
+            self.sampling_profile = profile_from_dict(json.loads(self.artifact_store.load_bytes(key, artifact.filename).decode('utf-8')))
+        else:
+            self.file_dict[name] = self.artifact_store.fetch(key, artifact.filename, self.output_folder)
+            if name == 'threshold_stats':
+                self.table = read_threshold_table(self.file_dict[name])
+
+    def store_artifacts(self):
+        #keeps everything built by this run for later runs with the same inputs
+        for name in self.build:
+            artifact = get_artifact(name)
+            if not artifact.stored:
+                continue
+            key = self.artifact_keys[name]
+            if name == 'summary_stats':
+                self.artifact_store.save_bytes(key, artifact.filename, pickle.dumps(self.summary))
+            elif name == 'sampling_profile':
+                self.artifact_store.save_bytes(key, artifact.filename, json.dumps(profile_to_dict(self.sampling_profile)).encode('utf-8'))
+            else:
+                self.artifact_store.save(key, artifact.filename, self.file_dict[name])
+
     def identify_file(self, data_frame):
-        #figures out file type
-        #also sets self.output_folder
-        identifier = data_frame.columns[0]
-        if identifier == 'sensor:model':
-            return Sensor.AIR_BEAM
-        if identifier == 'created_at':
-            return Sensor.PURPLE_AIR
-        if identifier == 'Timestamp':
-            return Sensor.AIR_EGG
-        raise ValueError('Invalid input file type. File must be an AirBeam, PurpleAir, or AirEgg dataset')
+        #figures out file type of an already read file, detect_format does the same from the file itself
+        return match_header([str(col) for col in data_frame.columns]).sensor
 
     def set_output_folder(self, output_path):
-        now = time.strftime("%Y%m%d-%H%M%S")
-        if self.sensor_type == Sensor.AIR_BEAM:
-            folder_name = 'Air_Beam' + now
-        elif self.sensor_type == Sensor.AIR_EGG:
-            folder_name = 'Air_Egg' + now
-        elif self.sensor_type == Sensor.PURPLE_AIR:
-            folder_name = 'Purple_Air' + now
-        self.output_folder = os.path.join(output_path, folder_name)
-        if not os.path.exists(self.output_folder):
-            os.makedirs(self.output_folder)
+        self.output_folder = create_output_folder(output_path, self.format.folder_prefix)
 
-    def clean(self, start_time, stop_time):
+    def is_streamable(self, filepath):
+        #csv files and xlsx sheets can be read in chunks, but only for formats whose rows stand alone
+        return self.format.can_stream(filepath)
+
+    def is_incremental(self, filepath):
+        #rows are only ever appended to csv exports, and the appended rows have no header so they need a schema
+        return os.path.splitext(filepath)[1].lower() == '.csv' and self.format.streamable and self.format.columns is not None
+
+    def clean_frame(self, data_frame):
+        stage = self.instrumentation.stage
         #clean data to uniform type
-        if self.sensor_type == Sensor.AIR_BEAM:
-            self.data_frame = clean_air_beam(self.data_frame)
-        elif self.sensor_type == Sensor.AIR_EGG:
-            self.data_frame = clean_air_egg(self.data_frame)
-        elif self.sensor_type == Sensor.PURPLE_AIR:
-            self.data_frame = clean_purple_air(self.data_frame)
-        #Parse datetime column to Datetime object
-        self.data_frame['Datetime'] = self.data_frame['Datetime'].apply(parse_time_string)
+        with stage('rename_columns'):
+            data_frame = self.format.clean(data_frame)
+        #Parse the whole datetime column at once, timezone information is dropped
+        with stage('parse_datetime') as info:
+            data_frame['Datetime'] = parse_datetime_column(data_frame['Datetime'], self.format.time_format)
+            info['rows'] = len(data_frame.index)
         #Sort data by datetime
-        self.data_frame = self.data_frame.sort_values(by = 'Datetime')
-        #convert dataframe data from strings to numbers
-        self.data_frame = self.data_frame.apply(pd.to_numeric, errors='ignore')
-        #since Datetime column was just converted to numbers, reconvert to dates
-        self.data_frame['Datetime'] = self.data_frame['Datetime'].apply(pd.to_datetime)
-        #Remove timezone information
-        self.data_frame['Datetime'] = self.data_frame['Datetime'].apply(lambda x: x.replace(tzinfo=None))
-
-        self.data_frame = filter_on_time(self.data_frame, start_time, stop_time)
-        self.data_frame = resample(self.data_frame, self.averaging_range)
-        self.store_clean_data()
+        with stage('sort'):
+            data_frame = data_frame.sort_values(by = 'Datetime').reset_index(drop=True)
+        #convert the remaining string columns to numbers, formats with a schema are typed by read_file
+        object_columns = [col for col in data_frame.columns.drop('Datetime') if data_frame[col].dtype == object]
+        if object_columns:
+            with stage('to_numeric'):
+                data_frame[object_columns] = data_frame[object_columns].apply(pd.to_numeric, errors='ignore')
+        return data_frame
+
+    def clean(self, start_time, stop_time):
+        self.data_frame = self.clean_frame(self.data_frame)
+        if not self.windowed:
+            self.cache_cleaned(self.data_frame)
+        self.filter_and_resample(start_time, stop_time)
+
+    def cache_cleaned(self, data_frame):
+        #keeps the cleaned rows of the whole file for later runs, in memory and on disk
+        if self.frame_cache is not None:
+            self.frame_cache.put(self.frame_key, data_frame)
+        if self.file_digest is not None:
+            with self.instrumentation.stage('store_cache'):
+                store_clean_cache(self.cache_dir, self.file_digest, self.sensor_type.name, self.cache_version(), data_frame)
+            self.store_pyramid(data_frame)
+
+    def filter_and_resample(self, start_time, stop_time):
+        stage = self.instrumentation.stage
+        with stage('filter_on_time') as info:
+            self.data_frame = filter_on_time(self.data_frame, start_time, stop_time)
+            info['rows'] = len(self.data_frame.index)
+        with stage('hourly_totals'):
+            self.totals = hourly_totals(self.data_frame)
+        with stage('sampling_profile'):
+            self.sampling_profile = sampling_profile(self.data_frame['Datetime'])
+        with stage('resample') as info:
+            self.data_frame = resample(self.data_frame, self.averaging_range, self.sampling_profile)
+            info['rows'] = len(self.data_frame.index)
+
+    def clean_chunks(self, filepath, chunksize, start_time, stop_time):
+        #streaming version of clean, only the running resample buckets are kept in memory
+        stage = self.instrumentation.stage
+        accumulator = ResampleAccumulator(self.averaging_range)
+        #the cleaned chunks are kept for the caches while they fit in the frame cache, so reruns skip the file as well
+        kept = [] if self.frame_cache is not None else None
+        kept_bytes = 0
+        for chunk in self.read_file(filepath, chunksize):
+            self.instrumentation.checkpoint()
+            chunk = self.clean_frame(chunk)
+            if kept is not None:
+                kept_bytes += frame_bytes(chunk)
+                if kept_bytes <= self.frame_cache.max_bytes:
+                    kept.append(chunk)
+                else:
+                    kept = None
+            with stage('filter_on_time') as info:
+                chunk = filter_on_time(chunk, start_time, stop_time, allow_empty=True)
+                info['rows'] = len(chunk.index)
+            with stage('resample'):
+                accumulator.add(chunk)
+        if kept:
+            data_frame = pd.concat(kept, ignore_index=True)
+            #each chunk was sorted on its own, which only sorts the whole file if its rows were in order
+            if not data_frame['Datetime'].is_monotonic_increasing:
+                data_frame = data_frame.sort_values(by = 'Datetime').reset_index(drop=True)
+            self.cache_cleaned(data_frame)
+            del data_frame, kept
+        if accumulator.n_rows == 0:
+            raise ValueError("Start and Stop Times given are outside range of file.")
+
+        with stage('hourly_totals'):
+            self.totals = accumulator.totals()
+        self.sampling_profile = accumulator.profiler.profile()
+        with stage('resample'):
+            self.data_frame = accumulator.result()
+        if self.data_frame is None:
+            #resampling was a no-op, so the report is made of every cleaned row
+            self.report_chunks(filepath, chunksize, start_time, stop_time, accumulator)
+
+    def report_chunks(self, filepath, chunksize, start_time, stop_time, accumulator):
+        '''Makes the report of the cleaned rows themselves in a second streamed pass over the file, for
+        streamed files whose resampling turned out to be a no-op - the rows go straight to cleaned_data.csv,
+        and only the statistics, the rows the charts draw and the boxplot tails are kept in memory
+        '''
+        stage = self.instrumentation.stage
+        outpath = os.path.join(self.output_folder, 'cleaned_data.csv') if 'cleaned_data' in self.build else None
+        report = RowReport(outpath, accumulator.min_time, accumulator.max_time, 'summary_stats' in self.build)
+        for chunk in self.read_file(filepath, chunksize):
+            self.instrumentation.checkpoint()
+            chunk = self.clean_frame(chunk)
+            with stage('filter_on_time') as info:
+                chunk = filter_on_time(chunk, start_time, stop_time, allow_empty=True)
+                info['rows'] = len(chunk.index)
+            report.add(chunk, stage)
+        self.use_report(report)
+
+    def use_report(self, report):
+        #takes the statistics and chart rows of a RowReport, and its rows as cleaned_data.csv
+        if 'cleaned_data' in self.build:
+            outpath = os.path.join(self.output_folder, 'cleaned_data.csv')
+            if report.csv_path != outpath:
+                with self.instrumentation.stage('store_clean_data'):
+                    shutil.copyfile(report.csv_path, outpath)
+            self.file_dict['cleaned_data'] = outpath
+        if report.summary is not None:
+            self.summary = report.summary
+        self.samples = (report.n_rows, report.counts)
+        self.box_stats = report.box_stats
+        self.data_frame = report.reducer.result()
+
+    def incremental_settings(self):
+        #saved state is only reused by runs that would have produced the same aggregates
+        start = None if self.start_time is None else str(to_py_datetime(self.start_time))
+        stop = None if self.stop_time is None else str(to_py_datetime(self.stop_time))
+        return {'sensor': self.sensor_type.name, 'clean_version': CLEAN_VERSION, 'state_version': STATE_VERSION,
+                'all_columns': self.all_columns,
+                'averaging_range': list(self.averaging_range), 'start_time': start, 'stop_time': stop}
+
+    def clean_increment(self, filepath, start_time, stop_time, restart=False):
+        '''Incremental version of clean_chunks - folds only the rows appended since the last run
+        into the running resample buckets (which hold the hourly totals) saved in state_dir
+        When resampling is a no-op the report is made of the rows themselves, then a RowReport of them
+        (with a copy of every cleaned row, in the state folder) is saved and carried on from as well.
+        @param restart: ignore the saved state and read the whole file
+        '''
+        stage = self.instrumentation.stage
+        settings = self.incremental_settings()
+        state = None if restart else load_state(self.state_dir, filepath)
+        if state is None or state['settings'] != settings:
+            state = {'settings': settings, 'offset': header_end(filepath), 'last_time': None,
+                     'accumulator': ResampleAccumulator(self.averaging_range), 'report': None}
+        fresh = state['offset'] == header_end(filepath)
+        accumulator = state['accumulator']
+        with stage('read_tail') as info:
+            tail, offset = read_tail(filepath, state['offset'])
+            chunk = self.format.read_rows(io.BytesIO(tail), self.all_columns) if tail else None
+            info['rows'] = 0 if chunk is None else len(chunk.index)
+        if chunk is not None:
+            chunk = self.clean_frame(chunk)
+            #clean_frame sorted the rows, so the last one is the newest
+            if len(chunk.index) > 0 and (state['last_time'] is None or chunk['Datetime'].iloc[-1] > state['last_time']):
+                state['last_time'] = chunk['Datetime'].iloc[-1]
+            with stage('filter_on_time') as info:
+                chunk = filter_on_time(chunk, start_time, stop_time, allow_empty=True)
+                info['rows'] = len(chunk.index)
+            with stage('resample'):
+                accumulator.add(chunk)
+        if accumulator.n_rows == 0:
+            raise ValueError("Start and Stop Times given are outside range of file.")
+
+        self.sampling_profile = accumulator.profiler.profile()
+        with stage('hourly_totals'):
+            self.totals = accumulator.totals()
+        with stage('resample'):
+            self.data_frame = accumulator.result()
+        if self.data_frame is None:
+            report = state['report']
+            if not fresh and (report is None or not report.resume()):
+                #the saved state was made for a resampled report, which keeps none of the rows, or they were deleted
+                print("The cleaned rows of the file were not kept, its incremental state is rebuilt from the whole file.")
+                return self.clean_increment(filepath, start_time, stop_time, restart=True)
+            if report is None:
+                os.makedirs(self.state_dir, exist_ok=True)
+                report = RowReport(rows_path(self.state_dir, filepath), accumulator.min_time, accumulator.max_time)
+                state['report'] = report
+            with stage('reduce_charts'):
+                report.reducer.extend(accumulator.max_time)
+            if chunk is not None:
+                report.add(chunk, stage)
+            self.use_report(report)
+        state['offset'] = offset
+        with stage('store_state'):
+            store_state(self.state_dir, filepath, state)
 
     def gen_statistics(self):
-        #calls statistics functions
-        self.file_dict.update({'basic_stats': basic_stats(self.data_frame, self.output_folder)})
-        self.table = above_threshold_stats(self.data_frame, self.output_folder)
+        #calls statistics functions, for the statistics this run builds
+        if 'summary_stats' in self.build and self.summary is None:
+            self.summary = SummaryStats()
+            self.summary.add(self.data_frame)
+        if 'basic_stats' in self.build:
+            self.file_dict.update({'basic_stats': basic_stats(self.data_frame, self.output_folder, self.summary)})
+        if 'threshold_stats' in self.build:
+            self.table = above_threshold_stats(self.data_frame, self.output_folder, totals=self.totals, samples=self.samples,
+                                               profile=self.sampling_profile)
+            self.file_dict.update({'threshold_stats': os.path.join(self.output_folder, 'threshold_stats.csv')})
 
     def store_clean_data(self):
         #writes clean csv to output path
         fn = 'cleaned_data.csv'
         output_filepath = os.path.join(self.output_folder, fn)
         self.data_frame.to_csv(output_filepath)
+        return output_filepath
 
     def visualize(self):
-        self.file_dict.update({'boxplot': boxplot(self.data_frame, self.output_folder)})
-        self.file_dict.update({'humidity_graph': humidity_graph(self.data_frame, self.output_folder)})
-        self.file_dict.update({'PM25_thresh': threshold_PM25(self.data_frame, self.output_folder)})
-        self.file_dict.update({'PM10_thresh': threshold_PM10(self.data_frame, self.output_folder)})
+        charts = [name for name in self.build if name in dict(CHARTS)]
+        self.file_dict.update(render_charts(self.data_frame, self.output_folder, self.render_workers, charts, self.box_stats,
+                                            self.instrumentation.checkpoint))
 
     def gen_pdf(self, header):
+        if 'pdf' not in self.build:
+            return
         avg_range_str = str(self.averaging_range[0]) + " " + self.averaging_range[1]
-
-        sensor_str = ''
-        if self.sensor_type == Sensor.AIR_BEAM:
-            sensor_str = 'Air Beam'
-        elif self.sensor_type == Sensor.AIR_EGG:
-            sensor_str = 'Air Egg'
-        elif self.sensor_type == Sensor.PURPLE_AIR:
-            sensor_str = 'Purple Air'
+        sensor_str = self.format.display_name
 
         if self.start_time is not None:
-            start_time = self.start_time.toPyDateTime()
+            start_time = to_py_datetime(self.start_time)
             start_time = start_time.replace(microsecond=0)
         else:
             start_time = "None"
         if self.stop_time is not None:
-            stop_time = self.stop_time.toPyDateTime()
+            stop_time = to_py_datetime(self.stop_time)
             stop_time = stop_time.replace(microsecond=0)
         else:
             stop_time = "None"
         proc_start_time = self.proc_start_time.replace(microsecond=0)
-        create_pdf(sensor_str, avg_range_str, str(start_time), str(stop_time), str(proc_start_time), self.file_dict, self.table, self.output_folder, header)
+        self.file_dict['pdf'] = create_pdf(sensor_str, avg_range_str, str(start_time), str(stop_time), str(proc_start_time), self.file_dict, self.table, self.output_folder, header, self.sampling_profile,
+                                           self.instrumentation.checkpoint)
@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+#openpyxl is optional, without it spreadsheets are parsed whole by pandas.read_excel
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+#workbook types openpyxl can stream, legacy .xls files always go through pandas (xlrd)
+STREAMING_EXTENSIONS = ['.xlsx', '.xlsm']
+
+def can_stream(filepath):
+    return openpyxl is not None and os.path.splitext(filepath)[1].lower() in STREAMING_EXTENSIONS
+
+def open_workbook(filepath):
+    #read only mode parses the sheet xml lazily instead of building every cell object up front
+    return openpyxl.load_workbook(filepath, read_only=True, data_only=True)
+
+def header_strings(row):
+    return ['' if v is None else str(v) for v in row]
+
+def sheet_headers(filepath):
+    '''Reads the first row of every sheet of a spreadsheet without reading the rest of it
+
+    @param filepath: the path to the spreadsheet
+    @result list of (sheet name, header row as strings) in workbook order
+    '''
+    if not can_stream(filepath):
+        sheets = pd.read_excel(filepath, sheet_name=None, nrows=0)
+        return [(name, [str(col) for col in df.columns]) for name, df in sheets.items()]
+    workbook = open_workbook(filepath)
+    try:
+        return [(ws.title, header_strings(next(ws.iter_rows(max_row=1, values_only=True), ())))
+                for ws in workbook.worksheets]
+    finally:
+        workbook.close()
+
+def typed_column(values, dtype, na_values):
+    #openpyxl returns python values, numbers stored as text are converted by numpy
+    if dtype is None:
+        return values
+    return np.array([np.nan if v is None or v in na_values else v for v in values], dtype=dtype)
+
+def build_frame(names, columns, dtypes, na_values):
+    data = dict((name, typed_column(values, dtypes.get(name), na_values)) for name, values in zip(names, columns))
+    return pd.DataFrame(data, columns=names)
+
+def iter_sheet(filepath, sheet, names, usecols, dtypes, na_values, chunksize):
+    workbook = open_workbook(filepath)
+    try:
+        ws = workbook[sheet] if sheet is not None else workbook.worksheets[0]
+        #the dimensions stored in the file are not always right, read until the last row instead
+        ws.reset_dimensions()
+        header = header_strings(next(ws.iter_rows(max_row=1, values_only=True), ()))
+        if names is None:
+            names = header
+        keep = list(names) if usecols is None else list(usecols)
+        positions = [names.index(name) for name in keep]
+        #cells right of the last kept column are never turned into values
+        rows = ws.iter_rows(min_row=2, max_col=max(positions) + 1 if positions else None, values_only=True)
+        columns = [[] for _ in positions]
+        n_rows = 0
+        for row in rows:
+            if all(v is None for v in row):
+                #formatted but empty rows below the data
+                continue
+            width = len(row)
+            for column, pos in zip(columns, positions):
+                column.append(row[pos] if pos < width else None)
+            n_rows += 1
+            if n_rows == chunksize:
+                yield build_frame(keep, columns, dtypes, na_values)
+                columns = [[] for _ in positions]
+                n_rows = 0
+        if n_rows or chunksize is None:
+            yield build_frame(keep, columns, dtypes, na_values)
+    finally:
+        workbook.close()
+
+def read_sheet(filepath, sheet=None, names=None, usecols=None, dtype=None, na_values=(), chunksize=None):
+    '''Reads one sheet of an .xlsx workbook row by row into typed columns
+
+    Only the kept columns are collected, and each is converted to its dtype in one step
+    instead of pandas inferring the type of every cell.
+
+    @param filepath: the path to the workbook
+    @param sheet: sheet name, None for the first sheet
+    @param names: names to give the columns of the sheet in order, None to use its header row
+    @param usecols: names of the columns to keep, None for all of them
+    @param dtype: dict of column name to dtype, other columns keep the values openpyxl returns
+    @param na_values: cell values read as missing
+    @param chunksize: if given, an iterator of DataFrames of this many rows is returned instead
+    @result DataFrame, or iterator of DataFrames when chunksize is given
+    '''
+    chunks = iter_sheet(filepath, sheet, names, usecols, dtype or {}, na_values, chunksize)
+    if chunksize is not None:
+        return chunks
+    data_frame = next(chunks)
+    #closes the workbook
+    chunks.close()
+    return data_frame
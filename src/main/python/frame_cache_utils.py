@@ -0,0 +1,79 @@
+import os
+import threading
+from collections import OrderedDict
+
+#memory cleaned frames may take up by default, in MB
+DEFAULT_CACHE_MB = 512
+
+def frame_bytes(data_frame):
+    #deep counts the strings of object columns too, cleaned frames are mostly numbers so it is cheap
+    return int(data_frame.memory_usage(index=True, deep=True).sum())
+
+class FrameCache():
+    '''Least recently used cache of cleaned data frames, kept in memory by a long running process (the app, server.py)
+    Repeated runs on an unchanged file (e.g. with another averaging range or time range) reuse the cleaned
+    frame and go straight to filter_on_time and resample instead of reading and parsing the file again.
+    Cached frames are shared, callers must not modify them.
+    @param max_mb: memory budget of the cached frames in MB, the least recently used frames are dropped to stay
+        within it, and a frame larger than the whole budget is not cached at all
+    @param max_entries: optional limit on the number of frames as well
+    @attribute size: memory the cached frames take up, in bytes
+    @attribute hits: number of lookups that found a frame
+    @attribute misses: number of lookups that did not
+    @function key: builds the cache key of a file from its path, size, modification time and sensor type
+    @function get: looks up a frame
+    @function put: stores a frame
+    '''
+    def __init__(self, max_mb=DEFAULT_CACHE_MB, max_entries=None):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, filepath, sensor_name, clean_version):
+        #a file that was rewritten or appended to gets a new key, its old frame ages out
+        st = os.stat(filepath)
+        return (os.path.abspath(filepath), st.st_size, st.st_mtime_ns, sensor_name, clean_version)
+
+    def get(self, key):
+        '''@result cleaned DataFrame, or None if the file is not cached'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, data_frame):
+        '''@result True if the frame was cached, False if it is larger than the whole budget'''
+        nbytes = frame_bytes(data_frame)
+        with self.lock:
+            self.remove(key)
+            if nbytes > self.max_bytes:
+                return False
+            self.entries[key] = (data_frame, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes or (self.max_entries is not None and len(self.entries) > self.max_entries):
+                self.remove(next(iter(self.entries)))
+            return True
+
+    def remove(self, key):
+        #the lock must be held
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {'frames': len(self.entries), 'mb': round(self.size / (1024 * 1024), 2),
+                    'max_mb': round(self.max_bytes / (1024 * 1024), 2), 'hits': self.hits, 'misses': self.misses}
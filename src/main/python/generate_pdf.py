@@ -1,4 +1,5 @@
 from fpdf import FPDF
+import math
 import os
 import csv
 
@@ -28,10 +29,21 @@ class ReportPDF(FPDF):
     #     self.set_xy(-60, -20)
     #     self.cell(w=50, h=10, txt='Sample Footer Text')
 
-def create_pdf(sensor_name, averaging_range, start_time, stop_time, process_start_time, file_dict, threshold_table, output_folder, header):
+def format_seconds(seconds):
+    # Short human readable duration, e.g. 80 s, 14 min, 2.5 h, in the largest unit that reads as at least 2
+    for unit, size in (('days', 86400), ('h', 3600), ('min', 60)):
+        if seconds >= 2 * size:
+            return '{:g} {}'.format(round(seconds / size, 1), unit)
+    return '{:g} s'.format(round(seconds, 1))
+
+def create_pdf(sensor_name, averaging_range, start_time, stop_time, process_start_time, file_dict, threshold_table, output_folder, header, sampling_profile=None, checkpoint=None):
     """
     Creates the pdf and returns the full path to where the PDF was written to
+    sampling_profile is the SamplingProfile of the data, summarized under the run details when given
+    checkpoint is an optional callable invoked between the sections and images of the pdf, which may raise to stop it
     """
+    if checkpoint is None:
+        checkpoint = lambda: None
     # /////////
     # Setup PDF
     # /////////
@@ -52,12 +64,19 @@ def create_pdf(sensor_name, averaging_range, start_time, stop_time, process_star
     pdf.cell(w=5,h=5, txt='Sensor: '+ sensor_name +' | Averaging Range: '+ averaging_range, border=0, ln=0, align='L')
     pdf.ln(8)
     pdf.cell(w=5,h=0, txt='Start Time: '+ start_time +' | Stop Time: '+ stop_time +' | Report Generated: '+ process_start_time, border=0, ln=0, align='L')
+    if sampling_profile is not None and not math.isnan(sampling_profile.median_interval):
+        # Sampling details, the median interval is NaN when there are fewer than two samples
+        pdf.ln(6)
+        pdf.cell(w=5,h=0, txt='Samples: '+ str(sampling_profile.samples) +' | Sample Interval: '+ format_seconds(sampling_profile.median_interval)
+                 +' (jitter '+ format_seconds(sampling_profile.jitter) +') | Gaps: '+ str(sampling_profile.gaps)
+                 +' ('+ format_seconds(sampling_profile.gap_seconds) +' missing)', border=0, ln=0, align='L')
     pdf.ln(10)
 
     # /////////////
     # Details Table
     # /////////////
 
+    checkpoint()
     # Page width
     page_width = pdf.w - 2*pdf.l_margin
     # Set column width to 1/9 of page width to distribute content
@@ -90,6 +109,7 @@ def create_pdf(sensor_name, averaging_range, start_time, stop_time, process_star
     files = [boxplot_file_path, threshold25_file_path, threshold10_file_path, humidity_file_path]
     # Create the image and spacing for each visualization
     for file_path in files:
+        checkpoint()
         pdf.image(file_path, w=120,h=120)
         pdf.ln(5)
 
@@ -97,15 +117,20 @@ def create_pdf(sensor_name, averaging_range, start_time, stop_time, process_star
     # Threshold_table
     # ///////////////
 
-    # Set column width to 1/6 of page width to distribute content
-    # evenly across table and page
-    col_width = page_width/6
+    checkpoint()
+    # Size each column to its widest entry, then stretch the columns
+    # proportionally to fill the page width
+    col_widths = [max(pdf.get_string_width(str(row[i])) for row in threshold_table) + 2
+                  for i in range(len(threshold_table[0]))]
+    scale = page_width/sum(col_widths)
     # Construct table from detail_data
     for row in threshold_table:
-        for datum in row:
-            pdf.cell(col_width, text_height, str(datum), border=1)
+        for datum, col_width in zip(row, col_widths):
+            pdf.cell(col_width*scale, text_height, str(datum), border=1)
         pdf.ln(text_height)
 
     # Write to output file
+    checkpoint()
     output_filename = os.path.join(output_folder, 'summary.pdf')
     pdf.output(output_filename, dest='F')
+    return output_filename
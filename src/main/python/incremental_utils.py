@@ -0,0 +1,76 @@
+import hashlib
+import os
+import pickle
+
+STATE_FOLDER = '.incremental_state'
+#bump whenever the saved state changes shape so older state files are rebuilt
+STATE_VERSION = 5
+#bytes at the start of a file that must be unchanged for its saved state to be reused
+HEAD_BYTES = 1 << 16
+
+def state_path(state_dir, filepath):
+    #one state file per source file, named by its absolute path
+    key = hashlib.sha256(os.path.abspath(filepath).encode('utf-8')).hexdigest()[:32]
+    return os.path.join(state_dir, key + '.pkl')
+
+def rows_path(state_dir, filepath):
+    #cleaned rows of a source file whose report is made of the rows themselves, next to its state file
+    return os.path.splitext(state_path(state_dir, filepath))[0] + '_cleaned_data.csv'
+
+def head_digest(filepath, offset):
+    #sha256 of the start of the already processed part of the file, detects files that were replaced
+    with open(filepath, 'rb') as f:
+        return hashlib.sha256(f.read(min(offset, HEAD_BYTES))).hexdigest()
+
+def header_end(filepath):
+    #byte offset of the first data row
+    with open(filepath, 'rb') as f:
+        f.readline()
+        return f.tell()
+
+def read_tail(filepath, offset):
+    '''Reads the complete lines appended to a file since offset
+
+    A last line without its newline may still be being written, it is left for the next run.
+
+    @param filepath: the path to the source file
+    @param offset: byte offset up to which the file was already processed
+    @result tuple of (bytes of the new lines, byte offset to continue from next time)
+    '''
+    with open(filepath, 'rb') as f:
+        f.seek(offset)
+        tail = f.read()
+    end = tail.rfind(b'\n') + 1
+    return tail[:end], offset + end
+
+def load_state(state_dir, filepath):
+    '''Loads the state store_state saved for a source file
+
+    @result state dict, or None if there is none or the file no longer starts with the processed bytes
+    '''
+    path = state_path(state_dir, filepath)
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+    if os.path.getsize(filepath) < state['offset'] or head_digest(filepath, state['offset']) != state['head_digest']:
+        #the file was truncated or rewritten rather than appended to
+        return None
+    return state
+
+def store_state(state_dir, filepath, state):
+    '''Saves the running aggregates of a source file, see Data_File.clean_increment
+
+    @param state: dict with at least the byte offset processed so far, the head digest is added here
+    @result path of the state file
+    '''
+    os.makedirs(state_dir, exist_ok=True)
+    state['head_digest'] = head_digest(filepath, state['offset'])
+    path = state_path(state_dir, filepath)
+    #write to a temporary name first so a crash never leaves a truncated state behind
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    return path
@@ -1,5 +1,6 @@
 # Python standard library imports
 from functools import partial
+import multiprocessing
 import sys
 import os
 
@@ -13,6 +14,14 @@ from PyQt5.QtGui import QMovie
 
 # Data Processor function import (from clean.py)
 from clean import process_file
+from progress_utils import CancelToken, Cancelled
+from frame_cache_utils import DEFAULT_CACHE_MB, FrameCache
+
+# memory (in MB) the app may use to keep cleaned files between runs, set AQA_CACHE_MB to change it
+FRAME_CACHE_MB = float(os.environ.get("AQA_CACHE_MB", DEFAULT_CACHE_MB))
+
+# rows read at a time from csv files and xlsx sheets, so a large file can be cancelled part way through reading it
+CHUNKSIZE = 100000
 
 
 class AppContext(ApplicationContext):
@@ -420,14 +429,20 @@ class Processor(QObject):
         start (QDateTime): the selected start time
         end (QDateTime): the selected end time
         pdf_header (str): the file path of the PDF header
+        frame_cache (FrameCache): cleaned files kept in memory between runs of the session
 
     Attributes:
         result_signal (pyqtSignal): used to emit the resultant output path back to the main thread
+        progress_signal (pyqtSignal): used to emit a description of the last finished stage and the percent done
+        cancelled_signal (pyqtSignal): emitted instead of result_signal when the user cancelled the analysis
+        cancel_token (CancelToken): checked by the data processor between stages, chunks, charts and pdf sections
 
     '''
     result_signal = pyqtSignal(str, bool)
+    progress_signal = pyqtSignal(str, int)
+    cancelled_signal = pyqtSignal()
 
-    def __init__(self, file_path, output_path, ad_num, ad_unit, start, end, pdf_header):
+    def __init__(self, file_path, output_path, ad_num, ad_unit, start, end, pdf_header, frame_cache=None):
         super().__init__()
         self.file_path = file_path
         self.output_path = output_path
@@ -435,6 +450,19 @@ class Processor(QObject):
         self.start_time = start
         self.end_time = end
         self.header = pdf_header
+        self.frame_cache = frame_cache
+        self.cancel_token = CancelToken()
+
+    # called from the main thread, the worker stops at the next stage and removes its output folder
+    def cancel(self):
+        self.cancel_token.cancel()
+
+    # runs in the worker thread, the signal queues the update onto the main event loop
+    def report(self, event):
+        text = "Finished " + event.stage.split("/")[-1].replace("_", " ")
+        if event.rows:
+            text += " (" + format(event.rows, ",") + " rows read)"
+        self.progress_signal.emit(text, int(100 * event.completed / event.total))
 
     def work(self):
         error = False
@@ -444,7 +472,14 @@ class Processor(QObject):
                                   self.ad_tuple,
                                   self.header,
                                   start_time=self.start_time,
-                                  stop_time=self.end_time)
+                                  stop_time=self.end_time,
+                                  chunksize=CHUNKSIZE,
+                                  progress=self.report,
+                                  cancel_token=self.cancel_token,
+                                  frame_cache=self.frame_cache)
+        except Cancelled:
+            self.cancelled_signal.emit()
+            return
         except Exception as e:
             error = True
             output = str(e) # we trust the back end to describe errors
@@ -462,11 +497,15 @@ class ProgressWidget(QWidget):
 
     Attributes:
         thread (QThread): the thread used by the widget to delegate the processor to
+        frame_cache (FrameCache): cleaned files of earlier runs, so re-running a file with another averaging
+            duration or time range (e.g. after "Start Over") skips reading and cleaning it
         file_name_label (QLabel): displays the file name that was selected
         averaging_label (QLabel): displays the averaging duration number and unit selected
         start_label (QLabel): displays the start time selected (or N/A)
         end_label (QLabel): displays the end time selected (or N/A)
         movie (QMovie): runs the loading icon gif
+        status_label (QLabel): displays the last finished stage and the percent done
+        cancel_button (QPushButton): stops the running analysis
 
         All labels are defined as attributes of the class so they can be modified at the start of each process.
     '''
@@ -475,6 +514,7 @@ class ProgressWidget(QWidget):
         # delegation thread used to run the process off of the main event loop
         self.thread = QThread()
         self.thread.setObjectName("Data Processor Thread")
+        self.frame_cache = FrameCache(FRAME_CACHE_MB)
 
         # define information labels
         title_label = QLabel("Analysis in progress...")
@@ -487,6 +527,12 @@ class ProgressWidget(QWidget):
         self.start_label.setObjectName("details")
         self.end_label = QLabel("")
         self.end_label.setObjectName("details")
+        self.status_label = QLabel("")
+        self.status_label.setObjectName("details")
+
+        # cancelling takes effect at the next chunk, chart or pdf section
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel)
 
         # define movie and container label
         self.movie = QMovie(progress_icon)
@@ -502,6 +548,8 @@ class ProgressWidget(QWidget):
         layout.addWidget(self.start_label)
         layout.addWidget(self.end_label)
         layout.addWidget(loading_label)
+        layout.addWidget(self.status_label)
+        layout.addWidget(self.cancel_button)
         self.setLayout(layout)
 
     # takes in all parameters related to the process and spawns a worker to run it
@@ -516,25 +564,49 @@ class ProgressWidget(QWidget):
             self.start_label.setText("Start Time: N/A")
             self.end_label.setText("End Time: N/A")
 
+        self.status_label.setText("Starting...")
+        self.cancel_button.setEnabled(True)
+
         # start icon gif and allow main event loop to process it
         self.movie.start()
         qApp.processEvents()
 
         # define a worker object, move it to a new thread, and begin the processor work
-        self.processor = Processor(file_path, output_path, ad_num, ad_unit, start, end, pdf_header)
+        self.processor = Processor(file_path, output_path, ad_num, ad_unit, start, end, pdf_header, self.frame_cache)
         self.processor.moveToThread(self.thread)
         self.thread.started.connect(self.processor.work)
         self.processor.result_signal.connect(self.finish)
+        self.processor.progress_signal.connect(self.update_progress)
+        self.processor.cancelled_signal.connect(self.cancelled)
         self.thread.start()
 
-    # ends the process and makes a callback to the main window with the result
-    @pyqtSlot(str, bool)
-    def finish(self, output, error):
+    @pyqtSlot(str, int)
+    def update_progress(self, text, percent):
+        self.status_label.setText(text + " - " + str(percent) + "%")
+
+    # asks the processor to stop, the cancelled slot runs once it has
+    def cancel(self):
+        self.cancel_button.setEnabled(False)
+        self.status_label.setText("Cancelling...")
+        self.processor.cancel()
+
+    # the processor stopped and removed its partial output, go back to the main screen
+    @pyqtSlot()
+    def cancelled(self):
+        self.stop_thread()
+        self.parentWidget().parentWidget().start_over()
+
+    def stop_thread(self):
         # stop and disconnect the thread from the processor object
         self.thread.quit()
         self.thread.wait()
         self.thread.disconnect()
         self.movie.stop()
+
+    # ends the process and makes a callback to the main window with the result
+    @pyqtSlot(str, bool)
+    def finish(self, output, error):
+        self.stop_thread()
         self.parentWidget().parentWidget().complete_analysis(output, error)
 
 
@@ -590,6 +662,8 @@ class CompleteWidget(QWidget):
 
 
 if __name__ == "__main__":
+    # worker processes started from the app (e.g. render_workers > 1) must also start from a frozen (fbs) executable
+    multiprocessing.freeze_support()
     appctxt = AppContext()
     exit_code = appctxt.run()
     sys.exit(exit_code)
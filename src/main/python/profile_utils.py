@@ -0,0 +1,129 @@
+import cProfile
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+#resource is not available on Windows, peak RSS is simply not reported there
+try:
+    import resource
+except ImportError:
+    resource = None
+
+TIMINGS_NAME = 'timings.json'
+PROFILE_NAME = 'profile.prof'
+
+def peak_rss_mb():
+    #peak resident set size of the whole process so far, it never goes down so it is not a per-stage figure
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    if sys.platform == 'darwin':
+        return round(peak / (1024 * 1024), 2)
+    return round(peak / 1024, 2)
+
+class Instrumentation():
+    '''Records wall time, CPU time, memory and row counts of each pipeline stage
+    @param trace_memory: also record the tracemalloc peak of each stage (slows processing down noticeably),
+        the peak of a stage includes the stages nested in it
+    @param profile: run cProfile over the whole pipeline, dumped next to the timings by write()
+    @attribute records: dict of stage name to its record, in the order the stages first ran
+    @attribute listeners: callables invoked as listener(name, record) whenever a stage finishes,
+        used to plug in other reporting (logging, progress, metrics)
+    @function stage: context manager timing one stage, nested stages are named 'outer/inner'
+    @function checkpoint: lets listeners act inside a long stage, e.g. between chunks, charts or pdf pages
+    @function write: writes the records (and profile) to an output folder
+    '''
+    def __init__(self, trace_memory=False, profile=False):
+        self.trace_memory = trace_memory
+        self.records = {}
+        self.listeners = []
+        self.stack = []
+        #highest tracemalloc peak of each open stage before its last reset_peak, parallel to stack
+        self.peaks = []
+        self.profiler = cProfile.Profile() if profile else None
+        if self.profiler is not None:
+            self.profiler.enable()
+        #tracing started by someone else (e.g. a test or an outer Instrumentation) is left running by stop()
+        self.started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        '''Times the enclosed block, the yielded dict can be given a 'rows' count by the caller
+        A stage that runs several times (e.g. once per chunk) accumulates its times and calls.
+        '''
+        full_name = '/'.join(self.stack + [name])
+        self.stack.append(name)
+        info = {}
+        if self.trace_memory:
+            #the enclosing stage keeps the peak it reached so far, this stage measures its own from here
+            self.reset_peak()
+            self.peaks.append(0)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield info
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            self.stack.pop()
+            record = self.records.setdefault(full_name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            record['calls'] += 1
+            record['wall_seconds'] = round(record['wall_seconds'] + wall, 4)
+            record['cpu_seconds'] = round(record['cpu_seconds'] + cpu, 4)
+            if self.trace_memory:
+                #nested stages fold their peaks into this one, and this one into the enclosing stage
+                self.reset_peak()
+                peak = self.peaks.pop()
+                if self.peaks:
+                    self.peaks[-1] = max(self.peaks[-1], peak)
+                record['tracemalloc_peak_mb'] = round(max(peak / (1024 * 1024), record.get('tracemalloc_peak_mb', 0)), 2)
+            if 'rows' in info:
+                record['rows'] = record.get('rows', 0) + int(info['rows'])
+            for listener in self.listeners:
+                listener(full_name, record)
+
+    def checkpoint(self):
+        #listeners with a checkpoint method (e.g. ProgressReporter, which may raise Cancelled) are called
+        for listener in self.listeners:
+            check = getattr(listener, 'checkpoint', None)
+            if check is not None:
+                check()
+
+    def reset_peak(self):
+        #folds the tracemalloc peak since the last reset into the innermost open stage and starts a new one
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], tracemalloc.get_traced_memory()[1])
+        #reset_peak only exists on Python 3.9+, older versions report the peak since tracing started
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    def stage_times(self):
+        #wall time of the top level stages only
+        return dict((name, record['wall_seconds']) for name, record in self.records.items() if '/' not in name)
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.started_tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.started_tracing = False
+
+    def write(self, output_folder):
+        '''Writes timings.json (and profile.prof when profiling) to output_folder
+        Besides the stage records it holds the peak RSS of the whole process, which includes everything the
+        process did before this run.
+        @result path of timings.json
+        '''
+        self.stop()
+        if self.profiler is not None:
+            self.profiler.dump_stats(os.path.join(output_folder, PROFILE_NAME))
+        outpath = os.path.join(output_folder, TIMINGS_NAME)
+        with open(outpath, 'w') as f:
+            json.dump({'process_peak_rss_mb': peak_rss_mb(), 'stages': self.records}, f, indent=2)
+        return outpath
@@ -0,0 +1,62 @@
+import threading
+from collections import namedtuple
+
+#top level stages of the Data_File pipeline, in the order they run
+PIPELINE_STAGES = ['read_file', 'clean', 'gen_statistics', 'visualize', 'gen_pdf']
+
+#stage: full name of the stage that just finished, e.g. 'clean/parse_datetime'
+#completed: number of PIPELINE_STAGES finished so far, out of total
+#rows: rows parsed from the input file so far
+ProgressEvent = namedtuple('ProgressEvent', ['stage', 'completed', 'total', 'rows'])
+
+
+class Cancelled(Exception):
+    '''Raised inside the pipeline once its CancelToken is cancelled'''
+    pass
+
+
+class CancelToken():
+    '''Thread safe flag a running pipeline checks between stages and chunks
+    @function cancel: asks the pipeline to stop, can be called from any thread
+    @function check: raises Cancelled if cancel was called
+    '''
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    def is_cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise Cancelled('Processing was cancelled.')
+
+
+class ProgressReporter():
+    '''Instrumentation listener that reports each finished stage and stops the pipeline when cancelled
+    The token is checked whenever a stage ends and at every Instrumentation.checkpoint, which the pipeline
+    calls before each chunk it reads and between the charts and the pdf sections it renders.
+    @param callback: optional callable invoked as callback(ProgressEvent) after every stage
+    @param cancel_token: optional CancelToken checked after every stage and at every checkpoint
+    '''
+    def __init__(self, callback=None, cancel_token=None):
+        self.callback = callback
+        self.cancel_token = cancel_token
+        self.completed = 0
+        self.rows = 0
+
+    def checkpoint(self):
+        if self.cancel_token is not None:
+            self.cancel_token.check()
+
+    def __call__(self, name, record):
+        self.checkpoint()
+        if name == 'read_file' or name.endswith('/parse_datetime') or name.endswith('/read_tail'):
+            #these stages count the rows read from the file, accumulated over every chunk
+            self.rows = max(self.rows, record.get('rows', 0))
+        if name in PIPELINE_STAGES:
+            self.completed += 1
+        if self.callback is not None:
+            self.callback(ProgressEvent(name, self.completed, len(PIPELINE_STAGES), self.rows))
@@ -0,0 +1,77 @@
+import pandas as pd
+
+#resolutions the cleaned data is pre-aggregated at, finest first, as (name, pandas offset alias)
+PYRAMID_LEVELS = [('1min', 'T'), ('1h', 'H'), ('1d', 'D')]
+LEVEL_NAMES = [name for name, _ in PYRAMID_LEVELS]
+#level holding the hourly totals the regulatory averages are computed from
+HOURLY_LEVEL = '1h'
+#how each pre-aggregated statistic combines into a coarser bucket
+STAT_ROLLUPS = [('sum', 'sum'), ('count', 'sum'), ('min', 'min'), ('max', 'max')]
+
+def level_stat(level, stat):
+    '''Selects one statistic of a pyramid level
+
+    @param level: pyramid level DataFrame with 'stat:column' columns
+    @param stat: 'sum', 'count', 'min' or 'max'
+    @result DataFrame of that statistic with the original column names
+    '''
+    prefix = stat + ':'
+    columns = [col for col in level.columns if col.startswith(prefix)]
+    return level[columns].rename(columns=lambda col: col[len(prefix):])
+
+def coarsen(level, freq):
+    #combines the buckets of a level into coarser ones, each statistic the way it adds up
+    groups = level.groupby(level.index.floor(freq))
+    parts = []
+    for stat, how in STAT_ROLLUPS:
+        columns = [col for col in level.columns if col.startswith(stat + ':')]
+        parts.append(getattr(groups[columns], how)())
+    return pd.concat(parts, axis=1)
+
+def build_levels(df, stats=None, last=None):
+    '''Pre-aggregates cleaned data into tables at the PYRAMID_LEVELS resolutions
+
+    The finest level is built from the rows, every coarser one from the level below it. Each bucket only
+    depends on the rows that fall in it, so data split at day boundaries gives the same bits level by level.
+
+    @param df: cleaned data with a Datetime column
+    @param stats: names of the STAT_ROLLUPS statistics to build, all of them if not given
+    @param last: name of the coarsest level to build, all levels if not given
+    @result dict of level name to a DataFrame indexed by bucket start, with 'stat:column' columns
+    '''
+    if stats is None:
+        stats = [stat for stat, _ in STAT_ROLLUPS]
+    values = df.drop('Datetime', axis=1).select_dtypes(include='number').astype('float64')
+    groups = values.groupby(df['Datetime'].dt.floor(PYRAMID_LEVELS[0][1]).values)
+    level = pd.concat([getattr(groups, stat)().add_prefix(stat + ':') for stat in stats], axis=1)
+    levels = {PYRAMID_LEVELS[0][0]: level}
+    for name, freq in PYRAMID_LEVELS[1:]:
+        if last in levels:
+            break
+        level = coarsen(level, freq)
+        levels[name] = level
+    return levels
+
+def build_pyramid(df):
+    '''Pre-aggregates cleaned data into sum, count, min and max tables at every PYRAMID_LEVELS resolution
+
+    @param df: cleaned data with a Datetime column
+    @result dict of level name to a DataFrame indexed by bucket start, with 'stat:column' columns
+    '''
+    return build_levels(df)
+
+def pyramid_level(rate):
+    '''Finds the coarsest pyramid level whose buckets fit whole into the buckets of an averaging rate
+
+    @param rate: pandas offset alias from get_rate
+    @result level name, or None if the rate is finer than every level (e.g. seconds)
+    '''
+    offset = pd.tseries.frequencies.to_offset(rate)
+    if not isinstance(offset, pd.tseries.offsets.Tick):
+        #weeks, months and years are made of whole days
+        return PYRAMID_LEVELS[-1][0]
+    step = pd.Timedelta(offset)
+    for name, freq in reversed(PYRAMID_LEVELS):
+        if step % pd.Timedelta(pd.tseries.frequencies.to_offset(freq)) == pd.Timedelta(0):
+            return name
+    return None
@@ -0,0 +1,301 @@
+import csv
+import datetime
+import io
+import os
+from enum import Enum
+
+import pandas as pd
+
+from clean_utils import (AIR_EGG_COLUMNS, AIR_EGG_TIME_FORMAT,
+                         PURPLE_AIR_COLUMNS, PURPLE_AIR_TIME_FORMAT,
+                         clean_air_beam, clean_air_egg, clean_purple_air)
+from excel_utils import can_stream, read_sheet, sheet_headers
+
+#only the start of a file is read to detect its format
+SNIFF_BYTES = 4096
+#placeholders sensors write instead of a missing reading
+NA_VALUES = ['---']
+INVALID_FILE_MESSAGE = 'Invalid input file type. File must be an AirBeam, PurpleAir, or AirEgg dataset'
+
+
+class Sensor(Enum):
+    AIR_BEAM = 1
+    PURPLE_AIR = 2
+    AIR_EGG = 3
+    INVALID = 4
+
+
+class SensorFormat():
+    '''Sensor Format Class - describes how one sensor's export is detected, read and cleaned
+    Subclass it and pass an instance to register_format() to support a new sensor.
+    @attribute sensor: Sensor enum value
+    @attribute display_name: name used in the PDF report
+    @attribute folder_prefix: prefix of the output folder name
+    @attribute header_column: name of the first column of the export, used by sniff()
+    @attribute time_format: strftime format of the timestamps, None to let pandas infer it
+    @attribute streamable: whether the export can be cleaned in independent row chunks
+    @attribute columns: uniform names of every column of the export in file order, None to read it untyped
+    @attribute dtypes: dict of column name to the dtype it is read as, the Datetime strings are left to the cleaner
+    @attribute optional_columns: columns the report does not use, only read when all columns are requested
+    @attribute chronological: csv exports are written in time order, so a time window can be found
+        by binary search in the file (needs a time_format and a schema)
+    @function sniff: returns True if the parsed header row belongs to this format
+    @function read: reads the file (or one sheet of a spreadsheet) into a DataFrame (or an iterator of chunks)
+    @function read_rows: reads header-less csv rows through the schema
+    @function read_window: reads only the csv rows between two times
+    @function clean: renames the raw columns to the uniform names (Datetime, PM2.5, ...)
+    '''
+    sensor = Sensor.INVALID
+    display_name = ''
+    folder_prefix = ''
+    header_column = None
+    time_format = None
+    streamable = True
+    chronological = False
+    columns = None
+    dtypes = {}
+    optional_columns = []
+
+    def sniff(self, header):
+        return len(header) > 0 and header[0] == self.header_column
+
+    def used_columns(self, all_columns=False):
+        if all_columns:
+            return list(self.columns)
+        return [col for col in self.columns if col not in self.optional_columns]
+
+    def can_stream(self, filepath):
+        #csv files, and spreadsheets read through the schema, can be read in chunks
+        if os.path.splitext(filepath)[1].lower() == '.csv':
+            return self.streamable
+        return self.streamable and self.columns is not None and can_stream(filepath)
+
+    def read(self, filepath, chunksize=None, all_columns=False, sheet=None):
+        is_csv = os.path.splitext(filepath)[1].lower() == '.csv'
+        sheet_name = 0 if sheet is None else sheet
+        if self.columns is None:
+            if is_csv:
+                return pd.read_csv(filepath, chunksize=chunksize)
+            return pd.read_excel(filepath, sheet_name=sheet_name)
+        #the schema renames, prunes and types the columns while parsing, so clean_frame has nothing to coerce
+        usecols = self.used_columns(all_columns)
+        dtypes = dict((col, dtype) for col, dtype in self.dtypes.items() if col in usecols)
+        if is_csv:
+            return pd.read_csv(filepath, header=0, names=self.columns, usecols=usecols, dtype=dtypes,
+                               na_values=NA_VALUES, engine='c', chunksize=chunksize)
+        if can_stream(filepath):
+            return read_sheet(filepath, sheet, self.columns, usecols, dtypes, NA_VALUES, chunksize)
+        return pd.read_excel(filepath, sheet_name=sheet_name, header=0, names=self.columns, usecols=usecols,
+                             dtype=dtypes, na_values=NA_VALUES)
+
+    def read_rows(self, buffer, all_columns=False):
+        #reads csv rows without a header line (e.g. rows appended since an earlier run) through the schema
+        usecols = self.used_columns(all_columns)
+        dtypes = dict((col, dtype) for col, dtype in self.dtypes.items() if col in usecols)
+        return pd.read_csv(buffer, header=None, names=self.columns, usecols=usecols, dtype=dtypes,
+                           na_values=NA_VALUES, engine='c')
+
+    def can_read_window(self, filepath):
+        return (os.path.splitext(filepath)[1].lower() == '.csv' and self.chronological
+                and self.columns is not None and self.time_format is not None)
+
+    def line_time(self, line):
+        #timestamp of one raw csv line, the Datetime column comes first in every schema
+        field = line.decode('utf-8', errors='replace').split(',', 1)[0].strip().strip('"')
+        return datetime.datetime.strptime(field, self.time_format)
+
+    def read_window(self, filepath, start_time, stop_time, all_columns=False):
+        '''Reads the rows of a chronological csv export between two times (both inclusive)
+
+        The byte offsets of the first and last row are binary searched by parsing single lines,
+        so rows outside the window are never read or parsed.
+
+        @param start_time: python datetime of the start of the window
+        @param stop_time: python datetime of the end of the window
+        @result DataFrame of the rows in the window, or None if the window could not be located
+            (no rows in it, or timestamps that do not parse), the caller then reads the whole file
+        '''
+        with open(filepath, 'rb') as f:
+            f.readline()
+            data_start = f.tell()
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            try:
+                first = first_line_where(f, data_start, size, lambda line: self.line_time(line) >= start_time)
+                end = first_line_where(f, first, size, lambda line: self.line_time(line) > stop_time)
+            except ValueError:
+                return None
+            if first == end:
+                return None
+            f.seek(first)
+            window = f.read(end - first)
+        return self.read_rows(io.BytesIO(window), all_columns)
+
+    def clean(self, data_frame):
+        return data_frame
+
+    def is_clean(self, data_frame):
+        #frames read through the schema already carry the uniform names
+        return self.columns is not None and len(data_frame.columns) > 0 and data_frame.columns[0] == self.columns[0]
+
+
+class PurpleAirFormat(SensorFormat):
+    sensor = Sensor.PURPLE_AIR
+    display_name = 'Purple Air'
+    folder_prefix = 'Purple_Air'
+    header_column = 'created_at'
+    time_format = PURPLE_AIR_TIME_FORMAT
+    chronological = True
+    columns = PURPLE_AIR_COLUMNS
+    #read as float64, the precision the statistics are computed in
+    dtypes = {
+        'entry_id': 'float64',
+        'PM1.0': 'float64',
+        'PM2.5': 'float64',
+        'PM10.0': 'float64',
+        'UptimeMins': 'float64',
+        'RSSI_dbm': 'float64',
+        'Temperature': 'float64',
+        'Humidity': 'float64',
+        'Pm2.5_CF1': 'float64',
+    }
+    optional_columns = ['entry_id', 'UptimeMins', 'RSSI_dbm']
+
+    def clean(self, data_frame):
+        if self.is_clean(data_frame):
+            return data_frame
+        return clean_purple_air(data_frame)
+
+
+class AirEggFormat(SensorFormat):
+    sensor = Sensor.AIR_EGG
+    display_name = 'Air Egg'
+    folder_prefix = 'Air_Egg'
+    header_column = 'Timestamp'
+    time_format = AIR_EGG_TIME_FORMAT
+    chronological = True
+    columns = AIR_EGG_COLUMNS
+    #pressure, altitude, the SO2 voltage and the coordinates need more significant digits than float32 keeps
+    dtypes = {
+        'Temperature': 'float64',
+        'Humidity': 'float64',
+        'SO2[ppb]': 'float64',
+        'SO2[V]': 'float64',
+        'PM1.0': 'float64',
+        'PM2.5': 'float64',
+        'PM10.0': 'float64',
+        'Pressure': 'float64',
+        'Latitude': 'float64',
+        'Longitude': 'float64',
+        'Altitude': 'float64',
+    }
+
+    def clean(self, data_frame):
+        if self.is_clean(data_frame):
+            return data_frame
+        return clean_air_egg(data_frame)
+
+
+class AirBeamFormat(SensorFormat):
+    sensor = Sensor.AIR_BEAM
+    display_name = 'Air Beam'
+    folder_prefix = 'Air_Beam'
+    header_column = 'sensor:model'
+    #measurement blocks follow each other, so no chunk holds every measurement
+    streamable = False
+
+    def clean(self, data_frame):
+        return clean_air_beam(data_frame)
+
+
+def next_line_start(f, pos, lo):
+    #offset of the first line starting at or after pos, lo is known to be a line start
+    if pos == lo:
+        return lo
+    f.seek(pos - 1)
+    f.readline()
+    return f.tell()
+
+def first_line_where(f, lo, hi, predicate):
+    '''Binary searches the lines of a file for the first one a predicate holds for
+
+    @param f: file opened in binary mode
+    @param lo: offset of a line start, where the search begins
+    @param hi: offset where the search ends (the end of the file or a line start)
+    @param predicate: function of the raw line bytes that is False for every line before some line and True from it on
+    @result offset of the start of the first line the predicate holds for, hi if there is none
+    '''
+    found = hi
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = next_line_start(f, mid, lo)
+        if start >= hi:
+            hi = mid
+            continue
+        f.seek(start)
+        line = f.readline()
+        #blank trailing lines sort after every row
+        if not line.strip() or predicate(line):
+            found, hi = start, mid
+        else:
+            lo = start + len(line)
+    return found
+
+
+SENSOR_FORMATS = []
+
+def register_format(sensor_format):
+    #formats are tried in registration order, so register more specific formats first
+    SENSOR_FORMATS.append(sensor_format)
+    return sensor_format
+
+def get_format(sensor):
+    #looks up the registered format of a Sensor enum value
+    for sensor_format in SENSOR_FORMATS:
+        if sensor_format.sensor == sensor:
+            return sensor_format
+    raise ValueError('No format registered for ' + str(sensor))
+
+def match_header(header):
+    for sensor_format in SENSOR_FORMATS:
+        if sensor_format.sniff(header):
+            return sensor_format
+    raise ValueError(INVALID_FILE_MESSAGE)
+
+def read_header(filepath):
+    #returns the header row of a data file (the first sheet of a spreadsheet) without reading the rest of it
+    if os.path.splitext(filepath)[1].lower() != '.csv':
+        return sheet_headers(filepath)[0][1]
+    with open(filepath, 'rb') as f:
+        head = f.read(SNIFF_BYTES)
+    text = head.decode('utf-8-sig', errors='replace')
+    return next(csv.reader(io.StringIO(text)), [])
+
+def detect_format(filepath):
+    '''Finds the registered format of a data file from its first few KB
+
+    @param filepath: the path to the input file
+    @result SensorFormat instance, raises ValueError for unsupported files
+    '''
+    return detect_sheet(filepath)[0]
+
+def detect_sheet(filepath):
+    '''Finds the registered format of a data file and, for spreadsheets, the sheet holding the data
+
+    @param filepath: the path to the input file
+    @result tuple of (SensorFormat instance, sheet name or None for csv files),
+        raises ValueError for unsupported files
+    '''
+    if os.path.splitext(filepath)[1].lower() == '.csv':
+        return match_header(read_header(filepath)), None
+    #field spreadsheets often have notes or summary sheets, use the first sheet a format recognizes
+    for sheet, header in sheet_headers(filepath):
+        try:
+            return match_header(header), sheet
+        except ValueError:
+            continue
+    raise ValueError(INVALID_FILE_MESSAGE)
+
+register_format(AirBeamFormat())
+register_format(PurpleAirFormat())
+register_format(AirEggFormat())
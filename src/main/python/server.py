@@ -0,0 +1,498 @@
+'''Local HTTP API - submit analyses and fetch their results from other programs (e.g. a dashboard)
+
+    python server.py -o data_out --port 8765
+
+Endpoints (all answers are JSON, except the result files themselves):
+
+    POST /jobs?number=1&unit=Hours[&start=...&stop=...]&path=/data/Purple_air.csv   analyse a local file
+    POST /jobs?number=1&unit=Hours[&start=...&stop=...]&filename=Purple_air.csv     analyse the uploaded request body
+    GET  /jobs                          list every job
+    GET  /jobs/<id>                     status, output folder, error and result file names of one job
+    GET  /jobs/<id>/files/<name>        download a result file (summary.pdf, charts, csv files)
+    GET  /health                        worker and cache information
+
+POST answers 202 with the id of the job right away, the job runs in a worker process. Every file is
+always processed by the same worker, which keeps the cleaned data of the files it processed last in
+memory (FrameCache), so later jobs on the same file with other parameters skip reading and parsing it.
+The server only listens on 127.0.0.1 by default; --socket serves on a unix socket instead, and
+LocalClient talks to either without a network. Files can only be given by path when the server listens
+on a loopback address or a unix socket, or, with --data-root, when they are inside that folder. Finished jobs are forgotten after --job-ttl seconds, or
+sooner when more than --max-jobs have finished, and the uploads no remaining job uses are deleted then;
+their output folders are left in the output directory.
+'''
+import argparse
+import asyncio
+import hashlib
+import http.client
+import ipaddress
+import json
+import mimetypes
+import os
+import socket
+import sys
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
+
+from clean import VALID_EXTENSIONS, process_file_entry
+from cli import AD_UNITS, DEFAULT_HEADER
+from clean_utils import to_py_datetime
+from frame_cache_utils import DEFAULT_CACHE_MB, FrameCache
+
+UPLOAD_FOLDER = 'uploads'
+#uploads larger than this are refused, local files can be given by path instead
+MAX_UPLOAD_BYTES = 1 << 30
+STREAM_BLOCK = 1 << 16
+#finished jobs are kept this many seconds, and at most this many of them
+JOB_TTL = 24 * 3600
+MAX_JOBS = 1000
+#seconds between sweeps for expired jobs
+EXPIRE_INTERVAL = 60
+REASONS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+#FrameCache of the worker process, created by init_worker
+WORKER_CACHE = None
+
+def init_worker(cache_mb):
+    global WORKER_CACHE
+    WORKER_CACHE = FrameCache(cache_mb)
+
+def run_job(filepath, output_path, averaging_range, header, start_time, stop_time, use_cache):
+    #runs in a worker process, charts are rendered in the worker itself
+    entry = process_file_entry(filepath, output_path, averaging_range, header, start_time, stop_time,
+                               None, use_cache, False, False, 1, frame_cache=WORKER_CACHE)
+    entry['frame_cache'] = WORKER_CACHE.stats()
+    return entry
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class JobServer():
+    '''Job Server Class - accepts analysis jobs over HTTP and runs them in worker processes
+    @param output_path: output directory, each job gets its own output folder there and uploads are kept in uploads/
+    @param header: header image for the PDF reports
+    @param workers: number of worker processes, each with its own FrameCache
+    @param cache_mb: memory budget in MB of the cleaned frames each worker keeps
+    @param use_cache: also use the cleaned data cache on disk (see process_file)
+    @param job_ttl: seconds a finished job is kept before it is expired
+    @param max_jobs: number of finished jobs kept, the oldest are expired first
+    @param data_root: folder files given by path must be in, None to accept any file while local is True
+    @attribute local: whether the server only listens on this machine, set by serve_async
+    @attribute jobs: dict of job id to job dict (id, status, file, parameters, output, error, files, times)
+    @attribute finished: ids of the finished jobs in the order they finished, with the time.time() they finished
+    @function handle: asyncio connection handler serving one request
+    @function expire: forgets expired jobs and deletes the uploads no remaining job uses
+    '''
+    def __init__(self, output_path, header, workers=2, cache_mb=DEFAULT_CACHE_MB, use_cache=True, job_ttl=JOB_TTL,
+                 max_jobs=MAX_JOBS, data_root=None):
+        self.output_path = output_path
+        self.data_root = None if data_root is None else os.path.realpath(data_root)
+        self.local = True
+        self.header = header
+        self.use_cache = use_cache
+        self.job_ttl = job_ttl
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self.finished = OrderedDict()
+        self.tasks = set()
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        #one single process pool per worker, so a file always goes to the worker that has it cached
+        self.executors = [ProcessPoolExecutor(max_workers=1, initializer=init_worker, initargs=(cache_mb,))
+                          for _ in range(workers)]
+
+    def executor_for(self, filepath):
+        return self.executors[zlib.crc32(os.path.abspath(filepath).encode('utf-8')) % len(self.executors)]
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+
+    def expire(self, now):
+        #finished jobs past their ttl, and the oldest beyond max_jobs
+        expired = []
+        for job_id, finished in self.finished.items():
+            if finished > now - self.job_ttl and len(self.finished) - len(expired) <= self.max_jobs:
+                break
+            expired.append(job_id)
+        if not expired:
+            return
+        for job_id in expired:
+            del self.finished[job_id]
+        uploads = set(self.jobs.pop(job_id)['file'] for job_id in expired)
+        #an upload is shared by every job on the same contents, including running ones
+        uploads -= set(job['file'] for job in self.jobs.values())
+        upload_dir = os.path.abspath(os.path.join(self.output_path, UPLOAD_FOLDER))
+        for path in uploads:
+            if os.path.dirname(os.path.abspath(path)) == upload_dir and os.path.exists(path):
+                os.remove(path)
+
+    async def expire_jobs(self, interval=EXPIRE_INTERVAL):
+        #runs alongside the server for as long as it serves
+        while True:
+            self.expire(time.time())
+            await asyncio.sleep(interval)
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                method, target, headers = await read_request_head(reader)
+                await self.route(method, target, headers, reader, writer)
+            except HTTPError as e:
+                await send_json(writer, e.status, {'error': str(e)})
+            except (ValueError, KeyError) as e:
+                await send_json(writer, 400, {'error': str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            #the client went away
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, target, headers, reader, writer):
+        url = urlsplit(target)
+        parts = [unquote(p) for p in url.path.split('/') if p]
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        if method not in ('GET', 'POST') or (method == 'POST' and parts != ['jobs']):
+            raise HTTPError(405, 'Method not allowed')
+        if parts == ['health']:
+            await send_json(writer, 200, {'workers': len(self.executors), 'jobs': len(self.jobs),
+                                          'running': len([j for j in self.jobs.values() if j['status'] == 'running'])})
+        elif parts == ['jobs'] and method == 'GET':
+            await send_json(writer, 200, {'jobs': list(self.jobs.values())})
+        elif parts == ['jobs'] and method == 'POST':
+            job = await self.submit(query, headers, reader)
+            await send_json(writer, 202, job)
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            await send_json(writer, 200, self.job(parts[1]))
+        elif len(parts) == 4 and parts[0] == 'jobs' and parts[2] == 'files':
+            await send_file(writer, self.result_file(self.job(parts[1]), parts[3]))
+        else:
+            raise HTTPError(404, 'Not found')
+
+    def job(self, job_id):
+        if job_id not in self.jobs:
+            raise HTTPError(404, 'No job ' + job_id)
+        return self.jobs[job_id]
+
+    def result_file(self, job, name):
+        #only files listed in the job's own output folder can be fetched
+        if job['status'] != 'done' or name not in job['files']:
+            raise HTTPError(404, 'No result file ' + name)
+        return os.path.join(job['output'], name)
+
+    async def submit(self, query, headers, reader):
+        averaging_range, start_time, stop_time = job_parameters(query)
+        if 'path' in query:
+            filepath = self.local_file(query['path'])
+        else:
+            filepath = await self.store_upload(query, headers, reader)
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'running',
+            'file': filepath,
+            'averaging_range': list(averaging_range),
+            'start': None if start_time is None else str(start_time),
+            'stop': None if stop_time is None else str(stop_time),
+            'submitted': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'seconds': None,
+            'output': None,
+            'error': None,
+            'files': [],
+        }
+        self.jobs[job['id']] = job
+        task = asyncio.get_running_loop().create_task(self.run(job, filepath, averaging_range, start_time, stop_time))
+        #keep a reference until the job is done, the event loop only holds weak ones
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return job
+
+    def local_file(self, path):
+        #links are followed before the check, so they cannot point out of the data root
+        if self.data_root is not None:
+            filepath = os.path.realpath(path)
+            if os.path.commonpath([filepath, self.data_root]) != self.data_root:
+                raise HTTPError(403, 'Only files in the data root can be given by path, upload the file instead')
+        elif self.local:
+            filepath = path
+        else:
+            raise HTTPError(403, 'Files can only be given by path to a server listening on this machine or with a data root, upload the file instead')
+        if not os.path.isfile(filepath):
+            raise HTTPError(400, 'No such file: ' + path)
+        return filepath
+
+    async def store_upload(self, query, headers, reader):
+        '''Streams the request body into uploads/ under its content hash, so uploading the same file again
+        gives the same path (and hits the worker's FrameCache and the cleaned data cache)
+        '''
+        filename = os.path.basename(query.get('filename', ''))
+        extension = os.path.splitext(filename)[1].lower()
+        if extension not in VALID_EXTENSIONS:
+            raise HTTPError(400, 'Give the path of a local file, or upload a file with a filename ending in ' + ', '.join(VALID_EXTENSIONS))
+        length = int(headers.get('content-length', 0))
+        if length <= 0:
+            raise HTTPError(400, 'The upload is empty')
+        if length > MAX_UPLOAD_BYTES:
+            raise HTTPError(413, 'The upload is too large, give the path of the file instead')
+        upload_dir = os.path.join(self.output_path, UPLOAD_FOLDER)
+        os.makedirs(upload_dir, exist_ok=True)
+        tmp_path = os.path.join(upload_dir, '{}.tmp'.format(uuid.uuid4().hex))
+        digest = hashlib.sha256()
+        try:
+            with open(tmp_path, 'wb') as f:
+                remaining = length
+                while remaining:
+                    block = await reader.readexactly(min(STREAM_BLOCK, remaining))
+                    digest.update(block)
+                    f.write(block)
+                    remaining -= len(block)
+            path = os.path.join(upload_dir, digest.hexdigest()[:32] + extension)
+            if os.path.exists(path):
+                #keep the existing copy, and with it its modification time
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+    async def run(self, job, filepath, averaging_range, start_time, stop_time):
+        loop = asyncio.get_running_loop()
+        try:
+            entry = await loop.run_in_executor(self.executor_for(filepath), run_job, filepath, self.output_path,
+                                               averaging_range, self.header, start_time, stop_time, self.use_cache)
+        except Exception as e:
+            #the worker process itself died, process_file_entry reports every other error in the entry
+            entry = {'output': None, 'error': str(e), 'seconds': None}
+        job['output'] = entry['output']
+        job['error'] = entry['error']
+        job['seconds'] = entry['seconds']
+        job['frame_cache'] = entry.get('frame_cache')
+        if entry['error'] is None:
+            job['files'] = sorted(fn for fn in os.listdir(entry['output'])
+                                  if os.path.isfile(os.path.join(entry['output'], fn)))
+            job['status'] = 'done'
+        else:
+            job['status'] = 'failed'
+        self.finished[job['id']] = time.time()
+        self.expire(time.time())
+
+
+def job_parameters(query):
+    #averaging range and time window of a job from its query string, validated like the cli arguments
+    try:
+        number = int(query['number'])
+    except (KeyError, ValueError):
+        raise HTTPError(400, 'number must be given as a positive whole number')
+    if number <= 0:
+        raise HTTPError(400, 'number must be given as a positive whole number')
+    if query.get('unit') not in AD_UNITS:
+        raise HTTPError(400, 'unit must be one of ' + ', '.join(AD_UNITS))
+    start, stop = query.get('start'), query.get('stop')
+    if (start is None) != (stop is None):
+        raise HTTPError(400, 'start and stop must be given together')
+    if start is not None:
+        try:
+            start, stop = to_py_datetime(start), to_py_datetime(stop)
+        except ValueError as e:
+            raise HTTPError(400, 'invalid time range: ' + str(e))
+        if start > stop:
+            raise HTTPError(400, 'stop cannot be before start')
+    return (number, query['unit']), start, stop
+
+async def read_request_head(reader):
+    #request line and headers of an HTTP/1.x request, header names lower cased
+    line = await reader.readline()
+    try:
+        method, target, _ = line.decode('latin-1').split()
+    except ValueError:
+        raise HTTPError(400, 'Malformed request line')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return method.upper(), target, headers
+
+async def send_head(writer, status, content_type, length, extra_headers=()):
+    lines = ['HTTP/1.1 {} {}'.format(status, REASONS.get(status, '')),
+             'Content-Type: ' + content_type,
+             'Content-Length: ' + str(length),
+             'Connection: close']
+    lines.extend(extra_headers)
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    await writer.drain()
+
+async def send_json(writer, status, data):
+    body = json.dumps(data, indent=2).encode('utf-8')
+    await send_head(writer, status, 'application/json', len(body))
+    writer.write(body)
+    await writer.drain()
+
+async def send_file(writer, path):
+    #streamed in blocks, so large pdfs and csv files are never held in memory whole
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    disposition = "Content-Disposition: attachment; filename*=UTF-8''" + quote(os.path.basename(path))
+    await send_head(writer, 200, content_type, os.path.getsize(path), [disposition])
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(STREAM_BLOCK), b''):
+            writer.write(block)
+            await writer.drain()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class LocalClient():
+    '''Local Client Class - calls a JobServer on this machine, over a unix socket or 127.0.0.1
+    @param port: port the server listens on
+    @param socket_path: unix socket the server listens on instead, no network is used then
+    @function submit: starts a job on a local file (path) or on uploaded bytes, returns the job dict
+    @function job: returns the job dict
+    @function wait: polls a job until it is done or failed
+    @function download: streams a result file to a local path
+    '''
+    def __init__(self, port=8765, socket_path=None, timeout=60):
+        self.port = port
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def connection(self):
+        if self.socket_path is not None:
+            return UnixHTTPConnection(self.socket_path, self.timeout)
+        return http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None):
+        conn = self.connection()
+        try:
+            conn.request(method, path, body=body)
+            response = conn.getresponse()
+            data = json.loads(response.read().decode('utf-8'))
+        finally:
+            conn.close()
+        if response.status >= 400:
+            raise ValueError('{} {}: {}'.format(response.status, path, data.get('error')))
+        return data
+
+    def submit(self, averaging_range, path=None, data=None, filename=None, start_time=None, stop_time=None):
+        query = {'number': averaging_range[0], 'unit': averaging_range[1]}
+        if start_time is not None:
+            query.update({'start': str(start_time), 'stop': str(stop_time)})
+        if path is not None:
+            query['path'] = os.path.abspath(path)
+        else:
+            query['filename'] = filename
+        return self.request('POST', '/jobs?' + urlencode(query), data)
+
+    def job(self, job_id):
+        return self.request('GET', '/jobs/' + job_id)
+
+    def wait(self, job_id, poll_interval=0.5):
+        while True:
+            job = self.job(job_id)
+            if job['status'] != 'running':
+                return job
+            time.sleep(poll_interval)
+
+    def download(self, job_id, name, outpath):
+        conn = self.connection()
+        try:
+            conn.request('GET', '/jobs/{}/files/{}'.format(job_id, quote(name)))
+            response = conn.getresponse()
+            if response.status != 200:
+                raise ValueError('{}: {}'.format(response.status, response.read().decode('utf-8')))
+            with open(outpath, 'wb') as f:
+                for block in iter(lambda: response.read(STREAM_BLOCK), b''):
+                    f.write(block)
+        finally:
+            conn.close()
+        return outpath
+
+
+async def serve_async(job_server, host='127.0.0.1', port=8765, socket_path=None, ready=None):
+    '''Serves the job server until the task running it is cancelled
+
+    @param ready: optional callable invoked with the asyncio Server once it listens (e.g. to read the port
+        it was given when port is 0)
+    '''
+    job_server.local = socket_path is not None or is_loopback(host)
+    if socket_path is not None:
+        server = await asyncio.start_unix_server(job_server.handle, path=socket_path)
+    else:
+        server = await asyncio.start_server(job_server.handle, host, port)
+    expiry = asyncio.get_running_loop().create_task(job_server.expire_jobs())
+    if ready is not None:
+        ready(server)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        expiry.cancel()
+
+def is_loopback(host):
+    #only addresses, and localhost, are trusted to be loopback, names may resolve to anything
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def serve(job_server, host='127.0.0.1', port=8765, socket_path=None):
+    '''Serves the job server until interrupted'''
+    asyncio.run(serve_async(job_server, host, port, socket_path))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Local HTTP API for submitting air quality analyses and fetching their results.')
+    parser.add_argument('-o', '--output', default='data_out', help='output directory (default: ./data_out)')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on (default: 8765)')
+    parser.add_argument('--socket', help='listen on this unix socket instead of a port')
+    parser.add_argument('--data-root', help='only accept files given by path inside this folder (needed to give paths to a server on a non-loopback --host)')
+    parser.add_argument('--header', default=DEFAULT_HEADER, help='header image for the PDF reports')
+    parser.add_argument('--workers', type=int, default=2, help='number of worker processes (default: 2)')
+    parser.add_argument('--cache-mb', type=float, default=DEFAULT_CACHE_MB, help='memory each worker may use to keep cleaned files, in MB (default: {})'.format(DEFAULT_CACHE_MB))
+    parser.add_argument('--no-cache', action='store_true', help='do not use the cleaned data cache on disk')
+    parser.add_argument('--job-ttl', type=float, default=JOB_TTL, help='seconds finished jobs and their uploads are kept (default: {})'.format(JOB_TTL))
+    parser.add_argument('--max-jobs', type=int, default=MAX_JOBS, help='finished jobs kept at most, the oldest are forgotten first (default: {})'.format(MAX_JOBS))
+    args = parser.parse_args(argv)
+    if args.workers <= 0 or args.cache_mb <= 0:
+        parser.error('--workers and --cache-mb must be positive')
+    if args.job_ttl <= 0 or args.max_jobs <= 0:
+        parser.error('--job-ttl and --max-jobs must be positive')
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    job_server = JobServer(args.output, args.header, args.workers, args.cache_mb, not args.no_cache, args.job_ttl,
+                           args.max_jobs, args.data_root)
+    print('Serving on {}'.format(args.socket or '{}:{}'.format(args.host, args.port)), file=sys.stderr)
+    try:
+        serve(job_server, args.host, args.port, args.socket)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        job_server.shutdown()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,268 @@
 import os
+from collections import namedtuple
+
+import numpy as np
 import pandas as pd
 
-def basic_stats(df, output_folder):
-    stats = df.describe()
-    stats = round(stats, 2)
+from clean_utils import sampling_profile
+from pyramid_utils import HOURLY_LEVEL, build_levels, level_stat
+
+Standard = namedtuple('Standard', ['organization', 'pollutant', 'column', 'period', 'window', 'value', 'unit'])
+
+#air quality standards checked by above_threshold_stats, in report order
+#window is the averaging period the standard is defined on: 'H' hourly, 'D' 24 hour (calendar day), 'A' annual
+#standards for a column the data file does not have are skipped
+STANDARDS = [
+    Standard('WHO', 'PM 2.5', 'PM2.5', '24 Hour', 'D', 25, 'ug/m^3'),
+    Standard('WHO', 'PM 2.5', 'PM2.5', 'Annual Primary', 'A', 10, 'ug/m^3'),
+    Standard('WHO', 'PM 10.0', 'PM10.0', '24 Hour', 'D', 50, 'ug/m^3'),
+    Standard('WHO', 'PM 10.0', 'PM10.0', 'Annual Primary', 'A', 20, 'ug/m^3'),
+    Standard('NAAQS', 'PM 2.5', 'PM2.5', '24 Hour', 'D', 35, 'ug/m^3'),
+    Standard('NAAQS', 'PM 2.5', 'PM2.5', 'Annual Primary', 'A', 12, 'ug/m^3'),
+    Standard('NAAQS', 'PM 2.5', 'PM2.5', 'Annual Secondary', 'A', 15, 'ug/m^3'),
+    Standard('NAAQS', 'PM 10.0', 'PM10.0', '24 Hour', 'D', 150, 'ug/m^3'),
+    Standard('NAAQS', 'SO2', 'SO2[ppb]', '1 Hour', 'H', 75, 'ppb'),
+]
+
+#data capture needed for an average to count, as in the NAAQS 75% completeness requirement
+COMPLETENESS = 0.75
+WINDOW_NAMES = {'H': 'hours', 'D': 'days', 'A': 'years'}
+
+#rows of general_statistics.csv, in DataFrame.describe order
+SUMMARY_ROWS = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+QUARTILES = [0.25, 0.5, 0.75]
+
+#values are summarized in blocks of this many, in stream order, so a summary does not depend on how
+#its stream was chunked - a file read whole and read in chunks gives the same bits
+BLOCK_SIZE = 1 << 16
+
+def nonnan(values):
+    values = np.asarray(values, dtype=float)
+    return values[~np.isnan(values)]
+
+class QuantileSketch():
+    '''KLL quantile sketch - keeps a bounded sample of a stream of values in levels of doubling weight
+    Values are compacted a block of BLOCK_SIZE at a time. Quantiles are exact (same as pandas) until a
+    block was compacted, after that the rank error stays within a few tenths of a percent of the count
+    for the default k.
+    @param k: number of values kept at the top level
+    @attribute n: number of values added
+    @function update: adds an array of values, NaN values are ignored
+    @function merge: adds the values summarized by another sketch (e.g. of another file or process)
+    @function quantiles: returns the approximate quantiles of everything added so far
+    '''
+    def __init__(self, k=2048):
+        self.k = k
+        self.n = 0
+        #values of the block being filled
+        self.pending = np.empty(0)
+        self.levels = [np.empty(0)]
+        #which half of a sorted level is promoted alternates, so compactions do not bias the ranks
+        self.flips = [0]
+
+    def capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(int(np.ceil(self.k * (2.0 / 3) ** depth)), 8)
+
+    def update(self, values):
+        values = nonnan(values)
+        self.n += len(values)
+        self.pending = np.concatenate([self.pending, values])
+        full = len(self.pending) // BLOCK_SIZE * BLOCK_SIZE
+        for start in range(0, full, BLOCK_SIZE):
+            self.levels[0] = np.concatenate([self.levels[0], self.pending[start:start + BLOCK_SIZE]])
+            self.compress()
+        self.pending = self.pending[full:]
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+            self.flips.append(0)
+        for level, values in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self.n += other.n - len(other.pending)
+        self.compress()
+        self.update(other.pending)
+
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                    self.flips.append(0)
+                values = np.sort(self.levels[level])
+                #every other value moves up a level with twice the weight, an odd one out stays
+                odd = len(values) % 2
+                promoted = values[odd + self.flips[level]::2]
+                self.flips[level] ^= 1
+                self.levels[level] = values[:odd]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+
+    def quantiles(self, qs):
+        if self.n == 0:
+            return np.full(len(qs), np.nan)
+        if self.n == len(self.pending):
+            #nothing was compacted yet, interpolate like pandas does
+            return np.percentile(self.pending, np.multiply(qs, 100))
+        #the block being filled counts with weight one, like the lowest level
+        levels = [np.concatenate([self.levels[0], self.pending])] + self.levels[1:]
+        values = np.concatenate(levels)
+        weights = np.concatenate([np.full(len(v), 2.0 ** level) for level, v in enumerate(levels)])
+        order = np.argsort(values, kind='mergesort')
+        ranks = np.cumsum(weights[order])
+        positions = np.searchsorted(ranks, np.multiply(qs, ranks[-1]), side='left')
+        return values[order][np.minimum(positions, len(values) - 1)]
+
+def block_moments(values):
+    #(count, mean, sum of squared deviations, min, max) of an array without NaN values
+    if len(values) == 0:
+        return (0, 0.0, 0.0, np.nan, np.nan)
+    mean = values.mean()
+    return (len(values), mean, ((values - mean) ** 2).sum(), values.min(), values.max())
+
+def combine_moments(a, b):
+    #Chan's parallel update of two block_moments tuples
+    if b[0] == 0:
+        return a
+    if a[0] == 0:
+        return b
+    count = a[0] + b[0]
+    delta = b[1] - a[1]
+    return (count, a[1] + delta * b[0] / count, a[2] + b[2] + delta * delta * a[0] * b[0] / count,
+            np.fmin(a[3], b[3]), np.fmax(a[4], b[4]))
+
+class Moments():
+    '''Count, mean, sum of squared deviations, min and max of a stream of values
+    Blocks of BLOCK_SIZE values are combined with Welford's (Chan's parallel) update in stream order,
+    so the moments of a stream do not depend on how it was chunked.
+    @function update: adds an array of values, NaN values are ignored
+    @function merge: adds the values summarized by another Moments
+    @function result: returns the (count, mean, m2, min, max) tuple of everything added
+    '''
+    def __init__(self):
+        self.moments = block_moments(np.empty(0))
+        self.pending = np.empty(0)
+
+    def update(self, values):
+        self.pending = np.concatenate([self.pending, nonnan(values)])
+        full = len(self.pending) // BLOCK_SIZE * BLOCK_SIZE
+        for start in range(0, full, BLOCK_SIZE):
+            self.moments = combine_moments(self.moments, block_moments(self.pending[start:start + BLOCK_SIZE]))
+        self.pending = self.pending[full:]
+
+    def merge(self, other):
+        self.moments = combine_moments(self.moments, other.moments)
+        self.update(other.pending)
+
+    def result(self):
+        return combine_moments(self.moments, block_moments(self.pending))
+
+class SummaryStats():
+    '''Mergeable replacement for DataFrame.describe over the numeric columns of a data set
+    Count, mean and variance come from Moments, min and max directly, and the quartiles from a
+    QuantileSketch, so chunks, files or processes can each summarize their rows and only the summaries
+    are merged.
+    @attribute columns: numeric column names, in the order they were first seen
+    @function add: folds the numeric columns of a DataFrame into the statistics
+    @function merge: folds another SummaryStats into this one
+    @function describe: returns the statistics laid out like DataFrame.describe
+    '''
+    def __init__(self):
+        self.columns = []
+        self.moments = {}
+        self.sketches = {}
+
+    def init_column(self, col):
+        self.columns.append(col)
+        self.moments[col] = Moments()
+        self.sketches[col] = QuantileSketch()
+
+    def add(self, df):
+        for col in df.select_dtypes(include='number').columns:
+            if col not in self.moments:
+                self.init_column(col)
+            values = nonnan(df[col].values)
+            self.moments[col].update(values)
+            self.sketches[col].update(values)
+
+    def merge(self, other):
+        for col in other.columns:
+            if col not in self.moments:
+                self.init_column(col)
+            self.moments[col].merge(other.moments[col])
+            self.sketches[col].merge(other.sketches[col])
+
+    def describe(self):
+        stats = {}
+        for col in self.columns:
+            n, mean, m2, low, high = self.moments[col].result()
+            mean = mean if n else np.nan
+            std = np.sqrt(m2 / (n - 1)) if n > 1 else np.nan
+            stats[col] = [n, mean, std, low] + list(self.sketches[col].quantiles(QUARTILES)) + [high]
+        return pd.DataFrame(stats, index=SUMMARY_ROWS, columns=self.columns)
+
+class BoxStats():
+    '''Streaming counterpart of the statistics a boxplot is drawn from (matplotlib's boxplot_stats)
+    Quartiles come from a QuantileSketch, and the k lowest and highest values are kept, which holds every
+    outlier and the whisker ends exactly unless a tail has more than k outliers.
+    @param k: number of values kept at each end
+    @function update: adds an array of values, NaN values are ignored
+    @function stats: returns the dict Axes.bxp draws a box from
+    '''
+    def __init__(self, k=4096):
+        self.k = k
+        self.moments = Moments()
+        self.sketch = QuantileSketch()
+        self.low = np.empty(0)
+        self.high = np.empty(0)
+
+    def update(self, values):
+        values = nonnan(values)
+        if len(values) == 0:
+            return
+        self.moments.update(values)
+        self.sketch.update(values)
+        low = np.concatenate([self.low, values])
+        high = np.concatenate([self.high, values])
+        self.low = np.partition(low, self.k)[:self.k] if len(low) > self.k else low
+        self.high = np.partition(high, len(high) - self.k)[-self.k:] if len(high) > self.k else high
+
+    def stats(self, label, whis=1.5):
+        q1, med, q3 = self.sketch.quantiles(QUARTILES)
+        iqr = q3 - q1
+        n, mean = self.moments.result()[:2]
+        stats = {'label': label, 'mean': mean if n else np.nan, 'med': med, 'q1': q1, 'q3': q3}
+        #the whisker ends at the most extreme value within whis IQRs of the box, as in boxplot_stats
+        inside = self.high[self.high <= q3 + whis * iqr]
+        stats['whishi'] = max(inside.max(), q3) if len(inside) else q3
+        inside = self.low[self.low >= q1 - whis * iqr]
+        stats['whislo'] = min(inside.min(), q1) if len(inside) else q1
+        fliers = np.concatenate([self.low[self.low < stats['whislo']], self.high[self.high > stats['whishi']]])
+        stats['fliers'] = np.unique(fliers)
+        return stats
+
+def write_summary(stats, outpath):
+    stats = round(stats.describe(), 2)
     if "entry_id" in stats.columns:
         stats = stats.drop("entry_id", axis=1)
-    fn = 'general_statistics.csv'
-    outpath = os.path.join(output_folder, fn)
     stats.to_csv(outpath)
     return outpath
 
+def basic_stats(df, output_folder, summary=None):
+    '''Writes general_statistics.csv, the count, mean, std, min, quartiles and max of every numeric column
+
+    @param df: data as reported
+    @param summary: SummaryStats already holding df, e.g. merged from chunks; built from df if not given
+    @result path of general_statistics.csv
+    '''
+    if summary is None:
+        summary = SummaryStats()
+        summary.add(df)
+    fn = 'general_statistics.csv'
+    return write_summary(summary, os.path.join(output_folder, fn))
+
 def extra_stats(df, output_path):
     #returns 95th percentile
     ucl = df.mean() + 2 * df.std()
@@ -31,41 +283,137 @@ def extra_stats(df, output_path):
     stats_frame.to_csv(os.path.join(output_path, stats_name))
     return stats_name
 
-def above_threshold_stats(df, output_folder):
-
-    PM25_24HR_WHO = 25
-    PM25_ANNUAL_PRIMARY_WHO = 10
-    PM10_24HR_WHO = 50
-    PM10_ANNUAL_PRIMARY_WHO = 20
-
-    PM25_24HR_NAAQS = 35
-    PM25_ANNUAL_PRIMARY_NAAQS = 12
-    PM25_ANNUAL_SECONDARY_NAAQS = 15
-    PM10_24HR_NAAQS = 150
-
-    w22 = len(df[df['PM2.5'] >= PM25_24HR_WHO])
-    w2a = len(df[df['PM2.5'] >= PM25_ANNUAL_PRIMARY_WHO])
-    w102 = len(df[df['PM10.0'] >= PM10_24HR_WHO])
-    w10a = len(df[df['PM10.0'] >= PM10_ANNUAL_PRIMARY_WHO])
-
-    n22 = len(df[df['PM2.5'] >= PM25_24HR_NAAQS])
-    n2a = len(df[df['PM2.5'] >= PM25_ANNUAL_PRIMARY_NAAQS])
-    n2as = len(df[df['PM2.5'] >= PM25_ANNUAL_SECONDARY_NAAQS])
-    n102 = len(df[df['PM10.0'] >= PM10_24HR_NAAQS])
-
-    total = len(df.index)
-
-    row0 = ['', '', '', 'Threshold Value', 'Samples Above', 'Percent Above']
-    row1 = ['WHO', 'PM 2.5', '24 Hour', '25 ug/m^3', str(w22), "{:.2f}%".format(w22/total * 100)]
-    row2 = ['', '', 'Annual Primary', '35 ug/m^3', str(w2a), "{:.2f}%".format(w2a/total * 100)]
-    row3 = ['', 'PM 10.0', '24 Hour', '50 ug/m^3', str(w102), "{:.2f}%".format(w102/total * 100)]
-    row4 = ['', '', 'Annual Primary', '20 ug/m^3', str(w10a), "{:.2f}%".format(w10a/total * 100)]
-    row5 = ['NAAQS', 'PM 2.5', '24 Hour', '35 ug/m^3', str(n22), "{:.2f}%".format(n22/total * 100)]
-    row6 = ['', '', 'Annual Primary', '12 ug/m^3', str(n2a), "{:.2f}%".format(n2a/total * 100)]
-    row7 = ['', '', 'Annual Secondary', '15 ug/m^3', str(n2as), "{:.2f}%".format(n2as/total * 100)]
-    row8 = ['', 'PM 10.0', '24 Hour', '150 ug/m^3', str(n102), "{:.2f}%".format(n102/total * 100)]
-
-    rows = [row0, row1, row2, row3, row4, row5, row6, row7, row8]
+def count_at_or_above(values, thresholds):
+    '''Counts the values >= each threshold with one sort and a binary search per threshold
+
+    @param values: pandas Series or array of samples, NaN samples are never counted
+    @param thresholds: list of threshold values
+    @result numpy array of counts, one per threshold
+    '''
+    values = np.asarray(values, dtype=float)
+    values = np.sort(values[~np.isnan(values)])
+    return len(values) - np.searchsorted(values, thresholds, side='left')
+
+def sample_counts(df, standards=STANDARDS):
+    '''Counts the samples at or above every standard of a column df has, the counts of chunks add up
+
+    @result dict of Standard to number of samples
+    '''
+    counts = {}
+    pollutants = [s.column for s in standards]
+    #one pass per pollutant regardless of how many standards it has
+    for column in sorted(set(pollutants), key=pollutants.index):
+        if column not in df.columns:
+            continue
+        col_standards = [s for s in standards if s.column == column]
+        counts.update(zip(col_standards, count_at_or_above(df[column], [s.value for s in col_standards])))
+    return counts
+
+def hourly_totals(df):
+    '''Per clock hour sums and counts of every numeric column, summed minute by minute like the pyramid
+    and ResampleAccumulator.totals, so every read path gets the same hourly averages
+
+    @param df: cleaned (not resampled) data with a Datetime column
+    @result tuple of (sums, counts) DataFrames indexed by the start of each hour
+    '''
+    level = build_levels(df, ['sum', 'count'], HOURLY_LEVEL)[HOURLY_LEVEL]
+    return level_stat(level, 'sum'), level_stat(level, 'count')
+
+def window_sums(values, valid, window):
+    #trailing window sums and valid counts at every position from one pass of cumulative sums
+    value_sums = np.cumsum(np.where(valid, values, 0.0))
+    valid_counts = np.cumsum(valid)
+    value_sums[window:] = value_sums[window:] - value_sums[:-window]
+    valid_counts[window:] = valid_counts[window:] - valid_counts[:-window]
+    return value_sums, valid_counts
+
+def period_means(sums, counts, interval):
+    '''Regulatory averages of one column from its hourly totals
+
+    An hour is complete when it holds at least 75% of the samples the nominal sampling interval puts in an hour.
+    A 24 hour average needs 18 complete hours and covers one calendar day, found from the
+    rolling 24 hour window ending at 23:00. A quarter is complete when 75% of its days have a 24 hour average,
+    and an annual average is the mean of the four quarterly means of a year whose quarters are all complete.
+
+    @param sums: Series of hourly sums indexed by hour
+    @param counts: Series of hourly sample counts indexed by hour
+    @param interval: nominal sampling interval in seconds (SamplingProfile.median_interval),
+        NaN when there are too few samples to tell, then any sample completes an hour
+    @result dict of window ('H', 'D', 'A') to a Series of complete period means
+    '''
+    counts = counts[counts > 0]
+    expected = 3600.0 / interval if interval > 0 else 1.0
+    complete = counts >= COMPLETENESS * max(expected, 1.0)
+    hourly = (sums[counts.index] / counts)[complete]
+    if len(hourly) == 0:
+        return dict((window, pd.Series(dtype=float)) for window in WINDOW_NAMES)
+
+    #lay the hours on a gapless grid of whole days so every 24th window is one calendar day
+    grid = pd.date_range(hourly.index.min().normalize(), hourly.index.max().normalize() + pd.Timedelta(hours=23), freq='H')
+    values = hourly.reindex(grid).values
+    day_sums, day_counts = window_sums(values, ~np.isnan(values), 24)
+    day_ends = np.arange(23, len(grid), 24)
+    day_complete = day_counts[day_ends] >= COMPLETENESS * 24
+    daily = pd.Series(day_sums[day_ends][day_complete] / day_counts[day_ends][day_complete],
+                      index=grid[day_ends - 23][day_complete])
+
+    annual = pd.Series(dtype=float)
+    if len(daily) > 0:
+        by_quarter = daily.groupby(daily.index.to_period('Q'))
+        quarter_counts = by_quarter.count()
+        quarters = quarter_counts.index
+        quarter_days = (quarters.end_time - quarters.start_time).days + 1
+        quarterly = by_quarter.mean()[quarter_counts.values >= COMPLETENESS * quarter_days.values]
+        by_year = quarterly.groupby(quarterly.index.year)
+        annual = by_year.mean()[by_year.count() == 4]
+    return {'H': hourly, 'D': daily, 'A': annual}
+
+def above_threshold_stats(df, output_folder, standards=STANDARDS, totals=None, samples=None, profile=None):
+    '''Counts samples at or above every standard, and the complete hourly, 24 hour or annual
+    averages above it (the period the standard is actually defined on)
+
+    @param df: data as reported, used for the sample counts
+    @param totals: tuple of hourly (sums, counts) from hourly_totals over the cleaned, not resampled, data;
+        computed from df if not given
+    @param samples: tuple of (number of rows, sample_counts) of the reported rows, for reports whose rows
+        were streamed rather than kept in df; computed from df if not given
+    @param profile: SamplingProfile of the cleaned data, its nominal interval decides which hours are complete;
+        computed from df if not given
+    @result list of table rows, also written to threshold_stats.csv
+    '''
+    if totals is None:
+        totals = hourly_totals(df)
+    if samples is None:
+        samples = (len(df.index), sample_counts(df, standards))
+    if profile is None:
+        profile = sampling_profile(df['Datetime'])
+    sums, counts = totals
+    total, counted = samples
+    means = {}
+    for column in set(s.column for s in counted):
+        if column in sums.columns:
+            means[column] = period_means(sums[column], counts[column], profile.median_interval)
+
+    rows = [['', '', '', 'Threshold Value', 'Samples Above', 'Percent Above', 'Averages Above', 'Complete Averages']]
+    last_org = None
+    last_pollutant = None
+    for standard in standards:
+        if standard not in counted:
+            continue
+        above = int(counted[standard])
+        percent = above/total * 100 if total else 0
+        period = means.get(standard.column, {}).get(standard.window, pd.Series(dtype=float))
+        periods_above = int(count_at_or_above(period, [standard.value])[0])
+        window_name = WINDOW_NAMES[standard.window]
+        #organization and pollutant are only written on the first row of their group, like a merged cell
+        org = standard.organization if standard.organization != last_org else ''
+        pollutant = standard.pollutant if org or standard.pollutant != last_pollutant else ''
+        last_org = standard.organization
+        last_pollutant = standard.pollutant
+        value = '{:g} {}'.format(standard.value, standard.unit)
+        rows.append([org, pollutant, standard.period, value, str(above), "{:.2f}%".format(percent),
+                     '{} {}'.format(periods_above, window_name), '{} {}'.format(len(period), window_name)])
+
     df = pd.DataFrame(rows)
     df.to_csv(os.path.join(output_folder, 'threshold_stats.csv'), index=False)
 
@@ -74,4 +422,9 @@ def above_threshold_stats(df, output_folder):
     #      |          |               |  Threshold value  |  Num above  |  Percent above
     # WHO  |  PM 2.5  |      24 HR    |     25 ug/m^3     |    32       |    6%
     #      |          | Annual Primary|     35 ug/m^3     |    234      |    3%
-    #      |  PM 10.0 |      24 HR    |
\ No newline at end of file
+    #      |  PM 10.0 |      24 HR    |
+
+def read_threshold_table(path):
+    '''Reads back the table rows above_threshold_stats wrote, for a report made from a stored threshold_stats.csv'''
+    #the first line of the file holds the DataFrame column numbers, every cell is kept as the text written
+    return pd.read_csv(path, dtype=str, keep_default_na=False).values.tolist()
@@ -1,38 +1,162 @@
 import os
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from concurrent.futures.process import BrokenProcessPool
 
-def boxplot(df, output_folder):
-    #simple version, only makes the 4 boxplots every dataset has in common
-    fig, (ax1, ax2, ax3, ax4) = plt.subplots(1, 4)
+#object oriented Agg API only - pyplot keeps every figure in global state until it is closed
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
+import pandas as pd
+
+#columns the charts read, only these are sent to the rendering processes
+CHART_COLUMNS = ['Datetime', 'Temperature', 'Humidity', 'PM2.5', 'PM10.0']
+#columns drawn in boxplot, with their labels
+BOXPLOT_COLUMNS = [('Temperature', 'Temperature'), ('Humidity', 'Humidity'), ('PM2.5', 'PM 2.5'), ('PM10.0', 'PM 10.0')]
+#time slices ChartReducer keeps the extremes of, twice the pixel width of the time series charts
+REDUCE_BUCKETS = 2000
+
+def new_figure(**kwargs):
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+def save_figure(fig, outpath, **kwargs):
+    #figures are not registered anywhere, so each one is freed when its chart function returns
+    fig.savefig(outpath, **kwargs)
+    return outpath
+
+def m4_indices(x, y, n_buckets, start=None, end=None):
+    '''M4 decimation - keeps the first, last, min and max sample of each of n_buckets equal time slices,
+    which draws the same line as the full series at a width of n_buckets pixels
+
+    @param x: sorted int64 array (datetime64 nanoseconds)
+    @param y: float array, NaN samples are kept at the start of each gap so the line still breaks there
+    @param start: optional int64 start of the slices, for a part of a longer series (which is always decimated);
+        the first sample if not given
+    @param end: optional int64 end of the slices; the last sample if not given
+    @result sorted array of indices to plot, or None if the series is already small enough
+    '''
+    missing = np.isnan(y)
+    valid = np.flatnonzero(~missing)
+    if start is None and len(valid) <= 4 * n_buckets:
+        return None
+    gaps = np.flatnonzero(missing & ~np.r_[True, missing[:-1]])
+    if len(valid) == 0:
+        return gaps
+    xv = x[valid]
+    yv = y[valid]
+    start = xv[0] if start is None else start
+    end = xv[-1] if end is None else end
+    span = float(end - start) + 1
+    bins = ((xv - start) / span * n_buckets).astype(np.int64)
+    #bins never decrease, so each bucket is one contiguous run
+    starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    ends = np.r_[starts[1:] - 1, len(bins) - 1]
+    counts = np.diff(np.r_[starts, len(bins)])
+    extremes = [starts, ends]
+    for reduce_func in (np.minimum, np.maximum):
+        #first position in each bucket whose value equals the bucket's min (max)
+        hits = np.flatnonzero(yv == np.repeat(reduce_func.reduceat(yv, starts), counts))
+        extremes.append(hits[np.r_[True, bins[hits][1:] != bins[hits][:-1]]])
+    keep = np.unique(np.concatenate(extremes))
+    return np.union1d(valid[keep], gaps)
+
+def plot_series(ax, x, y, **kwargs):
+    #plots a time series decimated to roughly the pixel width of the figure, peaks are preserved
+    n_buckets = int(ax.figure.get_figwidth() * ax.figure.dpi)
+    idx = m4_indices(x.values.view('int64'), y.values.astype(float), n_buckets)
+    if idx is not None:
+        x = x.iloc[idx]
+        y = y.iloc[idx]
+    return ax.plot(x, y, **kwargs)
+
+class ChartReducer():
+    '''Keeps the rows of streamed chunks that the time series charts draw - the M4 samples of every chart
+    column on one grid of REDUCE_BUCKETS slices over the whole time range - so a report on every cleaned
+    row draws the same lines without holding the rows
+    @param start: earliest time of the series
+    @param end: latest time of the series
+    @function add: keeps the drawn rows of a chunk sorted by Datetime
+    @function result: returns the kept rows as one frame sorted by Datetime
+    @function extend: moves the end of the slices later, for rows appended after the first ones
+    '''
+    def __init__(self, start, end):
+        self.start = pd.Timestamp(start).value
+        self.end = pd.Timestamp(end).value
+        self.parts = []
+        self.missing = {}
+
+    def add(self, chunk):
+        if len(chunk.index) == 0:
+            return
+        x = chunk['Datetime'].values.view('int64')
+        keep = [np.array([0, len(chunk.index) - 1])]
+        for col in CHART_COLUMNS[1:]:
+            if col not in chunk.columns:
+                continue
+            y = chunk[col].values.astype(float)
+            idx = m4_indices(x, y, REDUCE_BUCKETS, self.start, self.end)
+            if self.missing.get(col) is False and np.isnan(y[0]):
+                #a gap starting right at the chunk boundary still breaks the line
+                idx = np.union1d(idx, [0])
+            keep.append(idx)
+            self.missing[col] = bool(np.isnan(y[-1]))
+        rows = np.unique(np.concatenate(keep))
+        self.parts.append(chunk.iloc[rows][[col for col in CHART_COLUMNS if col in chunk.columns]])
+
+    def result(self):
+        df = pd.concat(self.parts, ignore_index=True)
+        #chunks of a file that is not in time order overlap
+        return df.sort_values(by='Datetime', kind='mergesort').reset_index(drop=True)
+
+    def extend(self, end):
+        '''Covers rows up to end as well, for a series that was appended to, and reduces the kept rows again
+        The slices double in width until they reach end, so each new slice is a pair of old ones and the
+        extremes kept for the old slices hold those of the new ones.
+        '''
+        end = pd.Timestamp(end).value
+        span = self.end - self.start + 1
+        while self.start + span - 1 < end:
+            span *= 2
+        self.end = self.start + span - 1
+        if self.parts:
+            rows = self.result()
+            self.parts = []
+            self.missing = {}
+            self.add(rows)
+
+def boxplot(df, output_folder, box_stats=None):
+    '''simple version, only makes the 4 boxplots every dataset has in common
+    @param box_stats: optional dict of column to stat_utils.BoxStats, for reports whose rows were streamed
+        rather than kept in df
+    '''
+    fig = new_figure()
+    axes = fig.subplots(1, 4)
     #fig.suptitle('Air Beam', fontsize=20)
-    dat = [df['Temperature'].dropna()]
-    ax1.boxplot(dat, labels = ['Temperature'], vert = True)
-    dat = [df['Humidity'].dropna()]
-    ax2.boxplot(dat, labels = ['Humidity'], vert = True)
-    dat = [df['PM2.5'].dropna()]
-    ax3.boxplot(dat, labels = ['PM 2.5'], vert = True)
-    dat = [df['PM10.0'].dropna()]
-    ax4.boxplot(dat, labels = ['PM 10.0'], vert = True)
+    for ax, (col, label) in zip(axes, BOXPLOT_COLUMNS):
+        if box_stats is not None:
+            ax.bxp([box_stats[col].stats(label)], vert = True)
+        else:
+            dat = [df[col].dropna()]
+            ax.boxplot(dat, labels = [label], vert = True)
     fig.subplots_adjust(wspace=0.5)
     outpath = os.path.join(output_folder, 'boxplot.png')
-    fig.savefig(outpath)
-    return outpath
+    return save_figure(fig, outpath)
 
 def humidity_graph(df, output_folder):
-    plt.close()
-    _, axarr = plt.subplots(2, figsize=[10,8], sharex = True)
-    axarr[0].plot(df['Datetime'], df['PM2.5'], label='PM 2.5')
-    axarr[0].plot(df['Datetime'], df['PM10.0'], label='PM 10.0', linestyle="--")
+    fig = new_figure(figsize=[10,8])
+    axarr = fig.subplots(2, sharex = True)
+    plot_series(axarr[0], df['Datetime'], df['PM2.5'], label='PM 2.5')
+    plot_series(axarr[0], df['Datetime'], df['PM10.0'], label='PM 10.0', linestyle="--")
     axarr[0].legend()
     axarr[0].set_title('Particulate Matter and Humidity')
-    axarr[1].plot(df['Datetime'], df['Humidity'], label='Humidity (percent)')
+    plot_series(axarr[1], df['Datetime'], df['Humidity'], label='Humidity (percent)')
     axarr[1].legend()
     fn = 'humidity_graph.png'
     outpath = os.path.join(output_folder, fn)
-    plt.savefig(outpath, dpi='figure')
-    return outpath
+    return save_figure(fig, outpath, dpi='figure')
 
 def threshold_PM25(df, output_folder):
     PM25_ANNUAL_PRIMARY_WHO = 10
@@ -41,8 +165,9 @@ def threshold_PM25(df, output_folder):
     PM25_24HR_WHO = 25
     PM25_24HR_NAAQS = 35
 
-    _, axarr = plt.subplots(1, figsize=[10,8], sharex = True)
-    axarr.plot(df['Datetime'], df['PM2.5'], label='PM 2.5')
+    fig = new_figure(figsize=[10,8])
+    axarr = fig.subplots(1, sharex = True)
+    plot_series(axarr, df['Datetime'], df['PM2.5'], label='PM 2.5')
 
     axarr.hlines(PM25_ANNUAL_PRIMARY_WHO, df['Datetime'][0], df['Datetime'].tail(1), color='#800080', linestyles='--', label='WHO Annual Primary')
     axarr.text(df['Datetime'].tail(1), PM25_ANNUAL_PRIMARY_WHO + 0.2,'WHO AP')
@@ -60,16 +185,16 @@ def threshold_PM25(df, output_folder):
 
     fn = 'pm25_graph.png'
     outpath = os.path.join(output_folder, fn)
-    plt.savefig(outpath, dpi='figure')
-    return outpath
+    return save_figure(fig, outpath, dpi='figure')
 
 def threshold_PM10(df, output_folder):
     PM10_24HR_WHO = 50
     PM10_ANNUAL_PRIMARY_WHO = 20
     PM10_24HR_NAAQS = 150
 
-    _, axarr = plt.subplots(1, figsize=[10,8], sharex = True)
-    axarr.plot(df['Datetime'], df['PM10.0'], label='PM 10.0')
+    fig = new_figure(figsize=[10,8])
+    axarr = fig.subplots(1, sharex = True)
+    plot_series(axarr, df['Datetime'], df['PM10.0'], label='PM 10.0')
 
     axarr.hlines(PM10_ANNUAL_PRIMARY_WHO, df['Datetime'][0], df['Datetime'].tail(1), color='#006400', linestyles='--', label='WHO Annual Primary')
     axarr.text(df['Datetime'].tail(1), PM10_ANNUAL_PRIMARY_WHO + 0.5,'WHO AP')
@@ -83,5 +208,63 @@ def threshold_PM10(df, output_folder):
 
     fn = 'pm10_graph.png'
     outpath = os.path.join(output_folder, fn)
-    plt.savefig(outpath, dpi='figure')
-    return outpath
+    return save_figure(fig, outpath, dpi='figure')
+
+#file_dict key and chart function of every chart in the report
+CHARTS = [
+    ('boxplot', boxplot),
+    ('humidity_graph', humidity_graph),
+    ('PM25_thresh', threshold_PM25),
+    ('PM10_thresh', threshold_PM10),
+]
+
+def render_charts(df, output_folder, max_workers=1, names=None, box_stats=None, checkpoint=None):
+    '''Renders every chart in CHARTS, concurrently in worker processes when max_workers allows it
+    The pool only lives for this call. Starting it costs about as much as rendering the charts of a typical
+    report, so rendering in this process is the default.
+
+    @param max_workers: number of rendering processes, None for one per chart; 1 renders in this process
+    @param names: optional file_dict keys of the charts to render, the rest are skipped
+    @param box_stats: passed to boxplot
+    @param checkpoint: optional callable invoked between charts, e.g. Instrumentation.checkpoint, which may raise
+        to stop rendering
+    @result dict of file_dict key to chart path
+    '''
+    charts = [(key, func) for key, func in CHARTS if names is None or key in names]
+    if box_stats is not None:
+        charts = [(key, partial(func, box_stats=box_stats) if func is boxplot else func) for key, func in charts]
+    if not charts:
+        return {}
+    if max_workers is None:
+        max_workers = min(len(charts), multiprocessing.cpu_count())
+    #daemonic processes (e.g. older batch pool workers) cannot start children of their own
+    if max_workers <= 1 or multiprocessing.current_process().daemon:
+        return render_in_process(df, output_folder, charts, checkpoint)
+
+    df = df[[col for col in CHART_COLUMNS if col in df.columns]]
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = [(key, pool.submit(func, df, output_folder)) for key, func in charts]
+            try:
+                results = {}
+                for key, future in futures:
+                    results[key] = future.result()
+                    if checkpoint is not None:
+                        checkpoint()
+                return results
+            except BaseException:
+                #charts that have not started are dropped, the pool only waits for the ones being drawn
+                for _, future in futures:
+                    future.cancel()
+                raise
+    except BrokenProcessPool:
+        #a rendering process died, render here instead
+        return render_in_process(df, output_folder, charts, checkpoint)
+
+def render_in_process(df, output_folder, charts, checkpoint=None):
+    results = {}
+    for key, func in charts:
+        if checkpoint is not None:
+            checkpoint()
+        results[key] = func(df, output_folder)
+    return results
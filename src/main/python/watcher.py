@@ -0,0 +1,319 @@
+'''Inbox watcher - processes sensor files as they are dropped into a folder, without anyone opening the app
+
+    python watcher.py inbox -n 1 -u Hours -o data_out --workers 2
+
+polls the inbox folder, waits until a new file has stopped changing (it may still be being copied),
+skips files whose contents were already processed, and runs process_file on the rest in a pool of worker
+processes. Every file gets its own output folder in the output directory, like a run from the app.
+watcher_status.json in the output directory is rewritten after every poll with the queue depth,
+throughput and latency, and watcher_processed.json remembers the content hash of every processed file
+so a restarted watcher does not process them again. Files that fail are kept in watcher_failed.json
+instead and retried after a backoff that doubles with every attempt, until --max-attempts is reached.
+Stop it with Ctrl+C or SIGTERM, running files are finished first.
+'''
+import argparse
+import json
+import os
+import signal
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from cache_utils import file_hash
+from clean import VALID_EXTENSIONS, process_file_entry
+from cli import AD_UNITS, DEFAULT_HEADER
+
+STATUS_NAME = 'watcher_status.json'
+PROCESSED_NAME = 'watcher_processed.json'
+FAILED_NAME = 'watcher_failed.json'
+#attempts at a failing file before it is given up on, and seconds before its first retry (doubled after every failure)
+MAX_ATTEMPTS = 5
+RETRY_SECONDS = 60
+#files finished within this many seconds count towards the throughput and latency in the status file
+METRICS_WINDOW = 3600
+#most recent results listed in the status file
+RECENT_RESULTS = 20
+
+def write_json(path, data):
+    #write to a temporary name first so readers of the status file never see half of it
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+def is_data_file(filename):
+    #hidden files and the lock files spreadsheet programs leave next to open workbooks are never data
+    if filename.startswith('.') or filename.startswith('~$'):
+        return False
+    return os.path.splitext(filename)[1].lower() in VALID_EXTENSIONS
+
+class InboxWatcher():
+    '''Inbox Watcher Class - finds settled new files in an inbox folder and processes them in worker processes
+    @param inbox: folder to watch, sub folders are not searched
+    @param output_path: output directory, each file gets its own output folder there
+    @param averaging_range: tuple containing integer then string indicating time to average values over
+    @param header: header image for the PDF reports
+    @param workers: number of worker processes
+    @param max_pending: number of files submitted to the pool at once, further settled files wait in the
+        queue (as paths only) until one finishes, defaults to twice the workers
+    @param settle_seconds: a file is processed once its size and modification time have not changed for this long
+    @param chunksize: passed to process_file
+    @param use_cache: passed to process_file
+    @param max_attempts: times a failing file is processed before it is given up on
+    @param retry_seconds: wait before the first retry of a failed file, doubled after every further failure
+    @attribute candidates: dict of path to ((size, mtime), time that signature was first seen, time the file was first seen)
+    @attribute queue: settled files waiting for a free slot in the pool, as (path, signature, time first seen)
+    @attribute running: dict of future to (path, content hash, time first seen, (size, mtime) signature)
+    @attribute known: dict of path to the signature it had when it was handled, so unchanged files are not hashed again
+    @attribute processed: dict of content hash to the result of the file with those contents, failures excluded
+    @attribute failures: dict of content hash to the last error, the number of attempts and the time of the
+        next retry of a file that failed, an unchanged file is retried from there (a changed one is new contents)
+    @function poll: scans the inbox once, submits what it can and writes the status file
+    @function run: polls until stopped
+    '''
+    def __init__(self, inbox, output_path, averaging_range, header, workers=2, max_pending=None, settle_seconds=10,
+                 chunksize=None, use_cache=True, max_attempts=MAX_ATTEMPTS, retry_seconds=RETRY_SECONDS):
+        self.inbox = inbox
+        self.output_path = output_path
+        self.averaging_range = averaging_range
+        self.header = header
+        self.workers = workers
+        self.max_pending = max_pending if max_pending is not None else 2 * workers
+        self.settle_seconds = settle_seconds
+        self.chunksize = chunksize
+        self.use_cache = use_cache
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.candidates = {}
+        self.queue = deque()
+        self.running = {}
+        self.known = {}
+        self.finished = deque()
+        self.recent = deque(maxlen=RECENT_RESULTS)
+        self.counts = {'processed': 0, 'failed': 0, 'duplicates': 0}
+        self.started = time.time()
+        self.stopping = False
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        self.processed = self.load_processed()
+        self.failures = self.load_json(FAILED_NAME)
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    def load_json(self, name):
+        try:
+            with open(os.path.join(self.output_path, name)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def load_processed(self):
+        #earlier versions recorded failures here as well, those files are processed again
+        processed = self.load_json(PROCESSED_NAME)
+        return dict((digest, entry) for digest, entry in processed.items() if entry.get('error') is None)
+
+    def scan(self, now):
+        #moves files whose signature has not changed for settle_seconds from the candidates to the queue
+        queued = set(path for path, _, _ in self.queue)
+        seen = set()
+        for filename in sorted(os.listdir(self.inbox)):
+            if not is_data_file(filename):
+                continue
+            path = os.path.join(self.inbox, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                #removed between listing and stat
+                continue
+            signature = (st.st_size, st.st_mtime)
+            seen.add(path)
+            if self.known.get(path) == signature or path in queued:
+                continue
+            candidate = self.candidates.get(path)
+            if candidate is None or candidate[0] != signature:
+                #new, or still being written, (re)start its settle timer
+                self.candidates[path] = (signature, now, now if candidate is None else candidate[2])
+            elif now - candidate[1] >= self.settle_seconds:
+                del self.candidates[path]
+                self.queue.append((path, signature, candidate[2]))
+        for path in list(self.candidates):
+            if path not in seen:
+                del self.candidates[path]
+        for path in list(self.known):
+            if path not in seen:
+                del self.known[path]
+
+    def retry(self, now):
+        #queues unchanged failed files again once their backoff is over
+        waiting = set(path for path, _, _ in self.queue) | set(path for path, _, _, _ in self.running.values())
+        for failure in self.failures.values():
+            path = failure['file']
+            if failure['attempts'] >= self.max_attempts or failure['retry_at'] > now or path in waiting:
+                continue
+            if self.known.get(path) == tuple(failure['signature']):
+                self.queue.append((path, self.known[path], now))
+                waiting.add(path)
+
+    def submit(self, now):
+        #fills the free slots of the pool, this is the backpressure: nothing more is hashed or submitted while it is full
+        running_digests = set(digest for _, digest, _, _ in self.running.values())
+        while self.queue and len(self.running) < self.max_pending and not self.stopping:
+            path, signature, detected = self.queue.popleft()
+            try:
+                digest = file_hash(path)
+            except (IOError, OSError):
+                continue
+            self.known[path] = signature
+            if digest in self.processed or digest in running_digests:
+                #the same contents were uploaded again, possibly under another name
+                self.counts['duplicates'] += 1
+                continue
+            failure = self.failures.get(digest)
+            if failure is not None and (failure['attempts'] >= self.max_attempts or failure['retry_at'] > now):
+                #given up on, or seen again (e.g. after a restart) before its backoff is over, retry queues it then
+                failure['file'], failure['signature'] = path, list(signature)
+                continue
+            future = self.executor.submit(process_file_entry, path, self.output_path, self.averaging_range, self.header,
+                                          None, None, self.chunksize, self.use_cache, False, False, 1)
+            self.running[future] = (path, digest, detected, signature)
+            running_digests.add(digest)
+
+    def collect(self, timeout):
+        '''Waits up to timeout seconds for running files to finish and records their results'''
+        if not self.running:
+            time.sleep(timeout)
+            return
+        done, _ = wait(list(self.running), timeout=timeout, return_when=FIRST_COMPLETED)
+        now = time.time()
+        failures_changed = False
+        for future in done:
+            path, digest, detected, signature = self.running.pop(future)
+            try:
+                entry = future.result()
+            except Exception as e:
+                #the worker process itself died, process_file_entry reports every other error in the entry
+                entry = {'file': path, 'output': None, 'error': str(e)}
+            latency = now - detected
+            self.finished.append((now, latency, signature[0]))
+            self.recent.append({'file': path, 'output': entry['output'], 'error': entry['error'],
+                                'latency_seconds': round(latency, 3)})
+            if entry['error'] is None:
+                self.counts['processed'] += 1
+                self.processed[digest] = {'file': path, 'output': entry['output'], 'error': None}
+                if self.failures.pop(digest, None) is not None:
+                    failures_changed = True
+                continue
+            self.counts['failed'] += 1
+            failures_changed = True
+            attempts = self.failures.get(digest, {}).get('attempts', 0) + 1
+            self.failures[digest] = {'file': path, 'signature': list(signature), 'error': entry['error'],
+                                     'attempts': attempts, 'retry_at': now + self.retry_seconds * 2 ** (attempts - 1)}
+            if attempts >= self.max_attempts:
+                print('Giving up on {} after {} attempts: {}'.format(path, attempts, entry['error']), file=sys.stderr)
+        if done:
+            write_json(os.path.join(self.output_path, PROCESSED_NAME), self.processed)
+        if failures_changed:
+            write_json(os.path.join(self.output_path, FAILED_NAME), self.failures)
+
+    def status(self, now):
+        while self.finished and self.finished[0][0] < now - METRICS_WINDOW:
+            self.finished.popleft()
+        latencies = sorted(latency for _, latency, _ in self.finished)
+        window = min(METRICS_WINDOW, max(now - self.started, 1))
+        status = {
+            'inbox': os.path.abspath(self.inbox),
+            'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+            'updated': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)),
+            'stopping': self.stopping,
+            'settling': len(self.candidates),
+            'queued': len(self.queue),
+            'running': len(self.running),
+            'queue_depth': len(self.queue) + len(self.running),
+            'workers': self.workers,
+            'max_pending': self.max_pending,
+            'retrying': sum(1 for failure in self.failures.values() if failure['attempts'] < self.max_attempts),
+            'given_up': sum(1 for failure in self.failures.values() if failure['attempts'] >= self.max_attempts),
+            'files_per_hour': round(len(latencies) * 3600 / window, 2),
+            'mb_per_hour': round(sum(size for _, _, size in self.finished) * 3600 / window / (1024 * 1024), 2),
+            'latency_seconds': None,
+            'recent': list(self.recent),
+        }
+        status.update(self.counts)
+        if latencies:
+            status['latency_seconds'] = {
+                'mean': round(sum(latencies) / len(latencies), 3),
+                'median': round(latencies[len(latencies) // 2], 3),
+                'max': round(latencies[-1], 3),
+            }
+        return status
+
+    def poll(self):
+        now = time.time()
+        self.scan(now)
+        self.retry(now)
+        self.submit(now)
+        write_json(os.path.join(self.output_path, STATUS_NAME), self.status(now))
+
+    def idle(self):
+        #failed files waiting out their backoff do not keep a run with once going
+        return not self.candidates and not self.queue and not self.running
+
+    def stop(self, *args):
+        #also the SIGTERM handler, the loop finishes the running files and exits
+        self.stopping = True
+
+    def run(self, poll_interval=5, once=False):
+        '''Polls the inbox until stop is called (or, with once, until the files already there are processed)'''
+        try:
+            while not self.stopping:
+                self.poll()
+                if once and self.idle():
+                    break
+                self.collect(poll_interval)
+        except KeyboardInterrupt:
+            self.stopping = True
+        while self.running:
+            self.collect(poll_interval)
+        self.executor.shutdown()
+        write_json(os.path.join(self.output_path, STATUS_NAME), self.status(time.time()))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Watch a folder and automatically process the sensor data files dropped into it.')
+    parser.add_argument('inbox', help='folder to watch')
+    parser.add_argument('-n', '--number', type=int, required=True, help='averaging duration, as a whole number of units')
+    parser.add_argument('-u', '--unit', choices=AD_UNITS, required=True, help='averaging duration unit')
+    parser.add_argument('-o', '--output', default='data_out', help='output directory (default: ./data_out)')
+    parser.add_argument('--header', default=DEFAULT_HEADER, help='header image for the PDF reports')
+    parser.add_argument('--chunksize', type=int, help='stream csv files in chunks of this many rows')
+    parser.add_argument('--no-cache', action='store_true', help='always re-parse input files')
+    parser.add_argument('--workers', type=int, default=2, help='number of files processed in parallel (default: 2)')
+    parser.add_argument('--max-pending', type=int, help='files handed to the workers at once (default: twice the workers)')
+    parser.add_argument('--poll', type=float, default=5, help='seconds between scans of the inbox (default: 5)')
+    parser.add_argument('--settle', type=float, default=10, help='seconds a file must stay unchanged before it is processed (default: 10)')
+    parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS, help='times a failing file is processed before it is given up on (default: {})'.format(MAX_ATTEMPTS))
+    parser.add_argument('--retry-seconds', type=float, default=RETRY_SECONDS, help='seconds before a failed file is retried, doubled after every further failure (default: {})'.format(RETRY_SECONDS))
+    parser.add_argument('--once', action='store_true', help='process the files already in the inbox and exit')
+    args = parser.parse_args(argv)
+
+    if args.number <= 0:
+        parser.error('averaging duration must be a positive whole number')
+    if args.workers <= 0 or (args.max_pending is not None and args.max_pending <= 0):
+        parser.error('--workers and --max-pending must be positive')
+    if args.max_attempts <= 0 or args.retry_seconds < 0:
+        parser.error('--max-attempts must be positive and --retry-seconds cannot be negative')
+    if not os.path.isdir(args.inbox):
+        parser.error('inbox is not a folder: ' + args.inbox)
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    watcher = InboxWatcher(args.inbox, args.output, (args.number, args.unit), args.header, args.workers,
+                           args.max_pending, args.settle, args.chunksize, not args.no_cache, args.max_attempts,
+                           args.retry_seconds)
+    signal.signal(signal.SIGTERM, watcher.stop)
+    print('Watching {} (status in {})'.format(args.inbox, os.path.join(args.output, STATUS_NAME)), file=sys.stderr)
+    watcher.run(args.poll, args.once)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
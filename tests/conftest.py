@@ -0,0 +1,48 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src', 'main', 'python'))
+
+DATA_DIR = os.path.join(ROOT, 'data')
+HEADER = os.path.join(ROOT, 'src', 'main', 'resources', 'base', 'ATSDR-logo.png')
+PURPLE_AIR_HEADER = ['created_at', 'entry_id', 'PM1.0_CF_ATM_ug/m3', 'PM2.5_CF_ATM_ug/m3', 'PM10.0_CF_ATM_ug/m3',
+                     'UptimeMinutes', 'RSSI_dbm', 'Temperature_F', 'Humidity_%', 'PM2.5_CF_1_ug/m3']
+
+def purple_air_frame(rows, interval=80, start='2018-08-09 00:00:17', seed=0):
+    '''Synthetic PurpleAir export with two decimal readings every interval seconds'''
+    rng = np.random.RandomState(seed)
+    times = pd.date_range(start, periods=rows, freq='{}S'.format(interval))
+    pm25 = np.round(rng.gamma(2.0, 8.0, rows), 2)
+    return pd.DataFrame({
+        'created_at': times.strftime('%Y-%m-%d %H:%M:%S UTC'),
+        'entry_id': np.arange(rows) + 6524,
+        'PM1.0_CF_ATM_ug/m3': np.round(pm25 * 0.7, 2),
+        'PM2.5_CF_ATM_ug/m3': pm25,
+        'PM10.0_CF_ATM_ug/m3': np.round(pm25 * 1.1 + rng.uniform(0, 3, rows), 2),
+        'UptimeMinutes': np.arange(rows) + 968,
+        'RSSI_dbm': rng.randint(-70, -50, rows),
+        'Temperature_F': rng.randint(60, 95, rows),
+        'Humidity_%': rng.randint(20, 90, rows),
+        'PM2.5_CF_1_ug/m3': pm25,
+    }, columns=PURPLE_AIR_HEADER)
+
+@pytest.fixture(autouse=True)
+def disk_cache(tmp_path, monkeypatch):
+    '''Keeps the disk cache of every test in its own folder instead of the user's'''
+    path = str(tmp_path / 'disk_cache')
+    monkeypatch.setenv('AQA_DISK_CACHE_DIR', path)
+    return path
+
+@pytest.fixture
+def purple_air_csv(tmp_path):
+    '''Writes a synthetic PurpleAir csv, keyword arguments go to purple_air_frame'''
+    def write(name='purple_air.csv', **kwargs):
+        path = str(tmp_path / name)
+        purple_air_frame(**kwargs).to_csv(path, index=False)
+        return path
+    return write
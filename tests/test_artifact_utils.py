@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from conftest import HEADER
+from artifact_utils import ARTIFACT_FOLDER, REPORT_ARTIFACTS
+from clean import process_file
+from data_file import Data_File
+
+def read_bytes(folder, name):
+    with open(os.path.join(folder, name), 'rb') as f:
+        return f.read()
+
+@pytest.fixture
+def reads(monkeypatch):
+    #number of times the data file is read
+    calls = []
+    original = Data_File.read_file
+    def read_file(self, filepath, chunksize=None):
+        calls.append(filepath)
+        return original(self, filepath, chunksize)
+    monkeypatch.setattr(Data_File, 'read_file', read_file)
+    return calls
+
+def run(path, folder, artifact_dir, artifacts=None):
+    return Data_File(path, folder, (1, 'Hours'), HEADER, render_workers=1, artifacts=artifacts, artifact_dir=artifact_dir)
+
+def test_unchanged_outputs_are_reused_and_the_pdf_rebuilt(purple_air_csv, tmp_path, reads):
+    path = purple_air_csv(rows=2000)
+    artifact_dir = str(tmp_path / 'artifacts')
+    first = run(path, str(tmp_path / 'first'), artifact_dir)
+    assert len(reads) == 1
+    second = run(path, str(tmp_path / 'second'), artifact_dir)
+    #every output but the pdf comes from the store, and the pdf is made from them without the data
+    assert len(reads) == 1
+    assert second.build == ['pdf']
+    for name in ['cleaned_data.csv', 'general_statistics.csv', 'threshold_stats.csv', 'boxplot.png']:
+        assert read_bytes(second.output_folder, name) == read_bytes(first.output_folder, name)
+    assert os.path.getsize(second.file_dict['pdf']) > 0
+
+def test_changed_contents_with_the_same_size_and_mtime_are_rebuilt(purple_air_csv, tmp_path, reads):
+    path = purple_air_csv(rows=2000)
+    artifact_dir = str(tmp_path / 'artifacts')
+    first = run(path, str(tmp_path / 'first'), artifact_dir, ['cleaned_data'])
+    #one PM2.5 reading of the last row gets another first digit, the file keeps its size and modification time
+    st = os.stat(path)
+    with open(path, 'rb') as f:
+        lines = f.read().split(b'\n')
+    fields = lines[-2].split(b',')
+    fields[3] = str((int(fields[3][:1]) + 5) % 10).encode() + fields[3][1:]
+    lines[-2] = b','.join(fields)
+    with open(path, 'wb') as f:
+        f.write(b'\n'.join(lines))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert os.path.getsize(path) == st.st_size
+    second = run(path, str(tmp_path / 'second'), artifact_dir, ['cleaned_data'])
+    assert second.build == ['cleaned_data']
+    assert len(reads) == 2
+    fresh = run(path, str(tmp_path / 'fresh'), None, ['cleaned_data'])
+    assert read_bytes(second.output_folder, 'cleaned_data.csv') == read_bytes(fresh.output_folder, 'cleaned_data.csv')
+    assert read_bytes(second.output_folder, 'cleaned_data.csv') != read_bytes(first.output_folder, 'cleaned_data.csv')
+
+def test_partial_requests_share_the_store(purple_air_csv, tmp_path, reads):
+    path = purple_air_csv(rows=2000)
+    artifact_dir = str(tmp_path / 'artifacts')
+    partial = run(path, str(tmp_path / 'partial'), artifact_dir, ['threshold_stats'])
+    assert partial.build == ['threshold_stats']
+    assert sorted(os.listdir(partial.output_folder)) == ['threshold_stats.csv', 'timings.json']
+    full = run(path, str(tmp_path / 'full'), artifact_dir)
+    assert 'threshold_stats' not in full.build and 'cleaned_data' in full.build
+    assert sorted(full.file_dict) == sorted(REPORT_ARTIFACTS + ['timings'])
+    reads[:] = []
+    #general_statistics.csv is made from the stored summary, the file is not read again
+    stats = run(path, str(tmp_path / 'stats'), artifact_dir, ['basic_stats'])
+    assert stats.build == [] and reads == []
+    assert read_bytes(stats.output_folder, 'general_statistics.csv') == read_bytes(full.output_folder, 'general_statistics.csv')
+
+def test_reuse_is_opt_in(purple_air_csv, tmp_path, disk_cache):
+    path = purple_air_csv(rows=500)
+    process_file(path, str(tmp_path / 'output'), (1, 'Hours'), HEADER, artifacts=['threshold_stats'])
+    assert not os.path.exists(os.path.join(disk_cache, ARTIFACT_FOLDER))
+    process_file(path, str(tmp_path / 'output'), (1, 'Hours'), HEADER, artifacts=['threshold_stats'], reuse_artifacts=True)
+    assert os.listdir(os.path.join(disk_cache, ARTIFACT_FOLDER))
@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from artifact_utils import ArtifactStore, artifact_keys
+from cache_utils import (cache_available, load_clean_cache, load_pyramid, prune_cache, store_clean_cache,
+                         store_pyramid)
+from pyramid_utils import build_pyramid
+from clean import process_file
+from conftest import HEADER
+
+def write_entry(folder, name, size, mtime):
+    path = os.path.join(folder, name)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+def test_prune_drops_least_recently_used_first(tmp_path):
+    folder = str(tmp_path)
+    os.makedirs(os.path.join(folder, 'ab'))
+    old = write_entry(folder, 'old', 400, 1000)
+    used = write_entry(os.path.join(folder, 'ab'), 'used', 400, 2000)
+    new = write_entry(folder, 'new', 400, 3000)
+    assert prune_cache(folder, 1000) == 1
+    assert not os.path.exists(old)
+    assert os.path.exists(used) and os.path.exists(new)
+    assert prune_cache(folder, 1000) == 0
+
+@pytest.mark.skipif(not cache_available(), reason='pyarrow is not installed')
+def test_clean_cache_hit_marks_entry_as_used(tmp_path):
+    folder = str(tmp_path)
+    df = pd.DataFrame({'Datetime': pd.date_range('2019-01-01', periods=5, freq='H'), 'PM2.5': [1.5, 2.0, 2.5, 3.0, 3.5]})
+    path = store_clean_cache(folder, 'abc', 'PURPLE_AIR', 1, df)
+    os.utime(path, (1000, 1000))
+    sensor_name, cached = load_clean_cache(folder, 'abc', 1)
+    assert sensor_name == 'PURPLE_AIR'
+    pd.testing.assert_frame_equal(cached, df)
+    assert os.stat(path).st_mtime > 1000
+    assert load_clean_cache(folder, 'abc', 2) == (None, None)
+
+def test_caches_stay_out_of_the_output_folder(purple_air_csv, tmp_path, disk_cache, monkeypatch):
+    path = purple_air_csv(rows=500)
+    output = str(tmp_path / 'out')
+    process_file(path, output, (1, 'Hours'), HEADER, render_workers=1, artifacts=['threshold_stats'])
+    #only the report folder is written to the output directory
+    assert [fn.startswith('Purple_Air') for fn in os.listdir(output)] == [True]
+    assert os.path.isdir(disk_cache)
+    #a limit of zero leaves nothing behind after the run
+    monkeypatch.setenv('AQA_DISK_CACHE_MB', '0')
+    process_file(path, output, (2, 'Hours'), HEADER, render_workers=1, artifacts=['threshold_stats'])
+    assert [files for _, _, files in os.walk(disk_cache) if files] == []
+
+@pytest.mark.skipif(not cache_available(), reason='pyarrow is not installed')
+def test_pyramid_round_trips_through_the_cache(tmp_path):
+    folder = str(tmp_path)
+    df = pd.DataFrame({'Datetime': pd.date_range('2019-01-01', periods=500, freq='80S'), 'PM2.5': np.arange(500.0)})
+    pyramid = build_pyramid(df)
+    store_pyramid(folder, 'abc', 'PURPLE_AIR', 1, pyramid, {'rows': 500})
+    loaded, metadata = load_pyramid(folder, 'abc', 'PURPLE_AIR', 1, ['1min', '1h'])
+    assert metadata == {'rows': 500}
+    for name in ['1min', '1h']:
+        pd.testing.assert_frame_equal(loaded[name], pyramid[name], check_names=False, check_freq=False)
+    assert load_pyramid(folder, 'abc', 'PURPLE_AIR', 2, ['1h']) == (None, None)
+
+def test_artifact_store_copies_in_and_out(tmp_path):
+    store = ArtifactStore(str(tmp_path / 'store'))
+    src = tmp_path / 'general_statistics.csv'
+    src.write_text('a,b\n1,2\n')
+    keys = artifact_keys({'data': 'd1', 'header': 'h1'})
+    assert not store.contains(keys['basic_stats'], 'general_statistics.csv')
+    store.save(keys['basic_stats'], 'general_statistics.csv', str(src))
+    src.write_text('edited')
+    out = tmp_path / 'out'
+    out.mkdir()
+    path = store.fetch(keys['basic_stats'], 'general_statistics.csv', str(out))
+    assert open(path).read() == 'a,b\n1,2\n'
+    #a changed source changes the key of everything made from it, and only that
+    changed = artifact_keys({'data': 'd1', 'header': 'h2'})
+    assert changed['basic_stats'] == keys['basic_stats']
+    assert changed['pdf'] != keys['pdf']
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from clean_utils import ResampleAccumulator, get_rate, parse_datetime_column, resample
+from stat_utils import hourly_totals
+
+def sensor_frame(rows, interval, seed=0):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({
+        'Datetime': pd.date_range('2018-08-09 00:00:17', periods=rows, freq='{}S'.format(interval)),
+        'PM2.5': rng.gamma(2.0, 8.0, rows),
+        'Humidity': rng.uniform(20, 90, rows),
+    })
+
+@pytest.mark.parametrize('averaging_range', [(1, 'Hours'), (7, 'Minutes'), (5, 'Hours'), (2, 'Days'), (1, 'Weeks')])
+def test_accumulator_matches_resample_on_out_of_order_chunks(averaging_range):
+    df = sensor_frame(6000, 80)
+    accumulator = ResampleAccumulator(averaging_range)
+    #the last chunk holds the earliest day, so resample's anchor is only known at the end
+    for chunk in reversed([df.iloc[i:i + 700].reset_index(drop=True) for i in range(0, len(df.index), 700)]):
+        accumulator.add(chunk)
+    expected = df.resample(get_rate(averaging_range)[0], on='Datetime').mean().reset_index().dropna(thresh=2)
+    result = accumulator.result()
+    assert result is not None
+    pd.testing.assert_frame_equal(result, expected.reset_index(drop=True), check_dtype=False)
+
+@pytest.mark.parametrize('averaging_range', [(1, 'Hours'), (7, 'Minutes'), (1, 'Weeks')])
+def test_chunking_does_not_change_a_bit(averaging_range):
+    df = sensor_frame(6000, 80)
+    accumulator = ResampleAccumulator(averaging_range)
+    for i in range(0, len(df.index), 777):
+        accumulator.add(df.iloc[i:i + 777].reset_index(drop=True))
+    pd.testing.assert_frame_equal(accumulator.result(), resample(df, averaging_range), check_exact=True)
+    for whole, chunked in zip(accumulator.totals(), hourly_totals(df)):
+        pd.testing.assert_frame_equal(whole, chunked, check_exact=True, check_dtype=False)
+
+def test_accumulator_leaves_noop_resample_to_the_caller():
+    df = sensor_frame(500, 80)
+    accumulator = ResampleAccumulator((1, 'Minutes'))
+    accumulator.add(df)
+    assert accumulator.result() is None
+    assert accumulator.min_time == df['Datetime'].iloc[0]
+    assert accumulator.max_time == df['Datetime'].iloc[-1]
+
+def test_mixed_utc_offsets_keep_their_wall_time():
+    #a log that crossed a daylight saving change, each row was written in the local time of its day
+    col = pd.Series(['2019-03-09 23:00:00-08:00', '2019-03-10 03:00:00-07:00', '2019-03-10 04:00:00-07:00', None])
+    parsed = parse_datetime_column(col)
+    expected = pd.Series(pd.to_datetime(['2019-03-09 23:00:00', '2019-03-10 03:00:00', '2019-03-10 04:00:00', None]))
+    pd.testing.assert_series_equal(parsed, expected)
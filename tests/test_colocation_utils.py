@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import purple_air_frame
+from clean_utils import get_rate
+from colocation_utils import colocate, read_chunks, to_grid
+
+MEASUREMENTS = ['PM1.0_CF_ATM_ug/m3', 'PM2.5_CF_ATM_ug/m3', 'PM10.0_CF_ATM_ug/m3', 'Temperature_F', 'Humidity_%']
+
+@pytest.fixture
+def sensors(tmp_path):
+    #the second sensor reads every measurement as 1.5 times the reference plus 2, at the same times
+    reference = purple_air_frame(5000)
+    biased = reference.copy()
+    biased[MEASUREMENTS] = reference[MEASUREMENTS] * 1.5 + 2
+    paths = [str(tmp_path / 'reference.csv'), str(tmp_path / 'biased.csv')]
+    reference.to_csv(paths[0], index=False)
+    biased.to_csv(paths[1], index=False)
+    return paths
+
+def test_grid_of_chunks_is_the_resampled_file(sensors):
+    whole = to_grid(read_chunks(sensors[0], chunksize=10 ** 6), (1, 'Hours'), 'reference')
+    chunked = to_grid(read_chunks(sensors[0], chunksize=333), (1, 'Hours'), 'reference')
+    pd.testing.assert_frame_equal(chunked, whole, check_exact=True)
+    rows = pd.concat(read_chunks(sensors[0]), ignore_index=True)
+    expected = rows.resample(get_rate((1, 'Hours'))[0], on='Datetime').mean().dropna(how='all')
+    np.testing.assert_allclose(whole.set_index('Datetime').values, expected.values, rtol=1e-12)
+
+def test_known_bias_and_slope_are_recovered(sensors, tmp_path):
+    output = colocate(sensors, (1, 'Hours'), str(tmp_path), chunksize=700)
+    stats = pd.read_csv(output['statistics']).set_index('Measurement')
+    aligned = pd.read_csv(output['aligned_data'])
+    assert list(stats['Reference'].unique()) == ['reference']
+    assert sorted(stats.index) == ['Humidity', 'PM1.0', 'PM10.0', 'PM2.5', 'Temperature']
+    for col in stats.index:
+        reference = aligned['reference:' + col]
+        assert stats.loc[col, 'Pairs'] == len(aligned.index)
+        assert stats.loc[col, 'Slope'] == pytest.approx(1.5, abs=1e-4)
+        assert stats.loc[col, 'Intercept'] == pytest.approx(2.0, abs=1e-3)
+        assert stats.loc[col, 'Correlation'] == pytest.approx(1.0, abs=1e-4)
+        assert stats.loc[col, 'Bias'] == pytest.approx(0.5 * reference.mean() + 2, abs=1e-3)
+
+def test_offset_grids_pair_each_bucket_once(tmp_path):
+    #7 minute buckets do not divide a day, so sensors started on different days have offset day anchored grids
+    reference = purple_air_frame(4000, start='2018-08-09 00:00:17')
+    later = purple_air_frame(4000, start='2018-08-10 00:00:47', seed=1)
+    paths = [str(tmp_path / 'reference.csv'), str(tmp_path / 'later.csv')]
+    reference.to_csv(paths[0], index=False)
+    later.to_csv(paths[1], index=False)
+    output = colocate(paths, (7, 'Minutes'), str(tmp_path))
+    stats = pd.read_csv(output['statistics']).set_index('Measurement')
+    step = pd.Timedelta(minutes=7)
+    origin = pd.Timestamp('1970-01-01')
+    buckets = [set(origin + ((pd.to_datetime(frame['created_at'].str[:19]) - origin) // step) * step)
+               for frame in (reference, later)]
+    assert stats.loc['PM2.5', 'Pairs'] == len(buckets[0] & buckets[1])
@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+from conftest import DATA_DIR, HEADER, purple_air_frame
+from data_file import Data_File
+from frame_cache_utils import FrameCache
+
+REPORT = ['cleaned_data', 'basic_stats', 'threshold_stats']
+
+def read_bytes(folder, name):
+    with open(os.path.join(folder, name), 'rb') as f:
+        return f.read()
+
+def test_streamed_report_of_cleaned_rows_matches_whole_file(purple_air_csv, tmp_path, monkeypatch):
+    #1 minute averages of 80 second samples are the cleaned rows themselves
+    path = purple_air_csv(rows=1800)
+    whole = Data_File(path, str(tmp_path / 'whole'), (1, 'Minutes'), HEADER, render_workers=1, artifacts=REPORT)
+
+    reads = []
+    original = Data_File.read_file
+    def read_file(self, filepath, chunksize=None):
+        reads.append(chunksize)
+        return original(self, filepath, chunksize)
+    monkeypatch.setattr(Data_File, 'read_file', read_file)
+    streamed = Data_File(path, str(tmp_path / 'streamed'), (1, 'Minutes'), HEADER, chunksize=250, render_workers=1,
+                         artifacts=REPORT)
+    #the file is streamed twice and never loaded whole
+    assert reads == [250, 250]
+    for name in ['cleaned_data.csv', 'general_statistics.csv', 'threshold_stats.csv']:
+        assert read_bytes(streamed.output_folder, name) == read_bytes(whole.output_folder, name)
+
+def test_streamed_report_keeps_only_the_drawn_rows(purple_air_csv, tmp_path):
+    path = purple_air_csv(rows=40000)
+    streamed = Data_File(path, str(tmp_path / 'streamed'), (1, 'Minutes'), HEADER, chunksize=5000, render_workers=1,
+                         artifacts=['PM25_thresh', 'boxplot', 'threshold_stats'])
+    assert streamed.samples[0] == 40000
+    assert len(streamed.data_frame.index) < 40000 / 2
+    assert streamed.data_frame['Datetime'].is_monotonic_increasing
+    whole = Data_File(path, str(tmp_path / 'whole'), (1, 'Minutes'), HEADER, render_workers=1, artifacts=['threshold_stats'])
+    assert read_bytes(streamed.output_folder, 'threshold_stats.csv') == read_bytes(whole.output_folder, 'threshold_stats.csv')
+
+@pytest.mark.parametrize('filename', ['Purple_air.csv', 'air_egg.csv'])
+def test_whole_chunked_and_cached_reports_match_exactly(filename, tmp_path, monkeypatch):
+    #small blocks, so the summaries of these files span several of them
+    monkeypatch.setattr('stat_utils.BLOCK_SIZE', 1000)
+    path = os.path.join(DATA_DIR, filename)
+    cache_dir = str(tmp_path / 'cache')
+    whole = Data_File(path, str(tmp_path / 'whole'), (1, 'Hours'), HEADER, render_workers=1, artifacts=REPORT)
+    chunked = Data_File(path, str(tmp_path / 'chunked'), (1, 'Hours'), HEADER, chunksize=777, render_workers=1,
+                        artifacts=REPORT)
+    #the first cached run stores the pyramid, the second averages from it
+    Data_File(path, str(tmp_path / 'store'), (1, 'Hours'), HEADER, cache_dir=cache_dir, render_workers=1, artifacts=REPORT)
+    cached = Data_File(path, str(tmp_path / 'cached'), (1, 'Hours'), HEADER, cache_dir=cache_dir, render_workers=1,
+                       artifacts=REPORT)
+    assert whole.data_frame.select_dtypes(include='number').dtypes.eq('float64').all()
+    for name in ['cleaned_data.csv', 'general_statistics.csv', 'threshold_stats.csv']:
+        assert read_bytes(chunked.output_folder, name) == read_bytes(whole.output_folder, name)
+        assert read_bytes(cached.output_folder, name) == read_bytes(whole.output_folder, name)
+
+def test_streamed_run_fills_the_frame_cache(purple_air_csv, tmp_path):
+    path = purple_air_csv(rows=3000)
+    frame_cache = FrameCache()
+    Data_File(path, str(tmp_path / 'streamed'), (1, 'Hours'), HEADER, chunksize=400, render_workers=1,
+              frame_cache=frame_cache, artifacts=REPORT)
+    assert frame_cache.stats()['frames'] == 1
+    whole = Data_File(path, str(tmp_path / 'whole'), (1, 'Hours'), HEADER, render_workers=1, artifacts=REPORT)
+    rerun = Data_File(path, str(tmp_path / 'rerun'), (1, 'Hours'), HEADER, chunksize=400, render_workers=1,
+                      frame_cache=frame_cache, artifacts=REPORT)
+    assert frame_cache.hits == 1
+    for name in ['cleaned_data.csv', 'general_statistics.csv', 'threshold_stats.csv']:
+        assert read_bytes(rerun.output_folder, name) == read_bytes(whole.output_folder, name)
+
+def test_chunks_that_do_not_fit_are_not_cached(purple_air_csv, tmp_path):
+    path = purple_air_csv(rows=3000)
+    frame_cache = FrameCache(max_mb=0.1)
+    Data_File(path, str(tmp_path / 'streamed'), (1, 'Hours'), HEADER, chunksize=400, render_workers=1,
+              frame_cache=frame_cache, artifacts=REPORT)
+    assert frame_cache.stats()['frames'] == 0
+
+def test_incremental_report_of_cleaned_rows_reads_only_the_tail(tmp_path, monkeypatch):
+    #1 minute averages of 80 second samples are the cleaned rows themselves, so nothing is resampled
+    frame = purple_air_frame(3000)
+    path = str(tmp_path / 'purple_air.csv')
+    frame.iloc[:2000].to_csv(path, index=False)
+    state_dir = str(tmp_path / 'state')
+    first = Data_File(path, str(tmp_path / 'first'), (1, 'Minutes'), HEADER, render_workers=1, state_dir=state_dir,
+                      artifacts=REPORT)
+    assert first.samples[0] == 2000
+    frame.iloc[2000:].to_csv(path, mode='a', header=False, index=False)
+
+    reads = []
+    monkeypatch.setattr(Data_File, 'read_file', lambda self, filepath, chunksize=None: reads.append(filepath))
+    second = Data_File(path, str(tmp_path / 'second'), (1, 'Minutes'), HEADER, render_workers=1, state_dir=state_dir,
+                       artifacts=REPORT)
+    assert reads == []
+    assert second.instrumentation.records['clean/read_tail']['rows'] == 1000
+    monkeypatch.undo()
+    whole = Data_File(path, str(tmp_path / 'whole'), (1, 'Minutes'), HEADER, render_workers=1, artifacts=REPORT)
+    for name in ['cleaned_data.csv', 'general_statistics.csv', 'threshold_stats.csv']:
+        assert read_bytes(second.output_folder, name) == read_bytes(whole.output_folder, name)
+    assert second.data_frame['Datetime'].is_monotonic_increasing
@@ -0,0 +1,31 @@
+import pandas as pd
+import pytest
+
+from conftest import purple_air_frame
+from excel_utils import can_stream, read_sheet, sheet_headers
+from sensors import NA_VALUES, PurpleAirFormat
+
+@pytest.fixture
+def workbook(tmp_path):
+    path = str(tmp_path / 'purple_air.xlsx')
+    df = purple_air_frame(300).astype({'Temperature_F': object})
+    df.loc[5, 'Temperature_F'] = '---'
+    with pd.ExcelWriter(path) as writer:
+        pd.DataFrame({'Notes': ['exported by hand']}).to_excel(writer, sheet_name='Notes', index=False)
+        df.to_excel(writer, sheet_name='Data', index=False)
+    return path
+
+def test_sheet_is_read_like_read_excel(workbook):
+    if not can_stream(workbook):
+        pytest.skip('openpyxl is not installed')
+    sensor_format = PurpleAirFormat()
+    usecols = sensor_format.used_columns()
+    dtypes = dict((col, dtype) for col, dtype in sensor_format.dtypes.items() if col in usecols)
+    assert [name for name, _ in sheet_headers(workbook)] == ['Notes', 'Data']
+    expected = pd.read_excel(workbook, sheet_name='Data', header=0, names=sensor_format.columns, usecols=usecols,
+                             dtype=dtypes, na_values=NA_VALUES)
+    whole = read_sheet(workbook, 'Data', sensor_format.columns, usecols, dtypes, NA_VALUES)
+    pd.testing.assert_frame_equal(whole, expected)
+    chunks = list(read_sheet(workbook, 'Data', sensor_format.columns, usecols, dtypes, NA_VALUES, 128))
+    assert [len(chunk.index) for chunk in chunks] == [128, 128, 44]
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), expected)
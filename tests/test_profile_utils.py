@@ -0,0 +1,55 @@
+import json
+import tracemalloc
+
+from profile_utils import Instrumentation
+
+MB = 1024 * 1024
+
+def test_nested_stage_keeps_the_outer_peak():
+    instrumentation = Instrumentation(trace_memory=True)
+    try:
+        with instrumentation.stage('outer'):
+            block = bytearray(20 * MB)
+            del block
+            with instrumentation.stage('inner'):
+                small = bytearray(2 * MB)
+                del small
+    finally:
+        instrumentation.stop()
+    records = instrumentation.records
+    assert records['outer']['tracemalloc_peak_mb'] >= 20
+    assert 2 <= records['outer/inner']['tracemalloc_peak_mb'] < 20
+
+def test_inner_peak_counts_towards_the_outer_stage():
+    instrumentation = Instrumentation(trace_memory=True)
+    try:
+        with instrumentation.stage('outer'):
+            with instrumentation.stage('inner'):
+                block = bytearray(20 * MB)
+                del block
+    finally:
+        instrumentation.stop()
+    assert instrumentation.records['outer']['tracemalloc_peak_mb'] >= 20
+
+def test_stop_leaves_tracing_it_did_not_start():
+    tracemalloc.start()
+    try:
+        instrumentation = Instrumentation(trace_memory=True)
+        with instrumentation.stage('read_file'):
+            pass
+        instrumentation.stop()
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+    Instrumentation(trace_memory=True).stop()
+    assert not tracemalloc.is_tracing()
+
+def test_rss_is_reported_for_the_process_not_per_stage(tmp_path):
+    instrumentation = Instrumentation()
+    with instrumentation.stage('read_file') as info:
+        info['rows'] = 10
+    with open(instrumentation.write(str(tmp_path))) as f:
+        timings = json.load(f)
+    assert 'process_peak_rss_mb' in timings
+    assert timings['stages']['read_file']['rows'] == 10
+    assert 'peak_rss_mb' not in timings['stages']['read_file']
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+import vis_utils
+from conftest import HEADER
+from clean import process_file
+from progress_utils import CancelToken, Cancelled
+
+def test_cancel_stops_a_streamed_run_at_the_next_chunk(purple_air_csv, tmp_path):
+    path = purple_air_csv(rows=5000)
+    output_path = tmp_path / 'output'
+    output_path.mkdir()
+    token = CancelToken()
+    events = []
+    def progress(event):
+        events.append(event.stage)
+        if event.stage == 'clean/filter_on_time':
+            #cancelled once the first chunk is cleaned, as if from the GUI thread
+            token.cancel()
+    with pytest.raises(Cancelled):
+        process_file(path, str(output_path), (1, 'Hours'), HEADER, chunksize=500, use_cache=False,
+                     progress=progress, cancel_token=token)
+    assert events.count('clean/parse_datetime') == 1
+    assert os.listdir(str(output_path)) == []
+
+def test_cancel_stops_rendering_between_charts(purple_air_csv, tmp_path, monkeypatch):
+    path = purple_air_csv(rows=2000)
+    output_path = tmp_path / 'output'
+    output_path.mkdir()
+    token = CancelToken()
+    rendered = []
+    original = vis_utils.render_in_process
+    def render_in_process(df, output_folder, charts, checkpoint=None):
+        def cancel_after_first():
+            if rendered:
+                token.cancel()
+            checkpoint()
+            rendered.append(True)
+        return original(df, output_folder, charts, cancel_after_first)
+    monkeypatch.setattr('vis_utils.render_in_process', render_in_process)
+    with pytest.raises(Cancelled):
+        process_file(path, str(output_path), (1, 'Hours'), HEADER, use_cache=False, cancel_token=token)
+    assert len(rendered) == 1
+    assert os.listdir(str(output_path)) == []
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from clean_utils import get_rate, resample, rollup
+from pyramid_utils import build_pyramid, level_stat, pyramid_level
+
+def sensor_frame(rows, interval=80):
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({
+        'Datetime': pd.date_range('2019-03-30 21:00:17', periods=rows, freq='{}S'.format(interval)),
+        'PM2.5': np.round(rng.gamma(2.0, 8.0, rows), 2),
+        'Humidity': rng.uniform(20, 90, rows),
+    })
+    df.loc[100:150, 'Humidity'] = np.nan
+    return df
+
+def test_every_level_summarizes_the_rows():
+    df = sensor_frame(5000)
+    pyramid = build_pyramid(df)
+    for name, freq in [('1min', 'T'), ('1h', 'H'), ('1d', 'D')]:
+        groups = df.drop('Datetime', axis=1).groupby(df['Datetime'].dt.floor(freq).values)
+        level = pyramid[name]
+        pd.testing.assert_frame_equal(level_stat(level, 'sum'), groups.sum())
+        pd.testing.assert_frame_equal(level_stat(level, 'count'), groups.count())
+        pd.testing.assert_frame_equal(level_stat(level, 'min'), groups.min())
+        pd.testing.assert_frame_equal(level_stat(level, 'max'), groups.max())
+
+@pytest.mark.parametrize('averaging_range', [(1, 'Hours'), (15, 'Minutes'), (3, 'Days'), (1, 'Months')])
+def test_rollup_of_the_pyramid_is_the_resample_of_the_rows(averaging_range):
+    df = sensor_frame(40000)
+    rate = get_rate(averaging_range)[0]
+    level = build_pyramid(df)[pyramid_level(rate)]
+    rolled = rollup(level_stat(level, 'sum'), level_stat(level, 'count'), rate)
+    pd.testing.assert_frame_equal(rolled, resample(df, averaging_range), check_exact=True)
+
+def test_pyramid_level_fits_the_averaging_range():
+    assert pyramid_level('7T') == '1min'
+    assert pyramid_level('2H') == '1h'
+    assert pyramid_level('90T') == '1min'
+    assert pyramid_level('2D') == '1d'
+    assert pyramid_level('1W') == '1d'
+    assert pyramid_level('30S') is None
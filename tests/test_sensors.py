@@ -0,0 +1,36 @@
+import datetime
+import io
+
+import pytest
+
+from clean_utils import parse_datetime_column
+from sensors import PurpleAirFormat, first_line_where
+
+def test_first_line_where_finds_the_first_matching_line():
+    lines = [b'%d\n' % n for n in range(0, 1000, 3)]
+    data = b''.join(lines)
+    f = io.BytesIO(data)
+    for target in [0, 1, 500, 997, 998]:
+        offset = first_line_where(f, 0, len(data), lambda line: int(line) >= target)
+        expected = sum(len(line) for line in lines if int(line) < target)
+        assert offset == expected
+
+@pytest.mark.parametrize('window', [('2018-08-09 10:00:00', '2018-08-09 12:30:00'),
+                                    ('2018-08-08 00:00:00', '2018-08-09 00:30:00'),
+                                    ('2018-08-09 23:00:00', '2018-08-12 00:00:00')])
+def test_read_window_reads_only_the_rows_in_the_window(purple_air_csv, window):
+    path = purple_air_csv(rows=2000)
+    sensor_format = PurpleAirFormat()
+    start, stop = [datetime.datetime.strptime(t, '%Y-%m-%d %H:%M:%S') for t in window]
+    rows = sensor_format.read(path)
+    times = parse_datetime_column(rows['Datetime'], sensor_format.time_format)
+    expected = rows[(times >= start) & (times <= stop)]
+    windowed = sensor_format.read_window(path, start, stop)
+    assert len(windowed.index) > 0
+    assert windowed['Datetime'].tolist() == expected['Datetime'].tolist()
+    assert windowed['PM2.5'].tolist() == expected['PM2.5'].tolist()
+
+def test_read_window_outside_the_file_finds_nothing(purple_air_csv):
+    path = purple_air_csv(rows=100)
+    start = datetime.datetime(2019, 1, 1)
+    assert PurpleAirFormat().read_window(path, start, start + datetime.timedelta(days=1)) is None
@@ -0,0 +1,107 @@
+import asyncio
+import os
+import queue
+import threading
+
+import pytest
+
+from conftest import HEADER
+from server import UPLOAD_FOLDER, JobServer, LocalClient, serve_async
+
+@pytest.fixture
+def start_server(tmp_path):
+    '''Serves a JobServer on a free port in a background thread, keyword arguments go to JobServer'''
+    running = []
+    def start(**kwargs):
+        job_server = JobServer(str(tmp_path / 'output'), HEADER, workers=1, use_cache=False, **kwargs)
+        started = queue.Queue()
+        async def main():
+            task = asyncio.current_task()
+            await serve_async(job_server, '127.0.0.1', 0, None,
+                              lambda server: started.put((server, asyncio.get_running_loop(), task)))
+        def run():
+            try:
+                asyncio.run(main())
+            except asyncio.CancelledError:
+                pass
+        thread = threading.Thread(target=run)
+        thread.start()
+        server, loop, task = started.get(timeout=10)
+        running.append((job_server, thread, loop, task))
+        return job_server, LocalClient(server.sockets[0].getsockname()[1])
+    yield start
+    for job_server, thread, loop, task in running:
+        loop.call_soon_threadsafe(task.cancel)
+        thread.join(10)
+        job_server.shutdown()
+
+def test_submit_poll_and_download(start_server, purple_air_csv, tmp_path):
+    _, client = start_server()
+    path = purple_air_csv(rows=500)
+    job = client.submit((1, 'Hours'), path=path)
+    assert job['status'] == 'running'
+    job = client.wait(job['id'], poll_interval=0.1)
+    assert job['status'] == 'done', job['error']
+    assert 'summary.pdf' in job['files']
+    outpath = client.download(job['id'], 'summary.pdf', str(tmp_path / 'summary.pdf'))
+    with open(outpath, 'rb') as f:
+        assert f.read(4) == b'%PDF'
+    with open(path, 'rb') as f:
+        uploaded = client.wait(client.submit((1, 'Hours'), data=f.read(), filename='sensor.csv')['id'], poll_interval=0.1)
+    assert uploaded['status'] == 'done', uploaded['error']
+
+def test_bad_requests_get_400_and_unknown_ids_404(start_server, purple_air_csv, tmp_path):
+    _, client = start_server()
+    path = purple_air_csv(rows=100)
+    with pytest.raises(ValueError, match='^400 '):
+        client.submit((1, 'Fortnights'), path=path)
+    with pytest.raises(ValueError, match='^400 '):
+        client.submit((1, 'Hours'), path=str(tmp_path / 'missing.csv'))
+    with pytest.raises(ValueError, match='^400 '):
+        client.submit((1, 'Hours'), data=b'a,b\n1,2\n', filename='notes.txt')
+    with pytest.raises(ValueError, match='^404 '):
+        client.job('0' * 32)
+    job = client.wait(client.submit((1, 'Hours'), path=path)['id'], poll_interval=0.1)
+    with pytest.raises(ValueError, match='^404'):
+        client.download(job['id'], 'missing.pdf', str(tmp_path / 'missing.pdf'))
+
+def test_paths_are_kept_to_the_data_root(start_server, purple_air_csv, tmp_path):
+    data_root = tmp_path / 'data'
+    data_root.mkdir()
+    outside = purple_air_csv(rows=100)
+    os.symlink(outside, str(data_root / 'link.csv'))
+    _, client = start_server(data_root=str(data_root))
+    with pytest.raises(ValueError, match='^403 '):
+        client.submit((1, 'Hours'), path=outside)
+    with pytest.raises(ValueError, match='^403 '):
+        client.submit((1, 'Hours'), path=str(data_root / '..' / os.path.basename(outside)))
+    with pytest.raises(ValueError, match='^403 '):
+        client.submit((1, 'Hours'), path=str(data_root / 'link.csv'))
+    inside = str(data_root / 'sensor.csv')
+    os.replace(outside, inside)
+    assert client.submit((1, 'Hours'), path=inside)['status'] == 'running'
+
+def test_paths_are_refused_off_loopback_without_a_data_root(start_server, purple_air_csv):
+    job_server, client = start_server()
+    assert job_server.local
+    #as if it listened on another address, the client still reaches it on 127.0.0.1
+    job_server.local = False
+    with pytest.raises(ValueError, match='^403 '):
+        client.submit((1, 'Hours'), path=purple_air_csv(rows=100))
+
+def test_finished_jobs_and_their_uploads_expire(start_server, purple_air_csv):
+    job_server, client = start_server(max_jobs=1)
+    uploads = []
+    for rows in [100, 120]:
+        with open(purple_air_csv(rows=rows), 'rb') as f:
+            job = client.wait(client.submit((1, 'Hours'), data=f.read(), filename='sensor.csv')['id'], poll_interval=0.1)
+        uploads.append(job)
+    #only the newest finished job is kept, the upload of the older one is deleted with it
+    with pytest.raises(ValueError, match='^404 '):
+        client.job(uploads[0]['id'])
+    assert client.job(uploads[1]['id'])['status'] == 'done'
+    assert os.listdir(os.path.join(job_server.output_path, UPLOAD_FOLDER)) == [os.path.basename(uploads[1]['file'])]
+    job_server.job_ttl = 0
+    job_server.expire(float('inf'))
+    assert job_server.jobs == {}
+    assert os.listdir(os.path.join(job_server.output_path, UPLOAD_FOLDER)) == []
@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+
+from stat_utils import QUARTILES, Moments, QuantileSketch, SummaryStats, period_means
+
+def hourly_totals_of(hours, per_hour, value=10.0):
+    #hourly sums and counts of per_hour samples of a constant value every hour
+    counts = pd.Series(per_hour, index=hours, dtype='int64')
+    return counts * value, counts
+
+def test_hour_completeness_follows_the_nominal_interval():
+    hours = pd.date_range('2019-01-01', periods=48, freq='H')
+    #80 second samples give 45 an hour, 30 is only two thirds of that however typical it is in the file
+    sums, counts = hourly_totals_of(hours, 30)
+    means = period_means(sums, counts, 80.0)
+    assert len(means['H']) == 0
+    assert len(means['D']) == 0
+    sums, counts = hourly_totals_of(hours, 34)
+    means = period_means(sums, counts, 80.0)
+    assert len(means['H']) == 48
+    assert len(means['D']) == 2
+
+def test_hourly_data_needs_one_sample_an_hour():
+    hours = pd.date_range('2019-01-01', periods=24, freq='H')
+    sums, counts = hourly_totals_of(hours, 1)
+    assert len(period_means(sums, counts, 3600.0)['H']) == 24
+    assert len(period_means(sums, counts, np.nan)['D']) == 1
+
+def test_year_needs_every_quarter_complete():
+    hours = pd.date_range('2019-01-01', '2019-12-31 23:00', freq='H')
+    #a full year, but only 60% of the fourth quarter: over 75% of the year and still incomplete
+    keep = hours < pd.Timestamp('2019-10-01') + pd.Timedelta(days=55)
+    sums, counts = hourly_totals_of(hours[keep], 1)
+    means = period_means(sums, counts, 3600.0)
+    assert len(means['A']) == 0
+    #the fourth quarter is the one short of 75% of its days
+    days = means['D'].groupby(means['D'].index.quarter).size()
+    assert dict(days) == {1: 90, 2: 91, 3: 92, 4: 55}
+
+def test_annual_mean_is_the_mean_of_quarterly_means():
+    hours = pd.date_range('2019-01-01', '2019-12-31 23:00', freq='H')
+    counts = pd.Series(1, index=hours, dtype='int64')
+    #the first quarter reads 20, the rest 10, and a quarter of the days of the third quarter are missing
+    values = pd.Series(np.where(hours.quarter == 1, 20.0, 10.0), index=hours)
+    missing = (hours.quarter == 3) & (hours.day <= 7)
+    annual = period_means(values[~missing] * counts[~missing], counts[~missing], 3600.0)['A']
+    assert list(annual.index) == [2019]
+    assert annual.iloc[0] == 12.5
+
+def test_sketch_is_exact_until_a_block_is_compacted():
+    values = np.random.RandomState(1).gamma(2.0, 8.0, 5000)
+    sketch = QuantileSketch()
+    for part in np.array_split(values, 7):
+        sketch.update(part)
+    assert list(sketch.quantiles(QUARTILES)) == list(pd.Series(values).quantile(QUARTILES))
+
+def test_sketch_rank_error_is_small(monkeypatch):
+    monkeypatch.setattr('stat_utils.BLOCK_SIZE', 1000)
+    values = np.random.RandomState(2).lognormal(2.0, 1.0, 200000)
+    sketch = QuantileSketch(k=256)
+    for part in np.array_split(values, 13):
+        sketch.update(part)
+    ordered = np.sort(values)
+    for q, estimate in zip([0.01, 0.25, 0.5, 0.75, 0.99], sketch.quantiles([0.01, 0.25, 0.5, 0.75, 0.99])):
+        rank = np.searchsorted(ordered, estimate) / float(len(values))
+        assert abs(rank - q) < 0.01
+
+def test_sketches_of_parts_merge_into_the_sketch_of_the_whole(monkeypatch):
+    monkeypatch.setattr('stat_utils.BLOCK_SIZE', 1000)
+    values = np.random.RandomState(3).normal(size=30000)
+    merged = QuantileSketch()
+    for part in np.array_split(values, 4):
+        sketch = QuantileSketch()
+        sketch.update(part)
+        merged.merge(sketch)
+    assert merged.n == len(values)
+    ordered = np.sort(values)
+    for q, estimate in zip(QUARTILES, merged.quantiles(QUARTILES)):
+        assert abs(np.searchsorted(ordered, estimate) / float(len(values)) - q) < 0.01
+
+def test_moments_merge_like_one_pass(monkeypatch):
+    monkeypatch.setattr('stat_utils.BLOCK_SIZE', 1000)
+    values = np.random.RandomState(4).normal(1e5, 3.0, 25000)
+    values[::97] = np.nan
+    merged = Moments()
+    for part in np.array_split(values, 5):
+        moments = Moments()
+        moments.update(part)
+        merged.merge(moments)
+    n, mean, m2, low, high = merged.result()
+    valid = values[~np.isnan(values)]
+    assert n == len(valid)
+    assert np.isclose(mean, valid.mean(), rtol=0, atol=1e-9)
+    assert np.isclose(m2 / (n - 1), valid.var(ddof=1), rtol=1e-9)
+    assert (low, high) == (valid.min(), valid.max())
+
+def test_summary_does_not_depend_on_chunking(monkeypatch):
+    monkeypatch.setattr('stat_utils.BLOCK_SIZE', 1000)
+    rng = np.random.RandomState(5)
+    df = pd.DataFrame({'PM2.5': rng.gamma(2.0, 8.0, 12345), 'Pressure': rng.normal(98323, 40, 12345)})
+    whole = SummaryStats()
+    whole.add(df)
+    chunked = SummaryStats()
+    for start in range(0, len(df.index), 777):
+        chunked.add(df.iloc[start:start + 777])
+    pd.testing.assert_frame_equal(chunked.describe(), whole.describe(), check_exact=True)
+    pd.testing.assert_frame_equal(whole.describe().drop(['25%', '50%', '75%']),
+                                  df.describe().drop(['25%', '50%', '75%']), check_dtype=False)
+
+def test_summary_of_a_small_frame_is_describe():
+    df = pd.DataFrame({'PM2.5': np.random.RandomState(6).gamma(2.0, 8.0, 999)})
+    summary = SummaryStats()
+    summary.add(df)
+    pd.testing.assert_frame_equal(summary.describe(), df.describe(), check_dtype=False)
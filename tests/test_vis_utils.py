@@ -0,0 +1,66 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+
+from vis_utils import ChartReducer, m4_indices, render_charts
+
+def chart_frame(rows=200):
+    rng = np.random.RandomState(0)
+    return pd.DataFrame({
+        'Datetime': pd.date_range('2019-06-01', periods=rows, freq='H'),
+        'Temperature': rng.uniform(60, 90, rows),
+        'Humidity': rng.uniform(20, 90, rows),
+        'PM2.5': rng.gamma(2.0, 8.0, rows),
+        'PM10.0': rng.gamma(2.0, 12.0, rows),
+    })
+
+def test_render_pool_is_shut_down_after_each_call(tmp_path):
+    charts = render_charts(chart_frame(), str(tmp_path), max_workers=2, names=['humidity_graph', 'PM25_thresh'])
+    assert sorted(charts) == ['PM25_thresh', 'humidity_graph']
+    assert all(os.path.getsize(path) > 0 for path in charts.values())
+    assert multiprocessing.active_children() == []
+
+def test_charts_render_in_process_by_default(tmp_path, monkeypatch):
+    monkeypatch.setattr('vis_utils.ProcessPoolExecutor', None)
+    charts = render_charts(chart_frame(), str(tmp_path))
+    assert sorted(charts) == ['PM10_thresh', 'PM25_thresh', 'boxplot', 'humidity_graph']
+
+def test_m4_keeps_first_last_min_and_max_of_every_bucket():
+    rng = np.random.RandomState(1)
+    x = np.arange(10000, dtype=np.int64) * 1000
+    y = rng.normal(size=10000)
+    idx = m4_indices(x, y, 50)
+    assert idx[0] == 0 and idx[-1] == 9999
+    assert len(idx) <= 4 * 50
+    bins = (x / float(x[-1] + 1) * 50).astype(int)
+    for b in range(50):
+        in_bin = np.flatnonzero(bins == b)
+        kept = np.intersect1d(idx, in_bin)
+        assert y[kept].min() == y[in_bin].min()
+        assert y[kept].max() == y[in_bin].max()
+        assert kept[0] == in_bin[0] and kept[-1] == in_bin[-1]
+
+def test_m4_keeps_gaps_and_leaves_short_series_alone():
+    x = np.arange(1000, dtype=np.int64)
+    y = np.sin(x / 50.0)
+    y[400:420] = np.nan
+    idx = m4_indices(x, y, 10)
+    assert 400 in idx
+    assert m4_indices(x[:40], y[:40], 10) is None
+
+def test_reducer_keeps_what_the_whole_series_draws():
+    df = chart_frame(20000)
+    df.loc[5000:5100, 'PM2.5'] = np.nan
+    start, end = df['Datetime'].iloc[0], df['Datetime'].iloc[-1]
+    reducer = ChartReducer(start, end)
+    for i in range(0, len(df.index), 3000):
+        reducer.add(df.iloc[i:i + 3000])
+    reduced = reducer.result()
+    assert reduced['Datetime'].is_monotonic_increasing
+    assert len(reduced.index) < len(df.index)
+    x = df['Datetime'].values.view('int64')
+    for col in ['PM2.5', 'Humidity']:
+        whole = df.iloc[m4_indices(x, df[col].values, 2000, x[0], x[-1])]
+        assert set(whole['Datetime']) <= set(reduced['Datetime'])
@@ -0,0 +1,49 @@
+import json
+import os
+
+from watcher import FAILED_NAME, PROCESSED_NAME, InboxWatcher
+from conftest import HEADER
+
+def run_once(watcher):
+    watcher.poll()
+    while watcher.running:
+        watcher.collect(1)
+
+def test_failed_files_are_retried_and_not_recorded_as_processed(purple_air_csv, tmp_path):
+    inbox = tmp_path / 'inbox'
+    inbox.mkdir()
+    output = str(tmp_path / 'output')
+    good = purple_air_csv(name='inbox/good.csv', rows=500)
+    with open(str(inbox / 'bad.csv'), 'w') as f:
+        f.write('not,a,sensor\n1,2,3\n')
+    watcher = InboxWatcher(str(inbox), output, (1, 'Hours'), HEADER, workers=1, settle_seconds=0,
+                           use_cache=False, max_attempts=2, retry_seconds=0)
+    try:
+        #the first poll starts the settle timers, the second queues the files
+        watcher.poll()
+        run_once(watcher)
+        with open(os.path.join(output, PROCESSED_NAME)) as f:
+            processed = json.load(f)
+        assert [entry['file'] for entry in processed.values()] == [good]
+        with open(os.path.join(output, FAILED_NAME)) as f:
+            failures = list(json.load(f).values())
+        assert [(failure['file'], failure['attempts']) for failure in failures] == [(str(inbox / 'bad.csv'), 1)]
+
+        #the backoff is over at once, so the next poll retries it, and then it is given up on
+        run_once(watcher)
+        run_once(watcher)
+        assert [failure['attempts'] for failure in watcher.failures.values()] == [2]
+        assert watcher.counts['failed'] == 2 and watcher.counts['processed'] == 1
+        assert watcher.status(0)['given_up'] == 1
+    finally:
+        watcher.executor.shutdown()
+
+    #a restarted watcher keeps the failures and does not try the file again
+    restarted = InboxWatcher(str(inbox), output, (1, 'Hours'), HEADER, workers=1, settle_seconds=0,
+                             use_cache=False, max_attempts=2, retry_seconds=0)
+    try:
+        restarted.poll()
+        run_once(restarted)
+        assert restarted.counts == {'processed': 0, 'failed': 0, 'duplicates': 1}
+    finally:
+        restarted.executor.shutdown()